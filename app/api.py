@@ -1,33 +1,48 @@
 from contextlib import asynccontextmanager
+from hmac import compare_digest
+from typing import Optional
 from urllib.parse import urlencode
 
 from config import TEMPLATES, get_settings
-from database import Session, engine
-from database import get_session as database_session
+from database import session_scope
 from fastapi import Depends, FastAPI, status
 from fastapi.responses import (
     FileResponse,
     HTMLResponse,
+    JSONResponse,
     RedirectResponse,
     Response,
+    StreamingResponse,
 )
+from live import view
+from logger import logger as log
+from migrations import migrate
 from models import Credentials
+from orders import OrderEvent, apply_event
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from registry import clients, notify
+from risk import risk_view
 from sqlmodel import update
 from upstox_client import LoginApi
 from upstox_client.rest import ApiException
 
 
 def get_session():
-    with Session(engine) as session:
+    with session_scope() as session:
         yield session
 
 
 @asynccontextmanager
 async def lifespan(_: FastAPI):
+    migrate()
     # Reset the is_active attribute to 0 whenever the server starts
-    database: Session = database_session()
-    database.exec(update(Credentials).values(is_active=0))
-    database.commit()
+    with session_scope() as database:
+        database.exec(update(Credentials).values(is_active=0))
+        notify(database)
+    # Positions and risk are served from what the trading app pushes
+    risk_view.start()
+    view.start()
+    clients.start()
     yield
 
 
@@ -39,6 +54,65 @@ def favicon() -> Response:
     return FileResponse("favicon.ico")
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics() -> Response:
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.post("/postback", include_in_schema=False)
+def postback(event: OrderEvent, secret: str = "") -> Response:
+    # Upstox does not sign postbacks, so the URL given to it carries a secret
+    expected = get_settings().postback_secret
+    if not expected:
+        # Without a secret anyone could post fills, the reconciliation still runs
+        log.warning("Postback refused, POSTBACK_SECRET is not set")
+        return Response(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+    if not compare_digest(secret, expected):
+        return Response(status_code=status.HTTP_401_UNAUTHORIZED)
+    apply_event(event)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+@app.get("/risk")
+def risk_report() -> Response:
+    """Greeks of the open iron flies, as the trading app last pushed them"""
+    report = risk_view.report
+    if report is None:
+        return JSONResponse(
+            {"detail": "No risk report pushed by the trading app"},
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    return JSONResponse(report)
+
+
+@app.get("/positions")
+def positions() -> Response:
+    """Positions and P&L of every client, as the trading app last pushed them"""
+    version, states = view.since()
+    return JSONResponse({"version": version, "clients": states})
+
+
+@app.get("/positions/stream")
+def positions_stream(client_id: Optional[str] = None) -> Response:
+    """Server-sent events of the positions of every client, or of one client"""
+    return StreamingResponse(
+        view.stream(client_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@app.get("/positions/{client_id}")
+def client_positions(client_id: str) -> Response:
+    state = view.get(client_id.upper())
+    if state is None:
+        return JSONResponse(
+            {"detail": "No positions pushed for the client"},
+            status_code=status.HTTP_404_NOT_FOUND,
+        )
+    return JSONResponse(state)
+
+
 @app.get("/login/{client_id}")
 def login(client_id: str, database=Depends(get_session)) -> Response:
     client_id = client_id if client_id.isupper() else client_id.upper()
@@ -74,6 +148,7 @@ def callback(code: str, state: str, database=Depends(get_session)) -> Response:
         )
         client.is_active = 1
         client.access_token = login_info.access_token
+        notify(database, client.client_id)
         database.commit()
         with open(f"{TEMPLATES}/close_tab.html", "r") as close_tab_html:
             return HTMLResponse(close_tab_html.read())
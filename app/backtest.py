@@ -0,0 +1,411 @@
+"""Vectorized backtest of the iron fly over historical minute bars.
+
+    uv run app/backtest.py --nifty nifty.parquet --options options.parquet \\
+        --sl 1.25 1.5 2 --adjustment 0.5 0.7 1 --wing 0.8 1 1.2
+
+The NIFTY file needs `timestamp` and `close` columns. The options file needs
+`timestamp`, `expiry`, `strike`, `option_type` (CE/PE) and `close`. Both can
+be CSV or Parquet; Parquet, and faster CSV parsing, need the `backtest`
+extra (pyarrow).
+
+Every entry and every parameter set is evaluated at once with the rules from
+`rules.py`, the same functions the live jobs use. Like the live jobs an iron
+fly is entered at the weekly entry time in the first monthly expiry after
+that day, the last expiry of its month (`--series weekly` trades the first
+expiry of any kind instead), its stoplosses and adjustment band are checked on every minute, and an entry
+is skipped while an iron fly near the same strike is still open. Legs fill at
+the close of the bar, and what is still open at expiry is settled at the last
+close of the contract.
+"""
+
+import csv
+from argparse import ArgumentParser
+from datetime import time
+from itertools import product
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+from rules import (
+    ADJUSTMENT_FACTOR,
+    SL_MULTIPLE,
+    WING_FACTOR,
+    adjustment_hit,
+    blocks_redeploy,
+    exit_levels,
+    nearest_price,
+    stoploss_hit,
+    wing_strikes,
+)
+
+CE, PE = 0, 1
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday")
+MONTHLY, WEEKLY = "monthly", "weekly"
+
+
+def read_table(path: Path) -> Dict[str, np.ndarray]:
+    """Return the columns of a CSV or Parquet file as arrays"""
+    try:
+        import pyarrow
+        from pyarrow import csv as arrow_csv
+        from pyarrow import parquet, types
+    except ImportError:
+        if path.suffix == ".parquet":
+            raise Exception("Reading Parquet needs the `backtest` extra (pyarrow)")
+        with path.open(newline="") as table_file:
+            reader = csv.reader(table_file)
+            header = next(reader)
+            columns = list(zip(*reader))
+        return {name: np.array(column) for name, column in zip(header, columns)}
+
+    def to_numpy(column) -> np.ndarray:
+        column = column.combine_chunks()
+        if types.is_string(column.type) or types.is_large_string(column.type):
+            # Millions of Python strings would not fit in memory, a fixed width
+            # array built from the few distinct values does
+            encoded = column.dictionary_encode()
+            values = np.array(encoded.dictionary.to_pylist())
+            return values[encoded.indices.to_numpy()]
+        return column.to_numpy(zero_copy_only=False)
+
+    if path.suffix != ".parquet":
+        table = arrow_csv.read_csv(path)
+        return {name: to_numpy(table[name]) for name in table.column_names}
+    # A column at a time, so that only one column is ever held twice
+    parquet_file = parquet.ParquetFile(path, memory_map=True)
+    columns = dict()
+    for name in parquet_file.schema_arrow.names:
+        columns[name] = to_numpy(parquet_file.read(columns=[name])[name])
+        pyarrow.default_memory_pool().release_unused()
+    return columns
+
+
+def minutes(column: np.ndarray) -> np.ndarray:
+    return np.asarray(column).astype("datetime64[m]")
+
+
+class Contract(NamedTuple):
+    """Closes of every strike of one expiry, shaped (minute, strike, CE/PE)"""
+
+    first: int
+    last: int
+    strikes: np.ndarray
+    closes: np.ndarray
+
+
+class History:
+    """NIFTY and option minute bars laid out as dense arrays"""
+
+    def __init__(self, nifty: Dict[str, np.ndarray], options: Dict[str, np.ndarray]):
+        times = minutes(nifty["timestamp"])
+        order = np.argsort(times)
+        self.times = times[order]
+        self.spot = np.asarray(nifty["close"], dtype=float)[order]
+
+        # Bars are matched to NIFTY minutes through a table over the whole
+        # span, which is much faster than searching for millions of bars
+        offsets = (minutes(options["timestamp"]) - self.times[0]).astype(np.int64)
+        position = np.full(int((self.times[-1] - self.times[0]).astype(int)) + 1, -1)
+        position[(self.times - self.times[0]).astype(np.int64)] = np.arange(
+            len(self.times)
+        )
+        inside = (offsets >= 0) & (offsets < len(position))
+        index = np.where(inside, position[np.where(inside, offsets, 0)], -1)
+        del offsets
+        expiries = np.asarray(options["expiry"]).astype("datetime64[D]", copy=False)
+        strikes = np.asarray(options["strike"]).astype(float, copy=False)
+        strikes = strikes.astype(np.int32)
+        sides = (np.asarray(options["option_type"]) != "CE").astype(np.int8)
+        closes = np.asarray(options["close"], dtype=float)
+        # Option bars without a NIFTY bar at the same minute are dropped
+        known = index >= 0
+        if not known.all():
+            expiries, strikes = expiries[known], strikes[known]
+            sides, closes, index = sides[known], closes[known], index[known]
+
+        expiry_values, expiry_index = factorize(expiries)
+        strike_values, strike_index = factorize(strikes)
+        self.contracts: Dict[np.datetime64, Contract] = dict()
+        for number, expiry in enumerate(expiry_values):
+            rows = np.flatnonzero(expiry_index == number)
+            columns = strike_index[rows]
+            traded = np.bincount(columns, minlength=len(strike_values)) > 0
+            column_of = np.cumsum(traded) - 1
+            first, last = index[rows].min(), index[rows].max()
+            contract_closes = np.full((last - first + 1, traded.sum(), 2), np.nan)
+            contract_closes[index[rows] - first, column_of[columns], sides[rows]] = (
+                closes[rows]
+            )
+            self.contracts[expiry] = Contract(
+                first, last, strike_values[traded], forward_fill(contract_closes)
+            )
+        self.expiries = np.array(sorted(self.contracts))
+        # Like in `expiry.py`, the last expiry of a month is its monthly
+        # contract, holidays already moved it in the data
+        months = self.expiries.astype("datetime64[M]")
+        self.monthly = self.expiries[np.append(months[1:] != months[:-1], True)]
+
+    def entries(self, weekday: str, at: time) -> np.ndarray:
+        """Return the indices of the minutes at which an iron fly is entered"""
+        days = self.times.astype("datetime64[D]")
+        # 1970-01-01 was a Thursday
+        weekdays = (days.astype(int) + 3) % 7
+        clock = (self.times - days).astype(int)
+        return np.flatnonzero(
+            (weekdays == WEEKDAYS.index(weekday)) & (clock == at.hour * 60 + at.minute)
+        )
+
+    def contract(self, entry: int, series: str = MONTHLY) -> Contract | None:
+        """Return the contract traded at the entry, the first of the series after it"""
+        day = self.times[entry].astype("datetime64[D]")
+        expiries = self.monthly if series == MONTHLY else self.expiries
+        later = expiries[expiries > day]
+        if not len(later):
+            return None
+        contract = self.contracts[later[0]]
+        return contract if contract.first <= entry < contract.last else None
+
+
+def factorize(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the distinct values and the position of every value among them.
+
+    Strikes and expiries span a small range, so a table over that range does
+    what `np.unique` would need a sort of every bar for.
+    """
+    numbers = values.view(np.int64) if values.dtype.kind == "M" else values
+    low = numbers.min()
+    offsets = numbers - low
+    present = np.zeros(int(numbers.max() - low) + 1, dtype=bool)
+    present[offsets] = True
+    distinct = (np.flatnonzero(present) + low).astype(numbers.dtype)
+    if values.dtype.kind == "M":
+        distinct = distinct.view(values.dtype)
+    return distinct, (np.cumsum(present) - 1)[offsets]
+
+
+def forward_fill(closes: np.ndarray) -> np.ndarray:
+    """Carry the last close forward over the minutes a contract did not trade"""
+    seen = np.where(~np.isnan(closes), np.arange(len(closes))[:, None, None], 0)
+    return np.take_along_axis(closes, np.maximum.accumulate(seen, axis=0), axis=0)
+
+
+def first(mask: np.ndarray, default: np.ndarray) -> np.ndarray:
+    """Return the index of the first True along the last axis, or the default"""
+    return np.where(mask.any(axis=-1), mask.argmax(axis=-1), default)
+
+
+def backtest(
+    history: History,
+    sl_multiples: np.ndarray,
+    adjustment_factors: np.ndarray,
+    wing_factors: np.ndarray,
+    weekday: str = "thursday",
+    at: time = time(15, 10),
+    series: str = MONTHLY,
+) -> Dict[str, np.ndarray]:
+    """Return the P&L in points of every entry (rows) and parameter set (columns)"""
+    sl_multiples = np.asarray(sl_multiples, dtype=float)
+    adjustment_factors = np.asarray(adjustment_factors, dtype=float)
+    wing_factors = np.asarray(wing_factors, dtype=float)
+
+    entries, contracts = list(), list()
+    for entry in history.entries(weekday, at):
+        contract = history.contract(entry, series)
+        if contract is not None:
+            entries.append(entry)
+            contracts.append(contract)
+    entries = np.array(entries, dtype=int)
+    weeks, sets = len(entries), len(sl_multiples)
+    window = max((c.last - e for c, e in zip(contracts, entries)), default=0)
+    # The minute after the entry is column 0; every week is padded with NaN
+    # up to the longest holding window
+    nifty = np.full((weeks, window), np.nan)
+    sell_ce, sell_pe = np.full((weeks, window), np.nan), np.full(
+        (weeks, window), np.nan
+    )
+    buy_ce, buy_pe = np.full((weeks, sets, window), np.nan), np.full(
+        (weeks, sets, window), np.nan
+    )
+    entry_prices = np.full((weeks, sets, 4), np.nan)
+    strikes = nearest_price(history.spot[entries]) if weeks else np.zeros(0, int)
+    final = np.zeros(weeks, dtype=int)
+
+    # Gathering the legs is the only per week work
+    for week, (entry, contract) in enumerate(zip(entries, contracts)):
+        rows = slice(entry - contract.first, None)
+        closes = contract.closes[rows]
+        held = len(closes) - 1
+        final[week] = held - 1
+        nifty[week, :held] = history.spot[entry + 1 : contract.last + 1]
+
+        def leg(strike, side: int) -> np.ndarray:
+            column = np.searchsorted(contract.strikes, strike)
+            column = np.minimum(column, len(contract.strikes) - 1)
+            series = closes[:, column, side].T
+            return np.where(
+                (contract.strikes[column] == strike)[..., None], series, np.nan
+            )
+
+        sell_ce_series = leg(strikes[week], CE)
+        sell_pe_series = leg(strikes[week], PE)
+        sell_ce[week, :held], sell_pe[week, :held] = (
+            sell_ce_series[1:],
+            sell_pe_series[1:],
+        )
+        premium = sell_ce_series[0] + sell_pe_series[0]
+        if np.isnan(premium):
+            continue
+        buy_ce_strikes, buy_pe_strikes = wing_strikes(
+            strikes[week], premium, wing_factors
+        )
+        buy_ce_series, buy_pe_series = leg(buy_ce_strikes, CE), leg(buy_pe_strikes, PE)
+        buy_ce[week, :, :held], buy_pe[week, :, :held] = (
+            buy_ce_series[:, 1:],
+            buy_pe_series[:, 1:],
+        )
+        entry_prices[week] = np.stack(
+            (
+                np.full(sets, sell_ce_series[0]),
+                np.full(sets, sell_pe_series[0]),
+                buy_ce_series[:, 0],
+                buy_pe_series[:, 0],
+            ),
+            axis=-1,
+        )
+
+    sell_ce_price, sell_pe_price, buy_ce_price, buy_pe_price = np.moveaxis(
+        entry_prices, -1, 0
+    )
+    levels = exit_levels(
+        strikes[:, None],
+        sell_ce_price,
+        sell_pe_price,
+        buy_ce_price,
+        buy_pe_price,
+        sl_multiple=sl_multiples,
+        adjustment_factor=adjustment_factors,
+    )
+    end = final[:, None]
+    with np.errstate(invalid="ignore"):
+        ce_hit = stoploss_hit(sell_ce[:, None, :], levels.high_sl[..., None])
+        pe_hit = stoploss_hit(sell_pe[:, None, :], levels.low_sl[..., None])
+        adj_hit = adjustment_hit(
+            nifty[:, None, :], levels.high_adj[..., None], levels.low_adj[..., None]
+        )
+    ce_stop = first(ce_hit, end)
+    # Both stoplosses are checked with an elif, so the put side cannot exit on
+    # the same check as the call side
+    pe_hit &= ~(
+        ce_hit.any(axis=-1)[..., None] & (np.arange(window) == ce_stop[..., None])
+    )
+    pe_stop = first(pe_hit, end)
+    adjusted = first(adj_hit, end)
+    ce_exit, pe_exit = np.minimum(ce_stop, adjusted), np.minimum(pe_stop, adjusted)
+
+    def at_exit(series: np.ndarray, exit: np.ndarray) -> np.ndarray:
+        if series.ndim == 2:
+            series = np.broadcast_to(series[:, None, :], (weeks, sets, window))
+        return np.take_along_axis(series, exit[..., None], axis=-1)[..., 0]
+
+    pnl = (
+        sell_ce_price
+        - at_exit(sell_ce, ce_exit)
+        + at_exit(buy_ce, ce_exit)
+        - buy_ce_price
+        + sell_pe_price
+        - at_exit(sell_pe, pe_exit)
+        + at_exit(buy_pe, pe_exit)
+        - buy_pe_price
+    )
+
+    # An iron fly is open from its entry until the adjustment closes it or
+    # its contract expires, and blocks new entries near its strike meanwhile
+    valid = ~np.isnan(pnl)
+    closed = np.where(adj_hit.any(axis=-1), adjusted, end) + entries[:, None] + 1
+    taken = np.zeros((weeks, sets), dtype=bool)
+    for week in range(weeks):
+        blocked = (
+            taken[:week]
+            & (closed[:week] > entries[week])
+            & blocks_redeploy(strikes[week], strikes[:week])[:, None]
+        ).any(axis=0)
+        taken[week] = valid[week] & ~blocked
+    return {
+        "entries": history.times[entries],
+        "strikes": strikes,
+        "taken": taken,
+        "pnl": np.where(taken, pnl, 0.0),
+    }
+
+
+def summary(result: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Return the trades, P&L, win rate and max drawdown of every parameter set"""
+    taken, pnl = result["taken"], result["pnl"]
+    trades = taken.sum(axis=0)
+    equity = np.cumsum(pnl, axis=0)
+    drawdown = (np.maximum.accumulate(equity, axis=0) - equity).max(axis=0, initial=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return {
+            "trades": trades,
+            "pnl": pnl.sum(axis=0),
+            "average": pnl.sum(axis=0) / trades,
+            "win_rate": ((pnl > 0) & taken).sum(axis=0) / trades,
+            "worst": np.where(taken, pnl, np.inf).min(axis=0, initial=np.inf),
+            "max_drawdown": drawdown,
+        }
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nifty", type=Path, required=True)
+    parser.add_argument("--options", type=Path, required=True)
+    parser.add_argument("--sl", type=float, nargs="+", default=[SL_MULTIPLE])
+    parser.add_argument(
+        "--adjustment", type=float, nargs="+", default=[ADJUSTMENT_FACTOR]
+    )
+    parser.add_argument("--wing", type=float, nargs="+", default=[WING_FACTOR])
+    parser.add_argument("--weekday", choices=WEEKDAYS, default="thursday")
+    parser.add_argument("--at", type=time.fromisoformat, default=time(15, 10))
+    parser.add_argument("--series", choices=(MONTHLY, WEEKLY), default=MONTHLY)
+    arguments = parser.parse_args()
+
+    start = perf_counter()
+    history = History(read_table(arguments.nifty), read_table(arguments.options))
+    loaded = perf_counter()
+    grid: List[tuple] = list(
+        product(arguments.sl, arguments.adjustment, arguments.wing)
+    )
+    sl_multiples, adjustment_factors, wing_factors = map(np.array, zip(*grid))
+    result = backtest(
+        history,
+        sl_multiples,
+        adjustment_factors,
+        wing_factors,
+        arguments.weekday,
+        arguments.at,
+        arguments.series,
+    )
+    stats = summary(result)
+    done = perf_counter()
+
+    print(
+        f"{'sl':>5} {'adj':>5} {'wing':>5} {'trades':>6} {'pnl':>9} {'avg':>8}", end=""
+    )
+    print(f" {'win':>5} {'worst':>8} {'max dd':>8}")
+    for index in np.argsort(-stats["pnl"]):
+        sl, adjustment, wing = grid[index]
+        print(
+            f"{sl:>5.2f} {adjustment:>5.2f} {wing:>5.2f} {stats['trades'][index]:>6} "
+            f"{stats['pnl'][index]:>9.1f} {stats['average'][index]:>8.1f} "
+            f"{stats['win_rate'][index]:>5.0%} {stats['worst'][index]:>8.1f} "
+            f"{stats['max_drawdown'][index]:>8.1f}"
+        )
+    print(
+        f"{len(result['entries'])} entries x {len(grid)} parameter sets, "
+        f"loaded in {loaded - start:.2f}s, evaluated in {done - loaded:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""Offline benchmark of the trading jobs against the local Upstox stand-in.
+
+    uv run app/benchmark.py --clients 1 10 100 1000 --latency 0.02
+
+For every client count the benchmark creates that many synthetic clients and
+runs a full trading cycle (iron_fly, update_order_status, one poll of the
+order chaser, update_order_status once the sells have filled and a poll of
+the market bus, which runs check_sl_and_adj) a few times against
+`mock_upstox.py`. It reports the p50/p99 wall time and the requests sent per
+job. Every run is appended to `benchmarks/results.jsonl` and compared with
+the last run made with the same settings.
+
+The synthetic clients and their rows are written to the configured database,
+so point the DATABASE_* settings at a scratch database. The benchmark refuses
+to run against a database that has any other clients in it.
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+from argparse import ArgumentParser, Namespace
+from datetime import datetime
+from pathlib import Path
+from statistics import mean, quantiles
+from time import perf_counter, sleep
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS = ROOT / "benchmarks" / "results.jsonl"
+PREFIX = "BENCH"
+STRIKES = range(15000, 35000, 50)
+REGRESSION = 0.2
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_mock(arguments: Namespace, port: int) -> subprocess.Popen:
+    mock = subprocess.Popen(
+        [
+            sys.executable,
+            str(Path(__file__).with_name("mock_upstox.py")),
+            "--port",
+            str(port),
+            "--latency",
+            str(arguments.latency),
+            "--jitter",
+            str(arguments.jitter),
+            "--error-rate",
+            str(arguments.error_rate),
+        ]
+    )
+    for _ in range(100):
+        try:
+            httpx.get(f"http://127.0.0.1:{port}/stats")
+            return mock
+        except httpx.TransportError:
+            sleep(0.1)
+    mock.terminate()
+    raise Exception("The mock Upstox server did not start!")
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if len(samples) == 1:
+        return {"p50": samples[0], "p99": samples[0]}
+    cuts = quantiles(samples, n=100, method="inclusive")
+    return {"p50": cuts[49], "p99": cuts[98]}
+
+
+def commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(arguments: Namespace, mock_url: str) -> List[dict]:
+    # The settings are read once on import, so the app is only imported after
+    # the broker has been pointed at the mock
+    from config import IRON_FLY, NIFTY
+    from database import session_scope
+    from instruments import instruments
+    from logger import logger
+    from bus import bus
+    from chase import chaser
+    from iron_fly import IronFlyStrategy, iron_fly, update_order_status
+    from live import publisher
+    from mock_upstox import NIFTY_KEY
+    from models import ClientStrategy, Credentials, IronFly, LiveState
+    from risk import risk
+    from registry import clients
+    from sqlmodel import col, delete, func, select
+    from utils import get_symbol, ltp_cache, quote_cache
+
+    # Keep the synthetic runs out of the log files and Betterstack
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    with session_scope() as database:
+        others = database.exec(
+            select(func.count())
+            .select_from(Credentials)
+            .where(col(Credentials.client_id).notlike(f"{PREFIX}%"))
+        ).one()
+    if others:
+        raise Exception("The benchmark needs a database without real clients!")
+
+    grid = [(NIFTY, NIFTY_KEY)]
+    for strike in STRIKES:
+        for option in ("CE", "PE"):
+            symbol = get_symbol(strike, option)
+            grid.append((symbol, f"NSE_FO|{symbol}"))
+    instruments.use(grid)
+
+    def cleanup() -> None:
+        with session_scope() as database:
+            for model in (IronFly, ClientStrategy, LiveState, Credentials):
+                database.exec(
+                    delete(model).where(col(model.client_id).like(f"{PREFIX}%"))
+                )
+
+    # The subscribers of the trading app, the benchmark polls the bus itself
+    bus.subscribe(IronFlyStrategy())
+    bus.subscribe(risk)
+    bus.subscribe(publisher)
+    steps = (
+        ("iron_fly", iron_fly, True),
+        ("update_order_status", update_order_status, False),
+        ("chase", chaser.poll, False),
+        ("update_order_status:filled", update_order_status, False),
+        ("check_sl_and_adj", bus.poll, False),
+    )
+    results = list()
+    for count in arguments.clients:
+        cleanup()
+        with session_scope() as database:
+            for number in range(count):
+                client_id = f"{PREFIX}{number:04d}"
+                database.add(
+                    Credentials(
+                        client_id=client_id,
+                        is_active=1,
+                        api_key="",
+                        api_secret="",
+                        access_token=f"{client_id}-token",
+                    )
+                )
+            # The strategies reference the credentials
+            database.flush()
+            for number in range(count):
+                database.add(
+                    ClientStrategy(
+                        client_id=f"{PREFIX}{number:04d}", strategy=IRON_FLY, lots=1
+                    )
+                )
+        clients.load()
+
+        samples = {name: list() for name, _, _ in steps}
+        requests = {name: list() for name, _, _ in steps}
+        failures = {name: 0 for name, _, _ in steps}
+        for _ in range(arguments.repeat):
+            with session_scope() as database:
+                database.exec(
+                    delete(IronFly).where(col(IronFly.client_id).like(f"{PREFIX}%"))
+                )
+            httpx.post(f"{mock_url}/reset")
+            chaser.refresh()
+            namespace = SimpleNamespace()
+            for name, job, takes_namespace in steps:
+                ltp_cache.clear()
+                quote_cache.clear()
+                before = sum(httpx.get(f"{mock_url}/stats").json()["requests"].values())
+                start = perf_counter()
+                try:
+                    job(namespace) if takes_namespace else job()
+                except Exception as error:
+                    failures[name] += 1
+                    print(f"{name} failed with {count} clients: {error!r}")
+                samples[name].append(perf_counter() - start)
+                after = sum(httpx.get(f"{mock_url}/stats").json()["requests"].values())
+                requests[name].append(after - before)
+
+        for name, _, _ in steps:
+            results.append(
+                {
+                    "clients": count,
+                    "job": name,
+                    "repeat": arguments.repeat,
+                    "wall_mean": mean(samples[name]),
+                    **{
+                        f"wall_{cut}": value
+                        for cut, value in percentiles(samples[name]).items()
+                    },
+                    "requests": mean(requests[name]),
+                    "failures": failures[name],
+                }
+            )
+    cleanup()
+    return results
+
+
+def previous(history: List[dict], result: dict) -> Optional[dict]:
+    """Return the last stored result that measured the same thing"""
+    same = ("clients", "job", "latency", "jitter", "error_rate")
+    for line in reversed(history):
+        if all(line.get(key) == result[key] for key in same):
+            return line
+    return None
+
+
+def report(results: List[dict]) -> None:
+    history = list()
+    if RESULTS.exists():
+        history = [json.loads(line) for line in RESULTS.read_text().splitlines()]
+    header = f"{'clients':>7} {'job':<28} {'p50 ms':>9} {'p99 ms':>9} {'requests':>9}"
+    print(header + f" {'fails':>5}  vs last")
+    for result in results:
+        line = (
+            f"{result['clients']:>7} {result['job']:<28} "
+            f"{result['wall_p50'] * 1000:>9.1f} {result['wall_p99'] * 1000:>9.1f} "
+            f"{result['requests']:>9.0f} {result['failures']:>5}"
+        )
+        last = previous(history, result)
+        if last is not None and last["wall_p50"]:
+            change = result["wall_p50"] / last["wall_p50"] - 1
+            flag = "  REGRESSION" if change > REGRESSION else ""
+            line += f"  {change:+.0%} ({last['commit']}){flag}"
+        print(line)
+    RESULTS.parent.mkdir(exist_ok=True)
+    with RESULTS.open("a") as results_file:
+        for result in results:
+            results_file.write(json.dumps(result) + "\n")
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    arguments = parser.parse_args()
+
+    port = free_port()
+    mock_url = f"http://127.0.0.1:{port}"
+    os.environ["UPSTOX_API_URL"] = os.environ["UPSTOX_HFT_URL"] = mock_url
+    mock = start_mock(arguments, port)
+    try:
+        results = run(arguments, mock_url)
+    finally:
+        mock.terminate()
+    stamp = {
+        "run": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit(),
+        "latency": arguments.latency,
+        "jitter": arguments.jitter,
+        "error_rate": arguments.error_rate,
+    }
+    report([{**stamp, **result} for result in results])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+from atexit import register as at_exit
+from importlib.util import find_spec
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Optional
+
+from config import get_settings
+from enums import Priority
+from httpx import Client as HttpClient
+from httpx import Limits, Response, Timeout, TransportError
+from logger import logger as log
+from metrics import (
+    register_stats,
+    upstox_errors,
+    upstox_latency,
+    upstox_retries,
+    upstox_throttled,
+)
+from ratelimit import ORDER, QUOTE, READ, scheduler
+
+API = "api"
+HFT = "hft"
+
+# Metric label of every Upstox path we call
+ENDPOINTS = {
+    "/market-quote/ltp": "ltp",
+    "/market-quote/quotes": "quotes",
+    "/order/multi/place": "order_place",
+    "/order/modify": "order_modify",
+    "/order/retrieve-all": "order_retrieve",
+}
+# Rate limit class of every endpoint, the others count as reads
+CLASSES = {
+    "ltp": QUOTE,
+    "quotes": QUOTE,
+    "order_place": ORDER,
+    "order_modify": ORDER,
+}
+# Lane of every endpoint unless the caller picks one, e.g. exits
+LANES = {"order_place": Priority.ENTRY, "order_modify": Priority.MODIFY}
+
+
+class Broker:
+    """Long-lived transport shared by every Upstox call.
+
+    One keep-alive connection pool is kept per Upstox host so that quotes and
+    orders reuse warm TCP+TLS connections instead of handshaking every time.
+    """
+
+    def __init__(self) -> None:
+        settings = get_settings()
+        http2 = settings.broker_http2 and find_spec("h2") is not None
+        if settings.broker_http2 and not http2:
+            log.warning("HTTP/2 requested but `h2` is not installed, using HTTP/1.1")
+        limits = Limits(
+            max_connections=settings.broker_max_connections,
+            max_keepalive_connections=settings.broker_max_keepalive_connections,
+            keepalive_expiry=settings.broker_keepalive_expiry,
+        )
+        timeout = Timeout(
+            settings.broker_read_timeout, connect=settings.broker_connect_timeout
+        )
+        self._clients: Dict[str, HttpClient] = {
+            host: HttpClient(
+                base_url=base_url,
+                http2=http2,
+                limits=limits,
+                timeout=timeout,
+                headers={"Accept": "application/json"},
+            )
+            for host, base_url in (
+                (API, settings.upstox_api_url),
+                (HFT, settings.upstox_hft_url),
+            )
+        }
+        self.retries = settings.broker_retries
+        self._lock = Lock()
+        self._stats = {
+            host: {"requests": 0, "connections": 0} for host in self._clients
+        }
+
+    def _tracer(self, host: str):
+        def trace(event: str, _: dict) -> None:
+            if event == "connection.connect_tcp.complete":
+                with self._lock:
+                    self._stats[host]["connections"] += 1
+
+        return trace
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        access_token: str,
+        host: str = API,
+        headers: Optional[dict] = None,
+        priority: Optional[Priority] = None,
+        **kwargs,
+    ) -> Response:
+        """Send a request to Upstox over the pooled connection of the given host.
+
+        The request first waits for its turn under the rate limits of the
+        access token, in the lane of `priority`.
+        """
+        endpoint = ENDPOINTS.get(path, path)
+        kind = CLASSES.get(endpoint, READ)
+        lane = priority if priority is not None else LANES.get(endpoint, Priority.POLL)
+        sent = 0.0
+        for attempt in range(1 + self.retries):
+            scheduler.acquire(access_token, kind, lane)
+            with self._lock:
+                self._stats[host]["requests"] += 1
+            start = perf_counter()
+            try:
+                response = self._clients[host].request(
+                    method,
+                    path,
+                    headers={
+                        "Authorization": f"Bearer {access_token}",
+                        **(headers or {}),
+                    },
+                    extensions={"trace": self._tracer(host)},
+                    **kwargs,
+                )
+            except TransportError as error:
+                sent += perf_counter() - start
+                # Only reads are sent again, an order could be placed twice
+                if method != "GET" or attempt == self.retries:
+                    upstox_latency.labels(endpoint).observe(sent)
+                    upstox_errors.labels(endpoint, type(error).__name__).inc()
+                    raise
+                upstox_retries.labels(endpoint).inc()
+                continue
+            sent += perf_counter() - start
+            scheduler.adapt(access_token, kind, response.status_code, response.headers)
+            # A 429 was rejected before it was acted on, so even orders are
+            # sent again once the paused bucket lets them through
+            if response.status_code == 429:
+                upstox_throttled.labels(endpoint).inc()
+                if attempt < self.retries:
+                    upstox_retries.labels(endpoint).inc()
+                    continue
+            break
+        upstox_latency.labels(endpoint).observe(sent)
+        if response.is_error:
+            upstox_errors.labels(endpoint, str(response.status_code)).inc()
+        return response
+
+    def get(self, path: str, access_token: str, **kwargs) -> Response:
+        return self.request("GET", path, access_token, **kwargs)
+
+    def post(self, path: str, access_token: str, **kwargs) -> Response:
+        return self.request("POST", path, access_token, **kwargs)
+
+    def put(self, path: str, access_token: str, **kwargs) -> Response:
+        return self.request("PUT", path, access_token, **kwargs)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Return the request and connection counts along with the reuse ratio"""
+        with self._lock:
+            stats = {host: dict(counts) for host, counts in self._stats.items()}
+        for counts in stats.values():
+            requests = counts["requests"]
+            counts["reuse_ratio"] = (
+                1 - counts["connections"] / requests if requests else 0.0
+            )
+        return stats
+
+    def close(self) -> None:
+        log.info("Closing broker connections", stats=self.stats())
+        for client in self._clients.values():
+            client.close()
+
+
+broker = Broker()
+register_stats("broker", broker.stats, "host")
+at_exit(broker.close)
@@ -0,0 +1,289 @@
+"""One stream of quotes and order updates shared by every strategy.
+
+Every subscriber, a strategy or the risk engine, says which symbols it needs
+through `instruments`. The bus asks all of them and gets the LTPs of the union
+once: in one batch every minute, or over the market data feed as they change
+when `MARKET_FEED_ENABLED` is set. It then calls the subscribers back with
+
+    on_quotes(ltps)       the latest LTP of every symbol, once a minute
+    on_tick(symbol, ltp)  every streamed tick of a symbol the subscriber needs
+    on_order(update)      every leg whose order changed status
+    on_rows(client_ids)   the clients whose rows were exited or adjusted here
+
+so a second strategy or underlying adds symbols to the same request instead
+of requests of its own. Order updates come from the reconciliation in this
+process and, through the `orders` channel, from the postbacks the API gets.
+
+With several workers, each one still asks its own subscribers, but only the
+leader fetches, the symbols of every worker in one batch. The others get
+their LTPs from what the leader shares, and only fetch the few symbols they
+started needing since they last told the leader. A worker that has not seen
+shared LTPs for `SHARED_QUOTES_TIMEOUT` fetches all of its own again. Without
+the feed, an LTP older than `SHARD_QUOTE_MAX_AGE`, about one poll, is not
+handed out at all, so the stoplosses are never checked against stale prices.
+"""
+
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Set
+
+from config import get_settings
+from feed import MarketFeed
+from instruments import instruments
+from logger import logger as log
+from metrics import register_stats
+from orders import CHANNEL, OrderUpdate
+from registry import clients
+from shard import shards
+from ticks import recorder
+from utils import get_access_token, get_clients, get_ltps
+
+# Over two polls without LTPs from the leader
+SHARED_QUOTES_TIMEOUT = 150.0
+
+
+class Subscriber:
+    """What the bus calls back, every callback does nothing unless overridden"""
+
+    def instruments(self) -> Set[str]:
+        """Return the symbols whose LTPs are needed right now"""
+        return set()
+
+    def on_quotes(self, ltps: Dict[str, float]) -> None:
+        pass
+
+    def on_tick(self, symbol: str, ltp: float) -> None:
+        pass
+
+    def on_order(self, update: OrderUpdate) -> None:
+        pass
+
+    def on_rows(self, client_ids: Set[str]) -> None:
+        pass
+
+
+class MarketBus:
+    def __init__(self, feed_enabled: bool, refresh_interval: float) -> None:
+        self.refresh_interval = refresh_interval
+        self._lock = Lock()
+        self._refresh_lock = Lock()
+        self._subscribers: List[Subscriber] = list()
+        # The symbols every subscriber asked for last, and who asked by symbol
+        self._needs: Dict[Subscriber, Set[str]] = dict()
+        self._by_symbol: Dict[str, List[Subscriber]] = dict()
+        self.ltps: Dict[str, float] = dict()
+        # When every polled LTP was fetched, on the monotonic clock
+        self._quoted_at: Dict[str, float] = dict()
+        self.feed = (
+            MarketFeed(
+                access_token=lambda: get_access_token(get_clients()[0]),
+                on_tick=self.on_tick,
+            )
+            if feed_enabled
+            else None
+        )
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        # Shared LTPs are handed out one snapshot at a time, like a job
+        self._deliveries = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bus")
+        self._shared_at = monotonic()
+        self._stats = Counter()
+
+    def subscribe(self, subscriber: Subscriber) -> None:
+        with self._lock:
+            self._subscribers.append(subscriber)
+
+    def start(self) -> None:
+        """Follow the order updates and shared LTPs, before `clients.start`"""
+        clients.listen(CHANNEL, self._on_notify, self._resync)
+        shards.on("quotes", self._on_shared_quotes)
+        shards.on("rebalance", lambda _: self.refresh_soon())
+        self._shared_at = monotonic()
+
+    def _deliver(self, callback: Callable, *args) -> None:
+        try:
+            callback(*args)
+        except Exception:
+            self._stats["errors"] += 1
+            log.exception("Subscriber failed", callback=callback.__qualname__)
+
+    def refresh(self) -> Set[str]:
+        """Ask every subscriber for its symbols and return all of them"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        with self._refresh_lock:
+            for subscriber in subscribers:
+                try:
+                    self._needs[subscriber] = set(subscriber.instruments())
+                except Exception:
+                    # The subscriber keeps getting the symbols it needed before
+                    log.exception(
+                        "Could not refresh the instruments of a subscriber",
+                        subscriber=type(subscriber).__name__,
+                    )
+            by_symbol: Dict[str, List[Subscriber]] = dict()
+            for subscriber, symbols in self._needs.items():
+                for symbol in symbols:
+                    by_symbol.setdefault(symbol, list()).append(subscriber)
+        with self._lock:
+            self._by_symbol = by_symbol
+        return set(by_symbol)
+
+    def poll(self) -> None:
+        """Get the LTPs every subscriber needs in one batch and hand them out"""
+        symbols = self.refresh()
+        sharing = self.feed is None and shards.running
+        if sharing:
+            shards.demand(symbols)
+            if shards.leads():
+                symbols |= shards.demanded()
+            elif monotonic() - self._shared_at < SHARED_QUOTES_TIMEOUT:
+                return
+            else:
+                log.warning("No LTPs shared by the leader... Fetching them here...")
+        if not symbols:
+            log.info("No subscriber needs quotes... Skipping...")
+            return
+        # The feed already streams them
+        if self.feed is None:
+            ltps = get_ltps(symbols)
+            self._take(ltps)
+            if sharing and shards.leads():
+                shards.share(ltps)
+        log.info("Fetched LTPs for the subscribers", symbols=len(symbols))
+        self._stats["polls"] += 1
+        self._hand_out()
+
+    def _take(
+        self, ltps: Dict[str, float], ages: Optional[Dict[str, float]] = None
+    ) -> None:
+        """Keep the LTPs, fetched the given seconds ago or just now"""
+        now = monotonic()
+        self.ltps.update(ltps)
+        for symbol in ltps:
+            self._quoted_at[symbol] = now - (ages or {}).get(symbol, 0.0)
+
+    def _hand_out(self) -> None:
+        ltps = dict(self.ltps)
+        if self.feed is None:
+            oldest = monotonic() - shards.quote_max_age
+            stale = [
+                symbol
+                for symbol in ltps
+                if self._quoted_at.get(symbol, float("-inf")) < oldest
+            ]
+            for symbol in stale:
+                del ltps[symbol]
+            # Only the stale LTPs a subscriber still needs are worth counting
+            self._stats["stale_quotes"] += len(set(stale) & set(self._by_symbol))
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            self._deliver(subscriber.on_quotes, ltps)
+
+    def _on_shared_quotes(self, _: dict) -> None:
+        self._deliveries.submit(self._take_shared)
+
+    def _take_shared(self) -> None:
+        """Hand out the LTPs the leader shared, fetching only what it missed"""
+        with self._lock:
+            symbols = set(self._by_symbol)
+        if not symbols:
+            return
+        try:
+            shared = shards.shared(symbols)
+            missing = symbols - shared.keys()
+            # Needed since this worker last told the leader
+            fetched = get_ltps(missing) if missing else dict()
+        except Exception:
+            log.exception("Could not take the shared LTPs")
+            return
+        self._take(
+            {symbol: ltp for symbol, (ltp, _) in shared.items()},
+            {symbol: age for symbol, (_, age) in shared.items()},
+        )
+        self._take(fetched)
+        self._shared_at = monotonic()
+        self._stats["shared"] += 1
+        self._stats["shared_missing"] += len(missing)
+        self._hand_out()
+
+    def on_tick(self, instrument_key: str, ltp: float) -> None:
+        recorder.record(instrument_key, ltp)
+        symbol = instruments.symbol(instrument_key)
+        self.ltps[symbol] = ltp
+        self._stats["ticks"] += 1
+        for subscriber in self._by_symbol.get(symbol, ()):
+            self._deliver(subscriber.on_tick, symbol, ltp)
+
+    def publish_order(self, update: OrderUpdate) -> None:
+        self._stats["orders"] += 1
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            self._deliver(subscriber.on_order, update)
+        # A filled or exited leg changes what the subscribers need
+        self.refresh_soon()
+
+    def publish_rows(self, client_ids: Set[str]) -> None:
+        """Tell the subscribers that rows changed without any order update"""
+        self._stats["rows"] += 1
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            self._deliver(subscriber.on_rows, set(client_ids))
+        # An exited leg is no longer needed
+        self.refresh_soon()
+
+    def _on_notify(self, payload: str) -> None:
+        try:
+            update = OrderUpdate.parse(payload)
+        except Exception:
+            log.exception("Invalid order update", payload=payload)
+            return
+        self.publish_order(update)
+
+    def _resync(self) -> None:
+        # Order updates may have been missed, every client's rows may have moved
+        self.publish_rows(set(clients.client_ids()))
+
+    def refresh_soon(self) -> None:
+        """Refresh the feed subscriptions now rather than at the next interval"""
+        if self._loop is not None and self._wake is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def _refresh_subscriptions(self) -> None:
+        while True:
+            self._wake.clear()
+            try:
+                symbols = await asyncio.to_thread(self.refresh)
+                await self.feed.set_subscriptions(
+                    instruments.key(symbol) for symbol in symbols
+                )
+            except Exception:
+                log.exception("Error while refreshing feed subscriptions")
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run(self) -> None:
+        """Stream the ticks of the symbols the subscribers need"""
+        self._loop, self._wake = asyncio.get_running_loop(), asyncio.Event()
+        await asyncio.gather(self.feed.run(), self._refresh_subscriptions())
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                **self._stats,
+                "subscribers": len(self._subscribers),
+                "symbols": len(self._by_symbol),
+            }
+
+
+settings = get_settings()
+bus = MarketBus(settings.market_feed_enabled, settings.market_feed_refresh_interval)
+register_stats("market_bus", bus.stats)
@@ -0,0 +1,78 @@
+from concurrent.futures import Future
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Tuple
+
+
+class QuoteCache:
+    """Short lived cache of market data keyed by instrument.
+
+    Values are kept for `ttl` seconds. When several callers ask for the same
+    key while it is being fetched they all wait for that one in-flight fetch
+    instead of sending their own request.
+    """
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self._lock = Lock()
+        self._entries: Dict[Hashable, Tuple[float, Any]] = dict()
+        self._in_flight: Dict[Hashable, Future] = dict()
+        self.hits = self.misses = self.coalesced = 0
+
+    def get_many(
+        self,
+        keys: Iterable[Hashable],
+        fetch_many: Callable[[List[Hashable]], Dict[Hashable, Any]],
+    ) -> Dict[Hashable, Any]:
+        """Return the values of all the keys, fetching the expired ones at once"""
+        values: Dict[Hashable, Any] = dict()
+        waiting: Dict[Hashable, Future] = dict()
+        owned: Dict[Hashable, Future] = dict()
+        now = monotonic()
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    self.hits += 1
+                    values[key] = entry[1]
+                elif key in self._in_flight:
+                    self.coalesced += 1
+                    waiting[key] = self._in_flight[key]
+                else:
+                    self.misses += 1
+                    owned[key] = self._in_flight[key] = Future()
+        if owned:
+            try:
+                fetched = fetch_many(list(owned))
+            except Exception as error:
+                with self._lock:
+                    for key, future in owned.items():
+                        del self._in_flight[key]
+                        future.set_exception(error)
+                raise
+            expires_at = monotonic() + self.ttl
+            with self._lock:
+                for key, future in owned.items():
+                    value = fetched.get(key)
+                    # Failed lookups are not cached so the next caller retries
+                    if value is not None:
+                        self._entries[key] = (expires_at, value)
+                    del self._in_flight[key]
+                    future.set_result(value)
+                    values[key] = value
+        for key, future in waiting.items():
+            values[key] = future.result()
+        return values
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "size": len(self._entries),
+            }
@@ -0,0 +1,69 @@
+"""Option chain snapshot around the ATM strike.
+
+The entry needs the ATM and the wing quotes to be from the same moment. The
+snapshot takes the NIFTY LTP and then the quotes of every listed strike within
+`OPTION_CHAIN_WIDTH` points of the ATM in one batched request, so that the
+strikes and prices of the iron fly are all chosen from one consistent view.
+"""
+
+from typing import Dict, Optional, Tuple
+
+from config import get_settings
+from enums import Options
+from expiry import expiries
+from logger import logger as log
+from models import Quote
+from rules import STRIKE_STEP, TICK, nearest_price
+from utils import fetch_market_quotes, get_nifty_price, get_symbol
+
+
+class OptionChain:
+    """Quotes of the strikes around the ATM taken in a single request"""
+
+    def __init__(
+        self, spot: float, strike: int, quotes: Dict[Tuple[int, str], Quote]
+    ) -> None:
+        self.spot = spot
+        self.strike = strike
+        self.quotes = quotes
+
+    @classmethod
+    def snapshot(cls, width: Optional[int] = None) -> "OptionChain":
+        width = width if width is not None else get_settings().option_chain_width
+        spot = get_nifty_price()
+        strike = nearest_price(spot)
+        listed = expiries.series.symbols
+        symbols = {
+            get_symbol(chain_strike, option): (chain_strike, option)
+            for chain_strike in range(
+                strike - width, strike + width + STRIKE_STEP, STRIKE_STEP
+            )
+            for option in (Options.CALL, Options.PUT)
+            # Only ask for strikes that are listed, once the master is loaded
+            if not listed or (chain_strike, option) in listed
+        }
+        quotes = fetch_market_quotes(list(symbols))
+        log.info("Took option chain snapshot", spot=spot, quotes=len(quotes))
+        return cls(
+            spot,
+            strike,
+            {symbols[symbol]: quote for symbol, quote in quotes.items()},
+        )
+
+    def quote(self, strike: int, option: Options) -> Quote:
+        quote = self.quotes.get((strike, option))
+        if quote is None:
+            # Only a strike beyond the width costs a request of its own
+            log.warning("Strike outside the option chain", strike=strike)
+            symbol = get_symbol(strike, option)
+            quote = fetch_market_quotes([symbol])[symbol]
+            self.quotes[(strike, option)] = quote
+        return quote
+
+    def ask(self, strike: int, option: Options) -> float:
+        """Return the price to sell at, a tick inside the ask like `get_ask`"""
+        return self.quote(strike, option).ask - TICK
+
+    def bid(self, strike: int, option: Options) -> float:
+        """Return the price to buy at, a tick inside the bid like `get_bid`"""
+        return self.quote(strike, option).bid + TICK
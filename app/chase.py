@@ -0,0 +1,269 @@
+"""Chases the limit prices of the unfilled sell legs after the best ask.
+
+The sell legs go out as limit orders at the ask. Every working leg is kept in
+memory together with the price it was last sent at. The asks are polled
+every `CHASE_INTERVAL` seconds, and a leg is only re-priced when the ask has
+moved by at least one tick. A leg that has used up `CHASE_MAX_MODIFICATIONS`
+is converted to a market order the next time it would be re-priced.
+
+The totals are exported as `chase_*` gauges. How many modifications and how
+long every leg took are observed once its chase ends, when it fills, goes to
+market or leaves the database's unfilled legs, and logged with its prices.
+
+The market data feed only streams LTPs, so the asks come from the quotes
+endpoint through the quote cache.
+"""
+
+import asyncio
+from threading import Lock
+from time import monotonic
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from broker import HFT, broker
+from config import get_settings
+from database import session_scope
+from engine import engine
+from enums import OrderType
+from logger import logger as log
+from metrics import chase_modifications, chase_order_age, register_stats
+from models import IronFly
+from orders import FINISHED
+from rules import TICK
+from shard import shards
+from sqlmodel import col, or_, select
+from utils import get_access_token, get_quotes
+
+SELL_LEGS = ("sell_ce", "sell_pe")
+
+
+def to_tick(price: float) -> float:
+    return round(round(price / TICK) * TICK, 2)
+
+
+class WorkingOrder:
+    """A sell leg waiting to fill and what has been done to fill it"""
+
+    def __init__(
+        self,
+        row_id: str,
+        client_id: str,
+        leg: str,
+        order_id: str,
+        symbol: str,
+        price: Optional[float] = None,
+    ) -> None:
+        self.row_id = row_id
+        self.client_id = client_id
+        self.leg = leg
+        self.order_id = order_id
+        self.symbol = symbol
+        # The limit price the order was last sent at, unknown after a restart
+        self.price = price
+        self.ask: Optional[float] = None
+        self.modifications = 0
+        self.skipped = 0
+        self.failures = 0
+        self.tracked_at = monotonic()
+
+    def state(self) -> Dict[str, float]:
+        return {
+            "price": self.price if self.price is not None else float("nan"),
+            "ask": self.ask if self.ask is not None else float("nan"),
+            "modifications": self.modifications,
+            "skipped": self.skipped,
+            "failures": self.failures,
+            "age_seconds": monotonic() - self.tracked_at,
+        }
+
+
+class OrderChaser:
+    def __init__(self) -> None:
+        settings = get_settings()
+        self.interval = settings.chase_interval
+        self.max_modifications = settings.chase_max_modifications
+        self.refresh_interval = settings.chase_refresh_interval
+        self._lock = Lock()
+        self._orders: Dict[str, WorkingOrder] = dict()
+        # Orders sent at market, left alone until they show up as filled
+        self._converted: Set[str] = set()
+        self._refreshed: Optional[float] = None
+        self._stats = {"modified": 0, "skipped": 0, "market": 0, "failures": 0}
+
+    def track(self, row: IronFly, prices: Dict[str, float]) -> None:
+        """Start chasing the sell legs of a row placed at the given prices"""
+        with self._lock:
+            for leg in SELL_LEGS:
+                order_id = getattr(row, f"{leg}_order_id")
+                if order_id is not None and order_id not in self._orders:
+                    self._orders[order_id] = WorkingOrder(
+                        row.id,
+                        row.client_id,
+                        leg,
+                        order_id,
+                        getattr(row, f"{leg}_symbol"),
+                        prices.get(leg),
+                    )
+
+    def _ended(self, order: WorkingOrder, outcome: str) -> None:
+        """Observe how long and how many modifications the order took"""
+        state = order.state()
+        chase_modifications.labels(outcome).observe(order.modifications)
+        chase_order_age.labels(outcome).observe(state["age_seconds"])
+        log.info(
+            "Stopped chasing order",
+            order_id=order.order_id,
+            client=order.client_id,
+            outcome=outcome,
+            **state,
+        )
+
+    def finish(self, order_id: str, status: str) -> None:
+        """Stop chasing an order that has filled or been closed"""
+        with self._lock:
+            order = self._orders.pop(order_id, None)
+            self._converted.discard(order_id)
+        if order is not None:
+            self._ended(order, status)
+
+    def refresh(self) -> None:
+        """Chase exactly the sell legs the database still has as unfilled"""
+        with session_scope() as database:
+            # The statuses of new rows are only filled in by update_order_status
+            unfilled = [
+                or_(status.is_(None), status.notin_(FINISHED))
+                for status in (col(IronFly.sell_ce_status), col(IronFly.sell_pe_status))
+            ]
+            rows = database.exec(
+                select(IronFly)
+                .where(or_(*unfilled))
+                .where(shards.where(IronFly.client_id))
+            ).all()
+        working: Dict[str, WorkingOrder] = dict()
+        converted: Set[str] = set()
+        with self._lock:
+            for row in rows:
+                for leg in SELL_LEGS:
+                    order_id = getattr(row, f"{leg}_order_id")
+                    if order_id is None or getattr(row, f"{leg}_status") in FINISHED:
+                        continue
+                    if order_id in self._converted:
+                        converted.add(order_id)
+                        continue
+                    # Known orders keep their price and counters
+                    working[order_id] = self._orders.get(order_id) or WorkingOrder(
+                        row.id,
+                        row.client_id,
+                        leg,
+                        order_id,
+                        getattr(row, f"{leg}_symbol"),
+                    )
+            # Finished without an update reaching this worker
+            dropped = [
+                order
+                for order_id, order in self._orders.items()
+                if order_id not in working and order_id not in converted
+            ]
+            self._orders, self._converted = working, converted
+            self._refreshed = monotonic()
+        for order in dropped:
+            self._ended(order, "dropped")
+
+    def _reprice(
+        self, orders: Iterable[WorkingOrder]
+    ) -> List[Tuple[WorkingOrder, Optional[float]]]:
+        """Return the orders to modify with their new price, None for market"""
+        quotes = get_quotes({order.symbol for order in orders})
+        due = list()
+        for order in orders:
+            quote = quotes.get(order.symbol)
+            if quote is None:
+                log.warning("No quote found", symbol=order.symbol, row=order.row_id)
+                continue
+            order.ask = quote.ask
+            price = to_tick(quote.ask - TICK)
+            if order.price is not None and abs(price - order.price) < TICK / 2:
+                # The ask has not moved by a tick, the modify would change nothing
+                order.skipped += 1
+                with self._lock:
+                    self._stats["skipped"] += 1
+            elif order.modifications >= self.max_modifications:
+                due.append((order, None))
+            else:
+                due.append((order, price))
+        return due
+
+    def _modify(self, order_price: Tuple[WorkingOrder, Optional[float]]) -> None:
+        order, price = order_price
+        body = {
+            "validity": "DAY",
+            "price": price if price is not None else 0,
+            "order_id": order.order_id,
+            "order_type": OrderType.LIMIT if price is not None else OrderType.MARKET,
+            "trigger_price": 0,
+        }
+        response = broker.put(
+            "/order/modify", get_access_token(order.client_id), host=HFT, json=body
+        )
+        if response.is_error:
+            log.warning(
+                "Error while modifying order",
+                order_id=order.order_id,
+                client=order.client_id,
+                response=response.text,
+            )
+            order.failures += 1
+            with self._lock:
+                self._stats["failures"] += 1
+            return
+        if price is None:
+            with self._lock:
+                self._orders.pop(order.order_id, None)
+                self._converted.add(order.order_id)
+                self._stats["market"] += 1
+            self._ended(order, "market")
+            return
+        order.price = price
+        order.modifications += 1
+        with self._lock:
+            self._stats["modified"] += 1
+        log.debug(
+            "Modified order",
+            order_id=order.order_id,
+            client=order.client_id,
+            price=price,
+            modifications=order.modifications,
+        )
+
+    def poll(self) -> None:
+        """Re-price every working order whose ask has moved since the last poll"""
+        if (
+            self._refreshed is None
+            or monotonic() - self._refreshed >= self.refresh_interval
+        ):
+            self.refresh()
+        with self._lock:
+            orders = list(self._orders.values())
+        if not orders:
+            return
+        # Modifications of all the orders that need one go out at once
+        engine.map(self._modify, self._reprice(orders))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                **self._stats,
+                "working": len(self._orders),
+                "converted": len(self._converted),
+            }
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.poll)
+            except Exception:
+                log.exception("Error while chasing orders")
+            await asyncio.sleep(self.interval)
+
+
+chaser = OrderChaser()
+register_stats("chase", chaser.stats)
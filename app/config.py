@@ -1,4 +1,3 @@
-from datetime import date
 from functools import lru_cache
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
@@ -11,11 +10,85 @@ class Settings(BaseSettings):
     database_name: str
     database_username: str
     database_password: str
+    database_pool_size: int = 10
+    database_max_overflow: int = 10
+    database_pool_timeout: float = 10.0
+    database_pool_recycle: int = 1800
+    database_pool_pre_ping: bool = True
 
     login_url: str
     redirect_uri: str
 
     betterstack_source_token: str
+    betterstack_url: str = "https://in.logs.betterstack.com"
+
+    log_queue_size: int = 10000
+    log_batch_size: int = 500
+    log_flush_interval: float = 0.5
+    log_block_timeout: float = 0.05
+    log_rate_limit: float = 20.0
+
+    upstox_api_url: str = "https://api.upstox.com/v2"
+    upstox_hft_url: str = "https://api-hft.upstox.com/v2"
+    broker_http2: bool = False
+    broker_max_connections: int = 64
+    broker_max_keepalive_connections: int = 10
+    broker_keepalive_expiry: float = 60.0
+    broker_connect_timeout: float = 3.0
+    broker_read_timeout: float = 5.0
+    broker_retries: int = 1
+    order_rate_limit: float = 10.0
+    order_rate_burst: int = 10
+    quote_rate_limit: float = 25.0
+    quote_rate_burst: int = 25
+    read_rate_limit: float = 10.0
+    read_rate_burst: int = 10
+
+    instruments_url: str = (
+        "https://assets.upstox.com/market-quote/instruments/exchange/complete.csv.gz"
+    )
+    instrument_segments: str = "NSE_INDEX,NSE_FO"
+    instrument_batch_size: int = 5000
+    expiry_weekday: str = "thursday"
+    exchange_holidays: str = ""
+
+    quote_cache_ttl: float = 0.25
+    quote_batch_size: int = 500
+    option_chain_width: int = 1000
+    risk_free_rate: float = 0.065
+
+    tick_store_path: str = "ticks"
+    tick_store_capacity: int = 1048576
+
+    engine_job_workers: int = 8
+    engine_concurrency: int = 16
+    engine_burst_concurrency: int = 64
+    job_deadline: float = 55.0
+    deploy_deadline: float = 120.0
+
+    chase_interval: float = 0.5
+    chase_max_modifications: int = 10
+    chase_refresh_interval: float = 5.0
+
+    postback_secret: str = ""
+    order_reconcile_interval: int = 5
+
+    market_feed_enabled: bool = False
+    market_feed_url: str = "wss://api.upstox.com/v3/feed/market-data-feed"
+    market_feed_max_backoff: float = 30.0
+    market_feed_refresh_interval: float = 60.0
+
+    strategies: str = "iron_fly"
+
+    shard_enabled: bool = False
+    shard_heartbeat_interval: float = 5.0
+    shard_lease_timeout: float = 30.0
+    shard_vnodes: int = 64
+    shard_quote_max_age: float = 65.0
+
+    live_heartbeat_interval: float = 15.0
+
+    metrics_port: int = 9100
     model_config = SettingsConfigDict(env_file=".env", extra="ignore")
 
 
@@ -24,15 +97,11 @@ def get_settings():
     return Settings()
 
 
-today = date.today()
-day = today.day
-year = today.year
-month = today.month
-
 # Constants
 TRUE = YES = 1
 FALSE = NO = 0
 NIFTY = "NIFTY"
+IRON_FLY = "iron_fly"
 CE = "CE"
 PE = "PE"
 NOT_AVAILABLE = "N/A"
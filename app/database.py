@@ -1,6 +1,16 @@
+from collections import deque
+from contextlib import contextmanager
+from statistics import quantiles
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterator
+
 from config import get_settings
-from sqlmodel import Session, SQLModel, create_engine
+from metrics import register_stats
 from sqlalchemy import URL
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.pool import QueuePool
+from sqlmodel import Session, SQLModel, create_engine
 
 settings = get_settings()
 postgres_url = URL(
@@ -12,13 +22,89 @@ postgres_url = URL(
     password=settings.database_password,
     query={},
 )
-engine = create_engine(postgres_url, max_overflow=-1)
+# Batch executemany statements, such as the bulk row updates, into a few
+# round trips instead of one per row
+engine = create_engine(
+    postgres_url,
+    pool_size=settings.database_pool_size,
+    max_overflow=settings.database_max_overflow,
+    pool_timeout=settings.database_pool_timeout,
+    pool_recycle=settings.database_pool_recycle,
+    pool_pre_ping=settings.database_pool_pre_ping,
+    executemany_mode="values_plus_batch",
+)
 
 
-def create_db_and_tables() -> None:
-    SQLModel.metadata.create_all(engine)
+class PoolMetrics:
+    """Checkout latency and occupancy of the connection pool"""
+
+    def __init__(self, pool: QueuePool, samples: int = 1024) -> None:
+        self.pool = pool
+        self._lock = Lock()
+        self._latencies = deque(maxlen=samples)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.checkout_seconds = 0.0
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+            self.checkouts += 1
+            self.checkout_seconds += seconds
+
+    def timed_out(self) -> None:
+        with self._lock:
+            self.timeouts += 1
 
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            latencies = list(self._latencies)
+            stats = {"checkouts": self.checkouts, "timeouts": self.timeouts}
+        if len(latencies) > 1:
+            percentiles = quantiles(latencies, n=100, method="inclusive")
+            stats["checkout_p50_ms"] = round(percentiles[49] * 1000, 3)
+            stats["checkout_p99_ms"] = round(percentiles[98] * 1000, 3)
+        stats.update(
+            size=self.pool.size(),
+            in_use=self.pool.checkedout(),
+            idle=self.pool.checkedin(),
+            overflow=max(self.pool.overflow(), 0),
+        )
+        return stats
 
-def get_session() -> Session:
-    with Session(engine) as session:
-        return session
+
+pool_metrics = PoolMetrics(engine.pool)
+register_stats("database_pool", pool_metrics.stats)
+
+
+@contextmanager
+def session_scope() -> Iterator[Session]:
+    """A session for one unit of work.
+
+    The work is committed when the block exits, rolled back if it raises, and
+    the connection always goes back to the pool. Loaded objects stay readable
+    after the block since they are not expired on commit.
+    """
+    session = Session(engine, expire_on_commit=False)
+    start = perf_counter()
+    try:
+        # Check the connection out up front so that the wait can be measured
+        session.connection()
+    except Exception as error:
+        if isinstance(error, PoolTimeout):
+            pool_metrics.timed_out()
+        session.close()
+        raise
+    pool_metrics.observe(perf_counter() - start)
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def create_db_and_tables() -> None:
+    SQLModel.metadata.create_all(engine)
@@ -0,0 +1,124 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, List, Set
+
+from config import get_settings
+from logger import logger as log
+from metrics import job_duration, job_failures, job_overruns, job_skips
+from schedule import Job, Scheduler
+
+
+class Engine:
+    """Asyncio runner for the scheduled trading jobs.
+
+    `schedule` still decides when a job is due, but instead of running it
+    inline the engine starts it on a worker thread and moves on, so a slow
+    job never delays the others. A job that is still running when it is due
+    again is skipped rather than stacked, and a job that runs past its
+    deadline is reported.
+    """
+
+    def __init__(self) -> None:
+        settings = get_settings()
+        self.scheduler = Scheduler()
+        self.default_deadline = settings.job_deadline
+        # Jobs and the per-client work they fan out get separate pools so that
+        # busy jobs can never starve their own fan-out of threads.
+        self._jobs = ThreadPoolExecutor(
+            max_workers=settings.engine_job_workers, thread_name_prefix="job"
+        )
+        self._workers = ThreadPoolExecutor(
+            max_workers=settings.engine_concurrency, thread_name_prefix="worker"
+        )
+        # Sized to send one request per client at the same moment, e.g. the
+        # entry orders of every client
+        self._burst = ThreadPoolExecutor(
+            max_workers=settings.engine_burst_concurrency, thread_name_prefix="burst"
+        )
+        # Keyed by the job, as jobs of functions of the same name are distinct
+        self._running: Dict[Job, asyncio.Future] = dict()
+        self._watchers: Set[asyncio.Task] = set()
+
+    def every(self, interval: int = 1) -> Job:
+        return self.scheduler.every(interval)
+
+    def schedule(
+        self, job: Job, func: Callable, *args, deadline: float | None = None
+    ) -> Job:
+        """Run `func(*args)` on the engine whenever the job is due"""
+        return job.do(self.submit, job, func, *args, deadline=deadline)
+
+    def submit(
+        self, job: Job, func: Callable, *args, deadline: float | None = None
+    ) -> None:
+        name = func.__name__
+        if job in self._running:
+            log.warning("Previous run is still in progress... Skipping...", job=name)
+            job_skips.labels(name).inc()
+            return
+        started = perf_counter()
+        future = asyncio.get_running_loop().run_in_executor(
+            self._jobs, partial(func, *args)
+        )
+        self._running[job] = future
+        future.add_done_callback(lambda _: self._finished(job, name, started))
+        watcher = asyncio.create_task(
+            self._watch(name, future, deadline or self.default_deadline)
+        )
+        self._watchers.add(watcher)
+        watcher.add_done_callback(self._watchers.discard)
+
+    def _finished(self, job: Job, name: str, started: float) -> None:
+        self._running.pop(job, None)
+        job_duration.labels(name).observe(perf_counter() - started)
+
+    async def _watch(self, name: str, future: asyncio.Future, deadline: float):
+        try:
+            await asyncio.wait_for(asyncio.shield(future), deadline)
+        except TimeoutError:
+            # The thread cannot be cancelled, it keeps the job marked as running
+            log.error("Job exceeded its deadline", job=name, deadline=deadline)
+            job_overruns.labels(name).inc()
+        except Exception:
+            log.exception("Job failed", job=name)
+            job_failures.labels(name).inc()
+
+    def run_pending(self) -> None:
+        self.scheduler.run_pending()
+
+    def map(self, func: Callable, items: Iterable, burst: bool = False) -> List[Any]:
+        """Call `func` on every item concurrently and return the results in order.
+
+        Exceptions are returned in place of the result of the item that raised
+        them, so one failing client does not hide the results of the others.
+        With `burst` the calls run on the wider burst pool, for work that has
+        to go out for every client at once.
+        """
+        pool = self._burst if burst else self._workers
+        futures = [pool.submit(func, item) for item in items]
+        results = list()
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as error:
+                results.append(error)
+        return results
+
+    def spawn(self, func: Callable, *args) -> None:
+        """Run `func(*args)` on the worker pool without waiting for it"""
+        self._workers.submit(func, *args).add_done_callback(_report)
+
+    def shutdown(self) -> None:
+        self._jobs.shutdown(wait=False, cancel_futures=True)
+        self._workers.shutdown(wait=False, cancel_futures=True)
+        self._burst.shutdown(wait=False, cancel_futures=True)
+
+
+def _report(future) -> None:
+    if future.exception() is not None:
+        log.opt(exception=future.exception()).error("Background task failed")
+
+
+engine = Engine()
@@ -6,6 +6,15 @@ class Close(IntEnum):
     SELL = 1
 
 
+class Priority(IntEnum):
+    """Lanes of the Upstox calls, the lowest value goes out first"""
+
+    EXIT = 0
+    ENTRY = 1
+    MODIFY = 2
+    POLL = 3
+
+
 class Status(StrEnum):
     LIVE = "LIVE"
     CLOSED = "CLOSED"
@@ -0,0 +1,188 @@
+"""NIFTY expiry calendar and the option symbols of the series being traded.
+
+Monthly contracts expire on the last expiry weekday of the month and weekly
+contracts on every other expiry weekday. An expiry that falls on an exchange
+holiday moves to the trading day before it. The series being traded is the
+first monthly expiry after today, so on expiry day the next month is used.
+
+Everything is computed once a day. The strike -> symbol -> instrument key
+table of that series is taken from the instrument index, so `symbol` and
+`key` are a dict lookup.
+"""
+
+import calendar
+import re
+from datetime import date, timedelta
+from threading import Lock
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from config import NIFTY, get_settings
+from enums import Options
+from instruments import instruments
+from logger import logger as log
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday")
+MONTHS = ("JAN", "FEB", "MAR", "APR", "MAY", "JUN")
+MONTHS += ("JUL", "AUG", "SEP", "OCT", "NOV", "DEC")
+# Weekly symbols write the month as a single character
+WEEKLY_MONTHS = "123456789OND"
+MONTHLY_SYMBOL = re.compile(rf"{NIFTY}(\d\d)([A-Z]{{3}})(\d+)(CE|PE)")
+WEEKLY_SYMBOL = re.compile(rf"{NIFTY}(\d\d)([1-9OND])(\d\d)(\d+)(CE|PE)")
+
+
+def trading_day(day: date, holidays: FrozenSet[date]) -> date:
+    """Return the day itself or, if the exchange is closed, the trading day before"""
+    while day.weekday() >= 5 or day in holidays:
+        day -= timedelta(days=1)
+    return day
+
+
+def monthly_expiry(
+    year: int, month: int, weekday: int, holidays: FrozenSet[date]
+) -> date:
+    """Return the expiry of the monthly contract of the given month"""
+    last_day = date(year, month, calendar.monthrange(year, month)[1])
+    last_weekday = last_day - timedelta(days=(last_day.weekday() - weekday) % 7)
+    return trading_day(last_weekday, holidays)
+
+
+def monthly_expiries(
+    today: date, count: int, weekday: int, holidays: FrozenSet[date]
+) -> List[date]:
+    """Return the next `count` monthly expiries after today"""
+    expiries, year, month = list(), today.year, today.month
+    while len(expiries) < count:
+        expiry = monthly_expiry(year, month, weekday, holidays)
+        if expiry > today:
+            expiries.append(expiry)
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return expiries
+
+
+def weekly_expiries(
+    today: date, count: int, weekday: int, holidays: FrozenSet[date]
+) -> List[date]:
+    """Return the next `count` weekly expiries after today, monthlies included"""
+    day = today + timedelta(days=(weekday - today.weekday()) % 7)
+    expiries = list()
+    while len(expiries) < count:
+        expiry = trading_day(day, holidays)
+        if expiry > today:
+            expiries.append(expiry)
+        day += timedelta(days=7)
+    return expiries
+
+
+def monthly_symbol(expiry: date, strike: int, option: Options) -> str:
+    """e.g. NIFTY25JAN23000CE"""
+    return f"{NIFTY}{expiry:%y}{MONTHS[expiry.month - 1]}{strike}{option}"
+
+
+def weekly_symbol(expiry: date, strike: int, option: Options) -> str:
+    """e.g. NIFTY2510923000CE for the 9th of January 2025"""
+    month = WEEKLY_MONTHS[expiry.month - 1]
+    return f"{NIFTY}{expiry:%y}{month}{expiry.day:02d}{strike}{option}"
+
+
+class Series(NamedTuple):
+    built_on: date
+    version: int
+    weekly: List[date]
+    monthly: List[date]
+    expiry: date
+    symbols: Dict[Tuple[int, str], str]
+    keys: Dict[Tuple[int, str], str]
+
+
+class ExpiryCalendar:
+    """Expiries and option symbols of the traded series, rebuilt every day"""
+
+    def __init__(self) -> None:
+        settings = get_settings()
+        self.weekday = WEEKDAYS.index(settings.expiry_weekday.lower())
+        self.holidays = frozenset(
+            date.fromisoformat(day.strip())
+            for day in settings.exchange_holidays.split(",")
+            if day.strip()
+        )
+        self._lock = Lock()
+        self._series: Optional[Series] = None
+
+    def build(self, today: Optional[date] = None) -> Series:
+        """Recompute the calendar and symbol table and swap them in at once"""
+        today = today or date.today()
+        weekly = weekly_expiries(today, 5, self.weekday, self.holidays)
+        monthly = monthly_expiries(today, 3, self.weekday, self.holidays)
+        expiry = monthly[0]
+        prefix = monthly_symbol(expiry, 0, Options.CALL)[: -len("0CE")]
+        symbols, keys = dict(), dict()
+        pairs = instruments.items()
+        version = instruments.version
+        for symbol, key in pairs:
+            if not symbol.startswith(prefix):
+                continue
+            strike, option = symbol[len(prefix) : -2], symbol[-2:]
+            if strike.isdigit() and option in (Options.CALL, Options.PUT):
+                symbols[(int(strike), option)] = symbol
+                keys[(int(strike), option)] = key
+        series = Series(today, version, weekly, monthly, expiry, symbols, keys)
+        self._series = series
+        log.info(
+            "Built expiry calendar",
+            expiry=expiry.isoformat(),
+            weekly=[day.isoformat() for day in weekly],
+            symbols=len(symbols),
+        )
+        return series
+
+    @staticmethod
+    def _stale(series: Optional[Series]) -> bool:
+        return (
+            series is None
+            or series.built_on != date.today()
+            or series.version != instruments.version
+        )
+
+    @property
+    def series(self) -> Series:
+        """The current series, rebuilt on a new day or a reloaded index"""
+        series = self._series
+        if self._stale(series):
+            with self._lock:
+                series = self._series
+                if self._stale(series):
+                    series = self.build()
+        return series
+
+    def symbol(self, strike: int, option: Options) -> str:
+        """Return the tradingsymbol of the strike in the traded series"""
+        series = self.series
+        symbol = series.symbols.get((strike, option))
+        if symbol is None:
+            # Strikes outside the instrument master are still named the same way
+            return monthly_symbol(series.expiry, strike, option)
+        return symbol
+
+    def contract(self, symbol: str) -> Optional[Tuple[date, int, str]]:
+        """Return the expiry, strike and option of a monthly or weekly symbol"""
+        match = MONTHLY_SYMBOL.fullmatch(symbol)
+        if match is not None and match[2] in MONTHS:
+            year, month = 2000 + int(match[1]), MONTHS.index(match[2]) + 1
+            expiry = monthly_expiry(year, month, self.weekday, self.holidays)
+            return expiry, int(match[3]), match[4]
+        match = WEEKLY_SYMBOL.fullmatch(symbol)
+        if match is not None:
+            month = WEEKLY_MONTHS.index(match[2]) + 1
+            expiry = date(2000 + int(match[1]), month, int(match[3]))
+            return expiry, int(match[4]), match[5]
+        return None
+
+    def key(self, strike: int, option: Options) -> str:
+        """Return the instrument key of the strike in the traded series"""
+        key = self.series.keys.get((strike, option))
+        if key is None:
+            return instruments.key(self.symbol(strike, option))
+        return key
+
+
+expiries = ExpiryCalendar()
@@ -0,0 +1,108 @@
+import asyncio
+import json
+from secrets import token_hex
+from typing import Callable, Iterable, Optional, Set
+
+from config import get_settings
+from logger import logger as log
+from metrics import feed_reconnects
+from upstox_client.feeder.proto.MarketDataFeedV3_pb2 import FeedResponse
+from websockets.asyncio.client import ClientConnection, connect
+
+
+class MarketFeed:
+    """Streaming LTP feed over the Upstox v3 market data websocket.
+
+    The feed keeps the set of subscribed instrument keys itself so that it
+    can subscribe to all of them again whenever it has to reconnect.
+    """
+
+    def __init__(
+        self,
+        access_token: Callable[[], str],
+        on_tick: Callable[[str, float], None],
+        url: Optional[str] = None,
+    ) -> None:
+        settings = get_settings()
+        self.url = url or settings.market_feed_url
+        self.max_backoff = settings.market_feed_max_backoff
+        self._access_token = access_token
+        self._on_tick = on_tick
+        self._keys: Set[str] = set()
+        self._websocket: Optional[ClientConnection] = None
+        self.reconnects = 0
+
+    async def _send(self, method: str, keys: Iterable[str]) -> None:
+        keys = list(keys)
+        if self._websocket is None or not keys:
+            return
+        request = {
+            "guid": token_hex(8),
+            "method": method,
+            "data": {"mode": "ltpc", "instrumentKeys": keys},
+        }
+        await self._websocket.send(json.dumps(request).encode())
+
+    async def subscribe(self, keys: Iterable[str]) -> None:
+        new_keys = set(keys) - self._keys
+        self._keys |= new_keys
+        await self._send("sub", new_keys)
+
+    async def unsubscribe(self, keys: Iterable[str]) -> None:
+        old_keys = set(keys) & self._keys
+        self._keys -= old_keys
+        await self._send("unsub", old_keys)
+
+    async def set_subscriptions(self, keys: Iterable[str]) -> None:
+        """Subscribe to exactly the given keys"""
+        keys = set(keys)
+        await self.unsubscribe(self._keys - keys)
+        await self.subscribe(keys)
+
+    def _dispatch(self, message: bytes) -> None:
+        response = FeedResponse()
+        response.ParseFromString(message)
+        for key, feed in response.feeds.items():
+            if feed.HasField("ltpc"):
+                ltpc = feed.ltpc
+            elif feed.HasField("fullFeed"):
+                full_feed = feed.fullFeed
+                market_feed = (
+                    full_feed.marketFF
+                    if full_feed.HasField("marketFF")
+                    else full_feed.indexFF
+                )
+                ltpc = market_feed.ltpc
+            else:
+                continue
+            try:
+                self._on_tick(key, ltpc.ltp)
+            except Exception:
+                log.exception("Error while handling tick", instrument_key=key)
+
+    async def run(self) -> None:
+        """Stream ticks forever, reconnecting with a capped exponential backoff"""
+        backoff = 1
+        while True:
+            try:
+                access_token = await asyncio.to_thread(self._access_token)
+                async with connect(
+                    self.url,
+                    additional_headers={"Authorization": f"Bearer {access_token}"},
+                ) as websocket:
+                    self._websocket = websocket
+                    log.info("Connected to market feed", instruments=len(self._keys))
+                    await self._send("sub", self._keys)
+                    backoff = 1
+                    async for message in websocket:
+                        self._dispatch(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                log.warning("Market feed disconnected", error=str(error))
+            finally:
+                self._websocket = None
+            self.reconnects += 1
+            feed_reconnects.inc()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
@@ -0,0 +1,181 @@
+import csv
+import zlib
+from datetime import date
+from io import StringIO
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config import NIFTY, get_settings
+from database import engine
+from httpx import stream
+from logger import logger as log
+from sqlalchemy import text
+
+# The instrument master names the index differently from what the app uses
+ALIASES = {"NSE_INDEX|Nifty 50": NIFTY}
+
+
+class InstrumentRegistry:
+    """Bidirectional tradingsymbol <-> instrument_key index kept in memory.
+
+    The index is loaded from the `instruments` table on first use and again
+    on the first lookup of every new day, so lookups never hit the database.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._by_symbol: Dict[str, str] = dict()
+        self._by_key: Dict[str, str] = dict()
+        self._loaded_on: Optional[date] = None
+        # Bumped on every reload so that tables derived from the index know
+        # when to rebuild
+        self.version = 0
+
+    def load(self) -> None:
+        """Reload the whole index from the instruments table"""
+        with engine.connect() as connection:
+            rows = connection.execute(
+                text("SELECT trading_symbol, instrument_key FROM instruments")
+            ).all()
+        self.use(rows)
+        log.info("Loaded instruments", count=len(rows))
+
+    def use(self, rows: Iterable[Tuple[str, str]]) -> None:
+        """Replace the index with the given (tradingsymbol, instrument_key) pairs"""
+        rows = list(rows)
+        by_symbol = {symbol: key for symbol, key in rows}
+        by_key = {key: symbol for symbol, key in rows}
+        # Swap both maps at once so that readers never see a half built index
+        self._by_symbol, self._by_key = by_symbol, by_key
+        self._loaded_on = date.today()
+        self.version += 1
+
+    def _ensure_fresh(self) -> None:
+        if self._loaded_on == date.today():
+            return
+        with self._lock:
+            if self._loaded_on != date.today():
+                self.load()
+
+    def key(self, tradingsymbol: str) -> str:
+        """Return the instrument key of the given tradingsymbol"""
+        self._ensure_fresh()
+        try:
+            return self._by_symbol[tradingsymbol]
+        except KeyError:
+            raise Exception("The tradingsymbol does not exist!")
+
+    def symbol(self, instrument_key: str) -> str:
+        """Return the tradingsymbol of the given instrument key"""
+        self._ensure_fresh()
+        try:
+            return self._by_key[instrument_key]
+        except KeyError:
+            raise Exception("The given instrument token is not in Instruments!")
+
+    def items(self) -> List[Tuple[str, str]]:
+        """Return every (tradingsymbol, instrument_key) pair of the index"""
+        self._ensure_fresh()
+        return list(self._by_symbol.items())
+
+    def refresh(self) -> None:
+        """Download today's instrument master and reload the index"""
+        bulk_load()
+        with self._lock:
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self._by_symbol)
+
+
+def _lines(url: str) -> Iterator[str]:
+    """Stream the gzipped instrument master and yield its decoded lines"""
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    pending = b""
+    with stream("GET", url, follow_redirects=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_raw():
+            pending += decompressor.decompress(chunk)
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                yield line.decode()
+    pending += decompressor.flush()
+    if pending:
+        yield pending.decode()
+
+
+def _copy(cursor, buffer: StringIO) -> None:
+    buffer.seek(0)
+    cursor.copy_expert(
+        "COPY instruments_staging (trading_symbol, instrument_key, expiry) "
+        "FROM STDIN WITH (FORMAT csv)",
+        buffer,
+    )
+
+
+def bulk_load(url: Optional[str] = None) -> int:
+    """Load the Upstox instrument master into the instruments table using COPY"""
+    settings = get_settings()
+    segments = set(settings.instrument_segments.split(","))
+    connection = engine.raw_connection()
+    loaded = pruned = 0
+    try:
+        cursor = connection.cursor()
+        cursor.execute(
+            "CREATE TEMP TABLE instruments_staging "
+            "(trading_symbol TEXT, instrument_key TEXT, expiry DATE) ON COMMIT DROP"
+        )
+        buffer, batched = StringIO(), 0
+        writer = csv.writer(buffer)
+        for row in csv.DictReader(_lines(url or settings.instruments_url)):
+            key = row["instrument_key"]
+            if key.split("|")[0] not in segments:
+                continue
+            # An empty expiry is copied as NULL
+            writer.writerow(
+                (ALIASES.get(key, row["tradingsymbol"]), key, row.get("expiry", ""))
+            )
+            batched += 1
+            if batched == settings.instrument_batch_size:
+                _copy(cursor, buffer)
+                loaded += batched
+                buffer.seek(0)
+                buffer.truncate()
+                batched = 0
+        if batched:
+            _copy(cursor, buffer)
+            loaded += batched
+        cursor.execute("DELETE FROM instruments_staging WHERE expiry < current_date")
+        # A symbol listed twice keeps the row without an expiry or with the
+        # nearest one, then the lowest key
+        cursor.execute(
+            "INSERT INTO instruments (trading_symbol, instrument_key) "
+            "SELECT DISTINCT ON (trading_symbol) trading_symbol, instrument_key "
+            "FROM instruments_staging "
+            "ORDER BY trading_symbol, expiry NULLS FIRST, instrument_key "
+            "ON CONFLICT (trading_symbol) "
+            "DO UPDATE SET instrument_key = EXCLUDED.instrument_key"
+        )
+        if loaded:
+            # Expired instruments are no longer in the master, nor in the table
+            cursor.execute(
+                "DELETE FROM instruments WHERE NOT EXISTS ("
+                "SELECT 1 FROM instruments_staging AS staging "
+                "WHERE staging.trading_symbol = instruments.trading_symbol)"
+            )
+            pruned = cursor.rowcount
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    log.info("Bulk loaded instruments", count=loaded, pruned=pruned)
+    return loaded
+
+
+instruments = InstrumentRegistry()
+
+
+if __name__ == "__main__":
+    bulk_load()
@@ -0,0 +1,387 @@
+"""The weekly NIFTY iron fly, the first strategy plugin.
+
+Every Thursday at 15:10 an iron fly is deployed at the ATM strike for each
+client trading it: both ATM options sold, the wings bought as far out as the
+premium collected. The sold legs are chased until they fill, and the rows are
+then watched until a stoploss or the adjustment level closes them, once a
+minute from the bus snapshot or on every tick with the market data feed.
+"""
+
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Set
+
+from bus import bus
+from chain import OptionChain
+from chase import chaser
+from config import IRON_FLY, NIFTY, get_settings
+from database import session_scope
+from engine import engine
+from enums import Options, Priority, Status
+from logger import logger as log
+from metrics import sl_checks_skipped
+from models import Client, IronFly
+from monitor import StopLossMonitor
+from orders import FINISHED, OrderUpdate, update_row
+from persistence import Changes
+from registry import clients
+from rules import (
+    adjustment_hit,
+    blocks_redeploy,
+    stoploss_hit,
+    wing_strikes,
+)
+from shard import shards
+from sqlmodel import col, select
+from strategy import Strategy, plugin
+from utils import (
+    buy,
+    get_symbol,
+    sell,
+)
+
+
+@log.catch(reraise=True)
+def initialize(namespace: SimpleNamespace):
+    # Strikes and prices all come from one snapshot of the option chain
+    chain = OptionChain.snapshot()
+    namespace.price = chain.spot
+
+    namespace.strike = chain.strike
+
+    namespace.sell_ce_symbol = get_symbol(namespace.strike, Options.CALL)
+    namespace.sell_pe_symbol = get_symbol(namespace.strike, Options.PUT)
+
+    namespace.sell_ce_price = chain.ask(namespace.strike, Options.CALL)
+    namespace.sell_pe_price = chain.ask(namespace.strike, Options.PUT)
+
+    namespace.premium = namespace.sell_ce_price + namespace.sell_pe_price
+
+    namespace.buy_ce_strike, namespace.buy_pe_strike = wing_strikes(
+        namespace.strike, namespace.premium
+    )
+
+    namespace.buy_ce_symbol = get_symbol(namespace.buy_ce_strike, Options.CALL)
+    namespace.buy_pe_symbol = get_symbol(namespace.buy_pe_strike, Options.PUT)
+
+    namespace.buy_ce_price = chain.bid(namespace.buy_ce_strike, Options.CALL)
+    namespace.buy_pe_price = chain.bid(namespace.buy_pe_strike, Options.PUT)
+
+    namespace.total = namespace.sell_ce_price + namespace.sell_pe_price
+
+    namespace.iron_fly_clients: list[Client] = [
+        client
+        for client in clients.trading(IRON_FLY, NIFTY)
+        if shards.owns(client.client_id)
+    ]
+
+
+def deploy_ironfly(
+    namespace: SimpleNamespace, client: Client, open_strikes: List[int]
+) -> Optional[IronFly]:
+    """Place the legs of a new iron fly for the client and return its row.
+
+    Nothing is written here, `iron_fly` saves the rows of every client in one
+    transaction once all the orders are out.
+    """
+    if not client.trades(IRON_FLY):
+        log.info("Not deploying ironlfy", client=client.client_id, quantity=0)
+        return None
+    if not shards.owns(client.client_id):
+        log.info("Not deploying ironfly, client moved", client=client.client_id)
+        return None
+
+    for strike in open_strikes:
+        # Don't deploy ironfly if already deployed for strike +- 100
+        if blocks_redeploy(namespace.strike, strike):
+            log.info(
+                "Not deploying ironfly",
+                client=client.client_id,
+                strike=namespace.strike,
+            )
+            return None
+
+    new_trade = IronFly()
+    new_trade.client_id = client.client_id
+    new_trade.strike = namespace.strike
+    new_trade.status = Status.OPEN
+    new_trade.buy_ce_symbol = namespace.buy_ce_symbol
+    new_trade.buy_pe_symbol = namespace.buy_pe_symbol
+    new_trade.sell_ce_symbol = namespace.sell_ce_symbol
+    new_trade.sell_pe_symbol = namespace.sell_pe_symbol
+    orders = client.place_multiple_orders(
+        buy(new_trade.buy_pe_symbol),
+        buy(new_trade.buy_ce_symbol),
+        sell(new_trade.sell_pe_symbol, namespace.sell_pe_price),
+        sell(new_trade.sell_ce_symbol, namespace.sell_ce_price),
+        strategy=IRON_FLY,
+    )
+    if not orders:
+        raise Exception("The entry orders were not placed")
+    for order in orders:
+        setattr(new_trade, order["correlation_id"] + "_order_id", order["order_id"])
+
+    log.info("Deploying ironfly", client=client.client_id)
+    return new_trade
+
+
+def update_order_status():
+    # The connection is only held while reading and writing the rows, not
+    # while the order books are downloaded
+    with session_scope() as database:
+        open_rows = Changes(
+            database,
+            select(IronFly)
+            .where(IronFly.status == Status.OPEN)
+            .where(shards.where(IronFly.client_id)),
+        )
+    if not open_rows:
+        log.info("No open rows found... Skipping...")
+        return
+    log.info("Updating open orders")
+    rows_by_client: Dict[str, List[IronFly]] = defaultdict(list)
+    for row in open_rows:
+        rows_by_client[row.client_id].append(row)
+    # Download each client's order book once, concurrently across clients
+    client_ids = list(rows_by_client)
+    updates: List[OrderUpdate] = list()
+    order_books = engine.map(
+        lambda client_id: clients.get(client_id).fetch_orders(), client_ids
+    )
+    for client_id, orders in zip(client_ids, order_books):
+        if orders is None or isinstance(orders, Exception):
+            log.error("Could not fetch orders... Skipping client...", client=client_id)
+            continue
+        orders_by_id = {order.order_id: order for order in orders}
+        for row in rows_by_client[client_id]:
+            log.info("Updating row", row_id=row.id, client=row.client_id)
+            updates.extend(update_row(row, orders_by_id))
+    # Only the rows whose orders moved are written, in one bulk update
+    with session_scope() as database:
+        updated = open_rows.save(database)
+    log.info("Commited and closed the Database Session", updated=updated)
+    # A postback got to these first, the next reconciliation starts from it
+    conflicts = {row.id for row in open_rows.conflicts}
+    if conflicts:
+        log.warning("Rows changed while updating... Skipping...", rows=len(conflicts))
+    for update in updates:
+        if update.row_id not in conflicts:
+            bus.publish_order(update)
+
+
+def check_row(row: IronFly, ltps: Dict[str, float], nifty_price: float) -> None:
+    """Exit the legs of the row whose stoploss or adjustment level is breached"""
+    log.info("Checking row", row=row.id, cliet=row.client_id)
+    if not shards.owns(row.client_id):
+        log.info("Client moved to another worker... Skipping row...", row=row.id)
+        return
+    client = clients.get(row.client_id)
+
+    sell_ce_ltp = ltps.get(row.sell_ce_symbol)
+    sell_pe_ltp = ltps.get(row.sell_pe_symbol)
+    if sell_ce_ltp is None or sell_pe_ltp is None:
+        log.warning("LTPs not found... Skipping row...", row=row.id)
+        sl_checks_skipped.inc()
+        return
+    if stoploss_hit(sell_ce_ltp, row.high_sl) and (
+        row.sl_status != "ALL_EXITED" and row.sl_status != "CE_EXITED"
+    ):
+        log.info("CE Symbol LTP is more than High SL")
+        log.info("SL Status is", sl_status=row.sl_status)
+        client.place_multiple_orders(
+            buy(row.sell_ce_symbol),
+            sell(row.buy_ce_symbol),
+            strategy=IRON_FLY,
+            priority=Priority.EXIT,
+        )
+        log.info("Placed closing orders")
+        row.sl_status = "ALL_EXITED" if row.sl_status == "PE_EXITED" else "CE_EXITED"
+        log.info("Set SL Status")
+    elif stoploss_hit(sell_pe_ltp, row.low_sl) and (
+        row.sl_status != "ALL_EXITED" and row.sl_status != "PE_EXITED"
+    ):
+        log.info("PE Symbol LTP is more than Low SL")
+        log.info("SL Status is", sl_status=row.sl_status)
+        client.place_multiple_orders(
+            buy(row.sell_pe_symbol),
+            sell(row.buy_pe_symbol),
+            strategy=IRON_FLY,
+            priority=Priority.EXIT,
+        )
+        log.info("Placed closing orders")
+        row.sl_status = "ALL_EXITED" if row.sl_status == "CE_EXITED" else "PE_EXITED"
+        log.info("Set SL Status")
+    log.info("Check adjustment")
+    if (
+        adjustment_hit(nifty_price, row.high_adj, row.low_adj)
+        and row.adj_status != Status.CLOSED
+    ):
+        if row.sl_status == "CE_EXITED":
+            client.place_multiple_orders(
+                buy(row.sell_pe_symbol),
+                sell(row.buy_pe_symbol),
+                strategy=IRON_FLY,
+                priority=Priority.EXIT,
+            )
+        elif row.sl_status == "PE_EXITED":
+            log.debug("Inside if condition of client", client_id=client.client_id)
+            client.place_multiple_orders(
+                buy(row.sell_ce_symbol),
+                sell(row.buy_ce_symbol),
+                strategy=IRON_FLY,
+                priority=Priority.EXIT,
+            )
+        else:
+            client.place_multiple_orders(
+                buy(row.sell_ce_symbol),
+                buy(row.sell_pe_symbol),
+                sell(row.buy_ce_symbol),
+                sell(row.buy_pe_symbol),
+                strategy=IRON_FLY,
+                priority=Priority.EXIT,
+            )
+        log.info("Placed closing orders", sl_status=row.sl_status)
+        row.adj_status = row.status = Status.CLOSED
+        log.info(
+            "Set Adjustment and Row Status",
+            adj_status=row.adj_status,
+            row_status=row.status,
+        )
+
+
+def check_sl_and_adj(ltps: Dict[str, float]) -> None:
+    """Check the complete rows against one snapshot of LTPs, NIFTY included"""
+    with session_scope() as database:
+        complete_rows = Changes(
+            database,
+            select(IronFly)
+            .where(IronFly.status == Status.COMPLETE)
+            .where(shards.where(IronFly.client_id)),
+        )
+    if not complete_rows:
+        log.info("No complete rows found... Skipping...")
+        return
+    if NIFTY not in ltps:
+        log.warning("NIFTY LTP not found... Skipping...")
+        sl_checks_skipped.inc(len(complete_rows))
+        return
+    log.info("Checking stoploss and adjusting accordingly of complete rows")
+    nifty_price = ltps[NIFTY]
+    # Check the rows concurrently so that one slow client doesn't delay the rest
+    results = engine.map(lambda row: check_row(row, ltps, nifty_price), complete_rows)
+    for row, result in zip(complete_rows, results):
+        if isinstance(result, Exception):
+            log.opt(exception=result).error("Error while checking row", row=row.id)
+    with session_scope() as database:
+        updated = complete_rows.save(database)
+    log.info("Commited and closed the Database Session", updated=updated)
+    if complete_rows.conflicts:
+        log.warning(
+            "Rows changed while checking... Skipping...",
+            rows=[row.id for row in complete_rows.conflicts],
+        )
+    if complete_rows.saved:
+        bus.publish_rows({row.client_id for row in complete_rows.saved})
+
+
+def iron_fly(namespace: SimpleNamespace) -> Dict[str, IronFly | Exception | None]:
+    """Deploy the iron fly for every client at once.
+
+    Returns the new row, the error or None (not deployed) of every client.
+    """
+    initialize(namespace)
+    deploying: List[Client] = namespace.iron_fly_clients
+    open_strikes: Dict[str, List[int]] = defaultdict(list)
+    with session_scope() as database:
+        # The strikes still in play of every client, in one query
+        for client_id, strike in database.exec(
+            select(IronFly.client_id, IronFly.strike)
+            .where(IronFly.status != Status.CLOSED)
+            .where(col(IronFly.client_id).in_([c.client_id for c in deploying]))
+        ):
+            open_strikes[client_id].append(strike)
+
+    # Every client's entry orders go out at the same time instead of one
+    # client after another, so they all trade at the same prices
+    results = engine.map(
+        lambda client: deploy_ironfly(
+            namespace, client, open_strikes[client.client_id]
+        ),
+        deploying,
+        burst=True,
+    )
+    deployed = dict()
+    for client, result in zip(deploying, results):
+        deployed[client.client_id] = result
+        if isinstance(result, Exception):
+            log.opt(exception=result).error(
+                "Failed to deploy ironfly", client=client.client_id
+            )
+
+    rows = [row for row in deployed.values() if isinstance(row, IronFly)]
+    with session_scope() as database:
+        database.add_all(rows)
+    prices = {"sell_ce": namespace.sell_ce_price, "sell_pe": namespace.sell_pe_price}
+    for row in rows:
+        chaser.track(row, prices)
+    log.info(
+        "Deployed ironfly",
+        deployed=len(rows),
+        failed=sum(isinstance(result, Exception) for result in results),
+        skipped=results.count(None),
+    )
+    return deployed
+
+
+@plugin
+class IronFlyStrategy(Strategy):
+    name = IRON_FLY
+
+    def __init__(self) -> None:
+        self.namespace = SimpleNamespace()
+        # With the market feed the stoplosses are checked on every tick instead
+        self.monitor = (
+            StopLossMonitor(check_row, bus.ltps) if bus.feed is not None else None
+        )
+
+    def instruments(self) -> Set[str]:
+        """The sold legs of the complete rows and NIFTY, while there are any"""
+        if self.monitor is not None:
+            return self.monitor.refresh()
+        with session_scope() as database:
+            legs = database.exec(
+                select(IronFly.sell_ce_symbol, IronFly.sell_pe_symbol)
+                .where(IronFly.status == Status.COMPLETE)
+                .where(shards.where(IronFly.client_id))
+            ).all()
+        symbols = {symbol for leg in legs for symbol in leg}
+        return {NIFTY, *symbols} if symbols else set()
+
+    def on_quotes(self, ltps: Dict[str, float]) -> None:
+        if self.monitor is None:
+            check_sl_and_adj(ltps)
+
+    def on_tick(self, symbol: str, ltp: float) -> None:
+        self.monitor.on_tick(symbol, ltp)
+
+    def on_order(self, update: OrderUpdate) -> None:
+        if update.status in FINISHED:
+            chaser.finish(update.order_id, update.status)
+
+    def schedule(self) -> None:
+        settings = get_settings()
+        engine.schedule(engine.every().day, initialize, self.namespace)
+        # Order updates are pushed to the API, the order books only reconcile them
+        engine.schedule(
+            engine.every(settings.order_reconcile_interval).minutes,
+            update_order_status,
+        )
+        engine.schedule(
+            engine.every().thursday.at("15:10:00"),
+            iron_fly,
+            self.namespace,
+            deadline=settings.deploy_deadline,
+        )
+
+    async def run(self) -> None:
+        await chaser.run()
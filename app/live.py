@@ -0,0 +1,345 @@
+"""Live positions and P&L of every client, pushed by the trading app to the API.
+
+The trading app keeps the LTPs of every open leg from the market bus. With
+every snapshot of LTPs and every order update it marks the open iron flies of
+its clients to market, and writes the state of each client that changed to
+the `livestate` table, announcing it on the `live` channel. The API keeps a
+copy of every state in memory and only reads the states written since its
+last read when it is told, so `/positions` and the stream it serves to the
+dashboards never query the database, however many of them are connected.
+"""
+
+import asyncio
+import json
+from collections import defaultdict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import (
+    AsyncIterator,
+    Dict,
+    FrozenSet,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from bus import Subscriber
+from config import IRON_FLY, get_settings
+from database import session_scope
+from engine import engine
+from enums import Status
+from logger import logger as log
+from metrics import register_stats
+from models import IronFly, LiveState
+from orders import LEGS, OrderUpdate
+from registry import clients
+from risk import live_legs
+from rules import LOT_SIZE
+from shard import shards
+from sqlalchemy import text
+from sqlmodel import col, select
+
+CHANNEL = "live"
+# A worker's transaction may commit after a later one of another worker
+RELOAD_OVERLAP = timedelta(seconds=5)
+
+
+def leg_state(
+    row: IronFly, leg: str, quantity: int, live: bool, ltps: Dict[str, float]
+) -> dict:
+    symbol = getattr(row, f"{leg}_symbol")
+    price = getattr(row, f"{leg}_price")
+    ltp = ltps.get(symbol)
+    # Sold legs are held short
+    signed = -quantity if leg.startswith("sell") else quantity
+    pnl = None
+    if live and price is not None and ltp is not None:
+        pnl = round((ltp - price) * signed, 2)
+    return {
+        "symbol": symbol,
+        "status": getattr(row, f"{leg}_status"),
+        "live": live,
+        "quantity": signed,
+        "price": price,
+        "ltp": ltp,
+        "pnl": pnl,
+    }
+
+
+def client_state(client_id: str, rows: List[IronFly], ltps: Dict[str, float]) -> dict:
+    """Mark the open iron flies of the client to market"""
+    try:
+        quantity = clients.get(client_id).lots(IRON_FLY) * LOT_SIZE
+    except Exception:
+        quantity = 0
+    flies = list()
+    for row in sorted(rows, key=lambda row: row.id):
+        live = set(live_legs(row))
+        legs = {leg: leg_state(row, leg, quantity, leg in live, ltps) for leg in LEGS}
+        flies.append(
+            {
+                "id": row.id,
+                "strike": row.strike,
+                "status": row.status,
+                "sl_status": row.sl_status,
+                "adj_status": row.adj_status,
+                "pnl": round(sum(leg["pnl"] or 0 for leg in legs.values()), 2),
+                "legs": legs,
+            }
+        )
+    return {
+        "client_id": client_id,
+        "pnl": round(sum(fly["pnl"] for fly in flies), 2),
+        "flies": flies,
+    }
+
+
+class LivePublisher(Subscriber):
+    """Pushes the positions of the trading app's clients whenever they change.
+
+    The rows that are not closed are kept in memory, so a snapshot of LTPs
+    only marks them to market again. The rows of a client are only read
+    again after an order update or an exit of one of them, and all of them
+    once the worker's share of the clients changed.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        # One push at a time, so an older state never overwrites a newer one
+        self._publishing = Lock()
+        self._ltps: Dict[str, float] = dict()
+        self._rows: Dict[str, List[IronFly]] = dict()
+        # The clients of the worker when every row was last read
+        self._loaded_for: Optional[FrozenSet[str]] = None
+        self._symbols: Set[str] = set()
+        # The last state pushed of every client, as JSON
+        self._published: Dict[str, str] = dict()
+        self._pending: Set[str] = set()
+        self._stats = {"pushes": 0, "changed": 0, "loads": 0}
+
+    def instruments(self) -> Set[str]:
+        """The legs of the rows in memory, no query of its own"""
+        with self._lock:
+            return set(self._symbols)
+
+    def on_quotes(self, ltps: Dict[str, float]) -> None:
+        with self._lock:
+            self._ltps = ltps
+        self.publish()
+
+    def on_order(self, update: OrderUpdate) -> None:
+        self._changed({update.client_id})
+
+    def on_rows(self, client_ids: Set[str]) -> None:
+        self._changed(client_ids)
+
+    def _changed(self, client_ids: Set[str]) -> None:
+        # The updates of one reconciliation are pushed together
+        with self._lock:
+            first = not self._pending
+            self._pending |= client_ids
+        if first:
+            engine.spawn(self._publish_pending)
+
+    def _publish_pending(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        self.publish(pending, reload=True)
+
+    def _load(self, client_ids: Optional[Set[str]] = None) -> None:
+        """Read the rows that are not closed, of the given clients or all of them"""
+        owned = shards.owned
+        query = (
+            select(IronFly)
+            .where(IronFly.status != Status.CLOSED)
+            .where(shards.where(IronFly.client_id))
+        )
+        if client_ids is not None:
+            query = query.where(col(IronFly.client_id).in_(client_ids))
+        with session_scope() as database:
+            rows = database.exec(query).all()
+            database.expunge_all()
+        rows_by_client: Dict[str, List[IronFly]] = defaultdict(list)
+        for row in rows:
+            rows_by_client[row.client_id].append(row)
+        with self._lock:
+            if client_ids is None:
+                self._rows, self._loaded_for = dict(rows_by_client), owned
+            else:
+                for client_id in client_ids:
+                    self._rows.pop(client_id, None)
+                self._rows.update(rows_by_client)
+            self._symbols = {
+                getattr(row, f"{leg}_symbol")
+                for rows in self._rows.values()
+                for row in rows
+                for leg in live_legs(row)
+            }
+            self._stats["loads"] += 1
+
+    def publish(
+        self, client_ids: Optional[Iterable[str]] = None, reload: bool = False
+    ) -> int:
+        """Push the state of the given clients, or all of them, if it changed"""
+        if client_ids is not None:
+            client_ids = set(client_ids)
+        with self._publishing:
+            if self._loaded_for != shards.owned:
+                self._load()
+            elif reload:
+                self._load(client_ids)
+            with self._lock:
+                ltps = self._ltps
+                rows_by_client = {
+                    client_id: rows
+                    for client_id, rows in self._rows.items()
+                    if client_ids is None or client_id in client_ids
+                }
+                # Clients whose last fly closed are pushed once more, empty
+                targets = set(rows_by_client) | {
+                    client_id
+                    for client_id in self._published
+                    if client_ids is None or client_id in client_ids
+                }
+            changed: Dict[str, str] = dict()
+            for client_id in targets:
+                if not shards.owns(client_id):
+                    continue
+                state = json.dumps(
+                    client_state(client_id, rows_by_client.get(client_id, []), ltps)
+                )
+                if self._published.get(client_id) != state:
+                    changed[client_id] = state
+            if changed:
+                self._push(changed)
+            with self._lock:
+                self._published.update(changed)
+                for client_id in list(self._published):
+                    if not shards.owns(client_id):
+                        # Pushed by the worker that trades it now
+                        del self._published[client_id]
+                self._stats["pushes"] += 1
+                self._stats["changed"] += len(changed)
+        return len(changed)
+
+    def _push(self, states: Dict[str, str]) -> None:
+        with session_scope() as database:
+            database.execute(
+                text(
+                    "INSERT INTO livestate (client_id, state, updated_at) "
+                    "SELECT client_id, CAST(state AS JSON), now() FROM unnest("
+                    "CAST(:client_ids AS VARCHAR[]), CAST(:states AS TEXT[])"
+                    ") AS live (client_id, state) "
+                    "ON CONFLICT (client_id) DO UPDATE "
+                    "SET state = excluded.state, updated_at = excluded.updated_at"
+                ),
+                {"client_ids": list(states), "states": list(states.values())},
+            )
+            database.execute(
+                text("SELECT pg_notify(:channel, :count)"),
+                {"channel": CHANNEL, "count": str(len(states))},
+            )
+        log.info("Pushed live positions", clients=len(states))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "clients": len(self._published)}
+
+
+class LiveView:
+    """The API's copy of the states the trading app pushes"""
+
+    def __init__(self, heartbeat_interval: float) -> None:
+        self.heartbeat_interval = heartbeat_interval
+        self.version = 0
+        self._lock = Lock()
+        self._reload_lock = Lock()
+        self._states: Dict[str, dict] = dict()
+        # The version every state last changed at
+        self._versions: Dict[str, int] = dict()
+        self._seen: Optional[datetime] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._changed: Optional[asyncio.Event] = None
+
+    def start(self) -> None:
+        """Load every state and follow the pushes, before `clients.start`"""
+        self._loop, self._changed = asyncio.get_running_loop(), asyncio.Event()
+        clients.listen(CHANNEL, lambda _: self.reload(), self.reload)
+        self.reload()
+
+    def reload(self) -> None:
+        """Read the states pushed since the last reload"""
+        with self._reload_lock:
+            query = select(LiveState)
+            if self._seen is not None:
+                query = query.where(LiveState.updated_at > self._seen - RELOAD_OVERLAP)
+            with session_scope() as database:
+                rows = database.exec(query).all()
+                database.expunge_all()
+            with self._lock:
+                # A worker only writes a state again once it has changed
+                changed = [
+                    row
+                    for row in rows
+                    if self._states.get(row.client_id, {}).get("updated_at")
+                    != row.updated_at.isoformat()
+                ]
+                if changed:
+                    self.version += 1
+                for row in changed:
+                    self._states[row.client_id] = {
+                        **row.state,
+                        "updated_at": row.updated_at.isoformat(),
+                    }
+                    self._versions[row.client_id] = self.version
+            if rows:
+                latest = max(row.updated_at for row in rows)
+                self._seen = max(self._seen or latest, latest)
+        if changed and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def get(self, client_id: str) -> Optional[dict]:
+        with self._lock:
+            return self._states.get(client_id)
+
+    def since(
+        self, version: int = 0, client_id: Optional[str] = None
+    ) -> Tuple[int, Dict[str, dict]]:
+        """Return the current version and the states changed after the given one"""
+        with self._lock:
+            return self.version, {
+                key: self._states[key]
+                for key, changed_at in self._versions.items()
+                if changed_at > version and client_id in (None, key)
+            }
+
+    async def stream(self, client_id: Optional[str] = None) -> AsyncIterator[str]:
+        """Server-sent events of every state as it changes, all of them first"""
+        version = 0
+        while True:
+            changed = self._changed
+            version, states = self.since(version, client_id)
+            if states:
+                data = json.dumps({"version": version, "clients": states})
+                yield f"event: positions\nid: {version}\ndata: {data}\n\n"
+            try:
+                await asyncio.wait_for(changed.wait(), self.heartbeat_interval)
+            except asyncio.TimeoutError:
+                # Keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"version": self.version, "clients": len(self._states)}
+
+
+publisher = LivePublisher()
+register_stats("live", publisher.stats)
+view = LiveView(get_settings().live_heartbeat_interval)
+register_stats("live_view", view.stats)
@@ -1,30 +1,313 @@
-from datetime import datetime, timedelta
-from sys import stdout
+"""App logger whose sinks never block the trading jobs.
+
+The only sink puts the message on a bounded queue, so a log call costs a
+record and a put. A background thread takes the messages off in batches of up
+to `LOG_BATCH_SIZE`, or whatever arrived within `LOG_FLUSH_INTERVAL`, formats
+them, writes each batch to stdout and the log file with a single write and
+uploads it to Betterstack in one request.
+
+When the queue is full, debug and info messages are dropped and counted.
+Warnings and errors wait up to `LOG_BLOCK_TIMEOUT` for room before they are
+dropped too. The loudest lines, those logged for every row and order, are
+limited to `LOG_RATE_LIMIT` debug and info messages per second per line of
+code. The next message let through from a limited line says how many were
+suppressed.
+"""
+
+import atexit
+import json
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from queue import Empty, Full, Queue
 from secrets import token_hex
+from shutil import rmtree
+from sys import stderr, stdout
+from threading import Lock, Thread, current_thread
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
 
+import httpx
 from config import get_settings
-from logtail import LogtailHandler
 from loguru import logger
+from metrics import register_stats
+
+# Colors of the console lines, the ANSI codes of green, magenta, cyan, red,
+# blue and yellow
+COLORS = tuple(f"\x1b[{code}m" for code in (32, 35, 36, 31, 34, 33))
+RESET = "\x1b[0m"
+# Messages below this level are the ones that may be limited and dropped
+WARNING = 30
+MAX_UPLOAD_BACKOFF = 60.0
+LOG_RETENTION = timedelta(days=7)
+DAY_FORMAT = "%d-%m-%Y"
+
+
+def prune_logs(root: Path, retention: timedelta = LOG_RETENTION) -> None:
+    """Delete the day directories of the logs older than the retention"""
+    oldest = datetime.today() - retention
+    for day in root.glob("*"):
+        try:
+            logged_on = datetime.strptime(day.name, DAY_FORMAT)
+        except ValueError:
+            continue
+        if day.is_dir() and logged_on < oldest:
+            # Another process may be pruning the same directory
+            rmtree(day, ignore_errors=True)
+
+
+class CallSiteLimiter:
+    """Token bucket per line of code for the debug and info messages"""
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        # (tokens, updated, suppressed) by (file, line)
+        self._sites: Dict[Tuple[str, int], List[float]] = dict()
+        self._lock = Lock()
+        self.suppressed = 0
+
+    def __call__(self, record: dict) -> None:
+        if not self.rate or record["level"].no >= WARNING:
+            return
+        site = (record["file"].path, record["line"])
+        current = monotonic()
+        with self._lock:
+            state = self._sites.get(site)
+            if state is None:
+                state = self._sites[site] = [self.rate, current, 0]
+            elapsed = current - state[1]
+            state[0], state[1] = min(self.rate, state[0] + elapsed * self.rate), current
+            if state[0] < 1:
+                state[2] += 1
+                self.suppressed += 1
+                record["extra"]["_suppressed"] = True
+                return
+            state[0] -= 1
+            if state[2]:
+                record["extra"]["suppressed"] = int(state[2])
+                state[2] = 0
+
+    @staticmethod
+    def allows(record: dict) -> bool:
+        return "_suppressed" not in record["extra"]
+
+
+def console_line(record: dict, exception: str) -> str:
+    """e.g. 09:15:02:1234:main.py:trade:42 - Placed orders {'client': 'A'}"""
+    green, magenta, cyan, red, blue, yellow = COLORS
+    time = record["time"]
+    return (
+        f"{green}{time:%H:%M:%S}:{time.microsecond // 100:04d}{RESET}:"
+        f"{magenta}{record['file'].name}{RESET}:{cyan}{record['function']}{RESET}:"
+        f"{red}{record['line']}{RESET} - {blue}{record['message']}{RESET} "
+        f"{yellow}{record['extra']}{RESET}\n{exception}"
+    )
+
+
+def file_line(record: dict, exception: str) -> str:
+    """e.g. INFO:09:15:02:123:main.py:trade:42 - Placed orders {'client': 'A'}"""
+    time = record["time"]
+    return (
+        f"{record['level'].name}:{time:%H:%M:%S}:{time.microsecond // 1000:03d}:"
+        f"{record['file'].name}:{record['function']}:{record['line']} - "
+        f"{record['message']} {record['extra']}\n{exception}"
+    )
+
+
+def frame(record: dict, line: str) -> dict:
+    """Return the Betterstack event of a record"""
+    return {
+        "dt": record["time"].astimezone(timezone.utc).isoformat(),
+        "level": record["level"].name.lower(),
+        "severity": record["level"].no // 10,
+        "message": line.rstrip("\n"),
+        "context": {
+            "runtime": {
+                "function": record["function"],
+                "file": record["file"].name,
+                "line": record["line"],
+                "thread_name": record["thread"].name,
+            },
+            "system": {"pid": record["process"].id},
+        },
+        "extra": record["extra"],
+    }
+
+
+class LogPipeline:
+    """Bounded queue of messages drained and shipped by a background thread"""
+
+    def __init__(
+        self,
+        path: Path,
+        source_token: str,
+        url: str,
+        size: int,
+        batch_size: int,
+        flush_interval: float,
+        block_timeout: float,
+    ) -> None:
+        self.path = path
+        self.source_token = source_token
+        self.url = url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block_timeout = block_timeout
+        self._queue: Queue = Queue(maxsize=size)
+        # Betterstack events not uploaded yet, kept across failed uploads
+        self._pending: List[dict] = list()
+        self._retry_at = 0.0
+        self._failures = 0
+        self._file = None
+        self._client: Optional[httpx.Client] = None
+        self._lock = Lock()
+        # Exported from the start, so that an outage shows as a rise from zero
+        self._stats = Counter(upload_failures=0, ship_failures=0)
+        self._closed = False
+        self._thread = Thread(target=self._run, name="log-shipper", daemon=True)
+        self._thread.start()
+
+    def put(self, message) -> None:
+        """The loguru sink, it never waits unless the message is a warning or worse"""
+        level = message.record["level"]
+        try:
+            if level.no < WARNING or current_thread() is self._thread:
+                self._queue.put_nowait(message)
+            else:
+                # Warnings and errors are worth a short wait for room
+                self._queue.put(message, timeout=self.block_timeout)
+        except Full:
+            with self._lock:
+                self._stats[f"dropped_{level.name.lower()}"] += 1
+
+    def _take(self) -> list:
+        """Wait for the next batch, at most `flush_interval` after its first message"""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except Empty:
+            return list()
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get(timeout=max(0, deadline - monotonic())))
+            except Empty:
+                break
+        return batch
+
+    def _write(self, batch: list) -> None:
+        console, file = list(), list()
+        for message in batch:
+            record = message.record
+            # The sink format is "{message}", loguru adds the traceback after it
+            exception = str(message)[len(record["message"]) + 1 :]
+            console.append(console_line(record, exception))
+            file.append(file_line(record, exception))
+            self._pending.append(frame(record, file[-1]))
+        if console:
+            stdout.write("".join(console))
+            stdout.flush()
+        if file:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = self.path.open("a", encoding="utf-8")
+            self._file.write("".join(file))
+            self._file.flush()
+
+    def _upload(self) -> None:
+        """Send the pending events in batches until one of them fails"""
+        if not self.source_token:
+            self._pending.clear()
+            return
+        while self._pending and monotonic() >= self._retry_at:
+            if self._client is None:
+                self._client = httpx.Client(timeout=5.0)
+            events = self._pending[: self.batch_size]
+            try:
+                response = self._client.post(
+                    self.url,
+                    content=json.dumps(events, default=str),
+                    headers={
+                        "Authorization": f"Bearer {self.source_token}",
+                        "Content-Type": "application/json",
+                    },
+                )
+                response.raise_for_status()
+            except httpx.HTTPError as error:
+                self._failures += 1
+                if self._failures == 1:
+                    print("Failed to send logs to Betterstack:", error, file=stderr)
+                self._retry_at = monotonic() + min(
+                    MAX_UPLOAD_BACKOFF, 2.0 ** (self._failures - 1)
+                )
+                # Keep no more events waiting for Betterstack than the queue holds
+                overflow = max(0, len(self._pending) - self._queue.maxsize)
+                del self._pending[:overflow]
+                with self._lock:
+                    self._stats["upload_failures"] += 1
+                    self._stats["dropped_upload"] += overflow
+                return
+            del self._pending[: len(events)]
+            self._failures = 0
+            with self._lock:
+                self._stats["uploaded"] += len(events)
+                self._stats["uploads"] += 1
+
+    def _run(self) -> None:
+        while not (self._closed and self._queue.empty()):
+            batch = self._take()
+            try:
+                if batch:
+                    self._write(batch)
+                self._upload()
+            except Exception as error:
+                print("Failed to ship logs:", error, file=stderr)
+                with self._lock:
+                    self._stats["ship_failures"] += 1
+            with self._lock:
+                self._stats["shipped"] += len(batch)
+                self._stats["batches"] += 1 if batch else 0
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Ship what is still queued before the process exits"""
+        self._closed = True
+        self._thread.join(timeout)
+        self._retry_at = 0.0
+        self._upload()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats["depth"] = self._queue.qsize()
+        stats["pending_upload"] = len(self._pending)
+        # Failed uploads in a row, zero once Betterstack accepts logs again
+        stats["upload_failing"] = self._failures
+        return stats
+
 
 log_file = token_hex(8) + ".log"
 settings = get_settings()
-betterstack_handler = LogtailHandler(source_token=settings.betterstack_source_token)
-logger.remove()
-logger.add(
-    stdout,
-    colorize=True,
-    level="DEBUG",
-    # format="<green>{time:HH:mm:ss:SSSS}</green>:<red>{line}</red> - <blue>{message}</blue> <yellow>{extra}</yellow>",
-    format="<green>{time:HH:mm:ss:SSSS}</green>:<magenta>{file.name}</magenta>:<cyan>{function}</cyan>:<red>{line}</red> - <blue>{message}</blue> <yellow>{extra}</yellow>",
+prune_logs(Path("logs"))
+pipeline = LogPipeline(
+    Path("logs", datetime.today().strftime(DAY_FORMAT), log_file),
+    settings.betterstack_source_token,
+    settings.betterstack_url,
+    settings.log_queue_size,
+    settings.log_batch_size,
+    settings.log_flush_interval,
+    settings.log_block_timeout,
 )
-logger.add(
-    f"logs/{datetime.today().strftime('%d-%m-%Y')}/{log_file}",
-    level="DEBUG",
-    format="{level}:{time:HH:mm:ss:SSS}:{file.name}:{function}:{line} - {message} {extra}",
-    retention=timedelta(days=7),
+limiter = CallSiteLimiter(settings.log_rate_limit)
+atexit.register(pipeline.close)
+register_stats(
+    "log_pipeline", lambda: {**pipeline.stats(), "suppressed": limiter.suppressed}
 )
+logger.remove()
+logger.configure(patcher=limiter)
 logger.add(
-    betterstack_handler,
-    format="{level}:{time:HH:mm:ss:SSS}:{file.name}:{function}:{line} - {message} {extra}",
+    pipeline.put,
+    level="DEBUG",
+    filter=CallSiteLimiter.allows,
+    # Everything else is formatted by the shipper thread
+    format="{message}",
 )
 logger.info("Saving logs", log_file=log_file)
@@ -0,0 +1,129 @@
+"""Prometheus instrumentation shared by the API and the trading worker.
+
+The API serves these from its `/metrics` route. The worker has no HTTP server
+of its own, so `start_exporter` serves them from a background thread on
+`METRICS_PORT` instead.
+"""
+
+from typing import Callable, Dict, Optional
+
+from prometheus_client import REGISTRY, Counter, Histogram, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+JOB_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+upstox_latency = Histogram(
+    "upstox_request_seconds",
+    "Latency of Upstox REST calls, retries included and queueing excluded",
+    ("endpoint",),
+    buckets=REQUEST_BUCKETS,
+)
+upstox_errors = Counter(
+    "upstox_request_errors",
+    "Upstox calls that failed or answered with an error status",
+    ("endpoint", "reason"),
+)
+upstox_retries = Counter(
+    "upstox_request_retries", "Upstox calls that were sent again", ("endpoint",)
+)
+upstox_throttled = Counter(
+    "upstox_rate_limited",
+    "Upstox calls answered with HTTP 429 Too Many Requests",
+    ("endpoint",),
+)
+upstox_queue_delay = Histogram(
+    "upstox_queue_seconds",
+    "Time Upstox calls waited for their turn under the rate limits",
+    ("lane",),
+    buckets=(0.001,) + REQUEST_BUCKETS,
+)
+feed_reconnects = Counter(
+    "market_feed_reconnects", "Reconnections to the market data websocket"
+)
+job_duration = Histogram(
+    "job_duration_seconds",
+    "Wall time of the scheduled jobs",
+    ("job",),
+    buckets=JOB_BUCKETS,
+)
+job_failures = Counter("job_failures", "Scheduled jobs that raised", ("job",))
+job_overruns = Counter(
+    "job_deadline_exceeded", "Scheduled jobs that ran past their deadline", ("job",)
+)
+job_skips = Counter(
+    "job_skipped",
+    "Scheduled runs skipped because the previous run was still going",
+    ("job",),
+)
+sl_checks_skipped = Counter(
+    "sl_checks_skipped",
+    "Stoploss and adjustment checks of rows skipped for want of a fresh LTP",
+)
+order_events = Counter(
+    "order_postbacks",
+    "Order updates posted by Upstox by what became of them",
+    ("result",),
+)
+tick_to_order = Histogram(
+    "sl_tick_to_order_seconds",
+    "Time from the tick that breached a stoploss or adjustment level "
+    "until its exit orders were placed",
+    buckets=REQUEST_BUCKETS,
+)
+
+chase_modifications = Histogram(
+    "chase_order_modifications",
+    "Modifications of a chased sell leg by how its chase ended",
+    ("outcome",),
+    buckets=(0, 1, 2, 3, 5, 8, 10, 15, 20),
+)
+chase_order_age = Histogram(
+    "chase_order_age_seconds",
+    "Time a sell leg was chased by how its chase ended",
+    ("outcome",),
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900),
+)
+
+
+class StatsCollector:
+    """Exposes the `stats()` dictionary of a component as gauges.
+
+    A flat dictionary becomes one gauge per key, named `<name>_<key>`. With a
+    label, the dictionary is expected to hold one such dictionary per label
+    value, e.g. the broker's stats per host.
+    """
+
+    def __init__(
+        self, name: str, stats: Callable[[], Dict], label: Optional[str] = None
+    ) -> None:
+        self.name = name
+        self.stats = stats
+        self.label = label
+
+    def collect(self):
+        stats = self.stats()
+        groups = stats.items() if self.label else ((None, stats),)
+        families: Dict[str, GaugeMetricFamily] = dict()
+        for label_value, values in groups:
+            for key, value in values.items():
+                if key not in families:
+                    families[key] = GaugeMetricFamily(
+                        f"{self.name}_{key}",
+                        f"{key.replace('_', ' ').capitalize()} of the {self.name}",
+                        labels=(self.label,) if self.label else None,
+                    )
+                labels = (label_value,) if self.label else ()
+                families[key].add_metric(labels, value)
+        return families.values()
+
+
+def register_stats(
+    name: str, stats: Callable[[], Dict], label: Optional[str] = None
+) -> None:
+    REGISTRY.register(StatsCollector(name, stats, label))
+
+
+def start_exporter(port: int) -> None:
+    """Serve the metrics of this process on the given port"""
+    start_http_server(port)
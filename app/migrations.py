@@ -0,0 +1,142 @@
+"""Numbered schema changes for databases created before the change was made.
+
+`create_db_and_tables` builds a fresh database with everything already in
+place, so every step has to be safe to run on top of it. Run the pending
+steps with `uv run app/migrations.py`; the API also runs them on startup.
+"""
+
+from typing import List, Tuple
+
+from database import engine
+from logger import logger as log
+from sqlalchemy import text
+
+# Serialises concurrent runs, e.g. two API replicas starting together
+LOCK_KEY = 0x6D696772
+
+MIGRATIONS: List[Tuple[str, List[str]]] = [
+    (
+        "Index instruments by instrument key",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_instruments_instrument_key "
+            "ON instruments (instrument_key)",
+        ],
+    ),
+    (
+        "Index ironfly lookups by status, client and order",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_ironfly_status ON ironfly (status)",
+            "CREATE INDEX IF NOT EXISTS ix_ironfly_client_id ON ironfly (client_id)",
+            *(
+                f"CREATE INDEX IF NOT EXISTS ix_ironfly_{leg}_order_id "
+                f"ON ironfly ({leg}_order_id)"
+                for leg in ("buy_ce", "buy_pe", "sell_ce", "sell_pe")
+            ),
+        ],
+    ),
+    (
+        "Partial indexes for rows and legs that are still in play",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_ironfly_not_closed "
+            "ON ironfly (client_id, strike) WHERE status <> 'CLOSED'",
+            "CREATE INDEX IF NOT EXISTS ix_ironfly_sell_ce_unfilled "
+            "ON ironfly (sell_ce_status) WHERE sell_ce_status <> 'complete'",
+            "CREATE INDEX IF NOT EXISTS ix_ironfly_sell_pe_unfilled "
+            "ON ironfly (sell_pe_status) WHERE sell_pe_status <> 'complete'",
+        ],
+    ),
+    (
+        "Move the strategies of the clients into clientstrategy",
+        [
+            "CREATE TABLE IF NOT EXISTS clientstrategy ("
+            "client_id VARCHAR NOT NULL REFERENCES credentials (client_id), "
+            "strategy VARCHAR NOT NULL, "
+            "underlying VARCHAR NOT NULL, "
+            "lots INTEGER NOT NULL, "
+            "enabled BOOLEAN NOT NULL, "
+            "params JSON, "
+            "PRIMARY KEY (client_id, strategy))",
+            # The old table is kept, it is just not read anymore
+            "DO $$ BEGIN "
+            "IF to_regclass('strategies') IS NOT NULL THEN "
+            "INSERT INTO clientstrategy "
+            "(client_id, strategy, underlying, lots, enabled, params) "
+            "SELECT client_id, 'iron_fly', 'NIFTY', iron_fly, iron_fly > 0, '{}' "
+            "FROM strategies ON CONFLICT DO NOTHING; "
+            "END IF; END $$",
+        ],
+    ),
+    (
+        "Leases of the trading app workers and the quotes they share",
+        [
+            "CREATE TABLE IF NOT EXISTS workerlease ("
+            "worker_id VARCHAR NOT NULL PRIMARY KEY, "
+            "started_at TIMESTAMP WITH TIME ZONE, "
+            "heartbeat TIMESTAMP WITH TIME ZONE, "
+            "symbols JSON)",
+            "CREATE TABLE IF NOT EXISTS sharedquote ("
+            "symbol VARCHAR NOT NULL PRIMARY KEY, "
+            "ltp FLOAT NOT NULL, "
+            "fetched_at TIMESTAMP WITH TIME ZONE)",
+        ],
+    ),
+    (
+        "Live positions the trading app pushes to the API",
+        [
+            "CREATE TABLE IF NOT EXISTS livestate ("
+            "client_id VARCHAR NOT NULL PRIMARY KEY, "
+            "state JSON, "
+            "updated_at TIMESTAMP WITH TIME ZONE)",
+            "CREATE INDEX IF NOT EXISTS ix_livestate_updated_at "
+            "ON livestate (updated_at)",
+        ],
+    ),
+    (
+        "Risk reports the trading app pushes to the API",
+        [
+            "CREATE TABLE IF NOT EXISTS risksnapshot ("
+            "worker_id VARCHAR NOT NULL PRIMARY KEY, "
+            "report JSON, "
+            "computed_at TIMESTAMP WITH TIME ZONE)",
+        ],
+    ),
+]
+
+
+def migrate() -> int:
+    """Apply the pending migrations in order and return how many were applied"""
+    applied = 0
+    with engine.begin() as connection:
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": LOCK_KEY}
+        )
+        connection.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS schema_version ("
+                "version INTEGER PRIMARY KEY, "
+                "description TEXT NOT NULL, "
+                "applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            )
+        )
+        current = connection.execute(
+            text("SELECT coalesce(max(version), 0) FROM schema_version")
+        ).scalar_one()
+        for version, (description, statements) in enumerate(MIGRATIONS, start=1):
+            if version <= current:
+                continue
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.execute(
+                text(
+                    "INSERT INTO schema_version (version, description) "
+                    "VALUES (:version, :description)"
+                ),
+                {"version": version, "description": description},
+            )
+            log.info("Applied migration", version=version, description=description)
+            applied += 1
+    return applied
+
+
+if __name__ == "__main__":
+    migrate()
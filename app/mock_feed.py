@@ -0,0 +1,99 @@
+"""Local stand-in for the Upstox v3 market data feed.
+
+Start it with `uv run app/mock_feed.py` and set
+`MARKET_FEED_URL=ws://localhost:8765` to run the worker against it offline.
+Every subscribed instrument gets a random walk LTP on each interval.
+"""
+
+import asyncio
+import json
+import random
+from argparse import ArgumentParser
+from typing import Dict, List, Set
+
+from upstox_client.feeder.proto.MarketDataFeedV3_pb2 import FeedResponse, Type
+from websockets.asyncio.server import ServerConnection, serve
+
+
+class MockFeed:
+    def __init__(
+        self,
+        interval: float,
+        volatility: float,
+        start_price: float,
+        drop_after: int = 0,
+    ) -> None:
+        self.interval = interval
+        self.volatility = volatility
+        self.start_price = start_price
+        self.drop_after = drop_after
+        self.prices: Dict[str, float] = dict()
+        # Every request received and every connection accepted, for the tests
+        self.requests: List[dict] = list()
+        self.connections = 0
+
+    def tick(self, key: str) -> float:
+        price = self.prices.get(key, self.start_price)
+        price = max(0.05, round(price * (1 + random.gauss(0, self.volatility)), 2))
+        self.prices[key] = price
+        return price
+
+    async def handle(self, websocket: ServerConnection) -> None:
+        keys: Set[str] = set()
+        self.connections += 1
+
+        async def receive() -> None:
+            async for message in websocket:
+                request = json.loads(message)
+                self.requests.append(request)
+                instrument_keys = request["data"]["instrumentKeys"]
+                if request["method"] == "sub":
+                    keys.update(instrument_keys)
+                elif request["method"] == "unsub":
+                    keys.difference_update(instrument_keys)
+
+        receiver = asyncio.create_task(receive())
+        sent = 0
+        try:
+            while not receiver.done():
+                if keys:
+                    response = FeedResponse(type=Type.Value("live_feed"))
+                    for key in keys:
+                        response.feeds[key].ltpc.ltp = self.tick(key)
+                    await websocket.send(response.SerializeToString())
+                    sent += 1
+                # Drop the connection now and then to exercise the reconnects
+                if self.drop_after and sent >= self.drop_after:
+                    await websocket.close()
+                    return
+                await asyncio.sleep(self.interval)
+        finally:
+            receiver.cancel()
+
+
+async def serve_forever(host: str, port: int, feed: MockFeed) -> None:
+    async with serve(feed.handle, host, port):
+        await asyncio.get_running_loop().create_future()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--interval", type=float, default=0.25)
+    parser.add_argument("--volatility", type=float, default=0.002)
+    parser.add_argument("--start-price", type=float, default=100.0)
+    parser.add_argument("--drop-after", type=int, default=0)
+    arguments = parser.parse_args()
+    asyncio.run(
+        serve_forever(
+            arguments.host,
+            arguments.port,
+            MockFeed(
+                arguments.interval,
+                arguments.volatility,
+                arguments.start_price,
+                arguments.drop_after,
+            ),
+        )
+    )
@@ -0,0 +1,225 @@
+"""Local stand-in for the Upstox REST endpoints the app calls.
+
+Start it with `uv run app/mock_upstox.py` and point `UPSTOX_API_URL` and
+`UPSTOX_HFT_URL` at it to run the jobs offline. Instrument keys are expected
+in the `<segment>|<tradingsymbol>` form, as the benchmark generates them, so
+that the mock can price options from their strike. Every response can be
+delayed and a share of them answered with errors, and the requests of every
+access token can be limited per second like Upstox does.
+"""
+
+import asyncio
+import math
+import random
+import time
+from argparse import ArgumentParser
+from collections import Counter
+from secrets import token_hex
+from typing import Dict, List
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+NIFTY_KEY = "NSE_INDEX|Nifty 50"
+
+
+class MockUpstox:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        spot: float = 23000.0,
+        volatility: float = 0.0005,
+        rate_limit: int = 0,
+    ) -> None:
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.spot = spot
+        self.volatility = volatility
+        self.rate_limit = rate_limit
+        # Requests of every access token in the current second
+        self.window: Dict[str, List[int]] = dict()
+        self.requests: Counter = Counter()
+        self.errors: Counter = Counter()
+        self.throttled: Counter = Counter()
+        # Order books by access token, each order kept by its id
+        self.orders: Dict[str, Dict[str, dict]] = dict()
+
+    def price(self, instrument_key: str) -> float:
+        if instrument_key == NIFTY_KEY:
+            return round(self.spot, 2)
+        symbol = instrument_key.split("|")[-1]
+        strike, option = int(symbol[-7:-2]), symbol[-2:]
+        intrinsic = max(self.spot - strike if option == "CE" else strike - self.spot, 0)
+        time_value = 150 * math.exp(-abs(self.spot - strike) / 500)
+        return max(0.05, round((intrinsic + time_value) * 20) / 20)
+
+    def quote(self, instrument_key: str, depth: bool) -> dict:
+        price = self.price(instrument_key)
+        quote = {"instrument_token": instrument_key, "last_price": price}
+        if depth:
+            quote["depth"] = {
+                "buy": [{"price": max(0.05, price - 0.05), "quantity": 75}],
+                "sell": [{"price": price + 0.05, "quantity": 75}],
+            }
+        return quote
+
+    def fill(self, order: dict) -> None:
+        """Fill an open sell once its limit is at or below the current price"""
+        price = self.price(order["instrument_token"])
+        if order["status"] == "open" and (
+            not order["price"] or order["price"] <= price
+        ):
+            order.update(status="complete", average_price=order["price"] or price)
+
+    def app(self) -> FastAPI:
+        app = FastAPI()
+
+        def token(request: Request) -> str:
+            return request.headers.get("Authorization", "").removeprefix("Bearer ")
+
+        @app.middleware("http")
+        async def inject(request: Request, call_next):
+            path = request.url.path
+            if path in ("/stats", "/reset"):
+                return await call_next(request)
+            self.requests[path] += 1
+            limit_headers = dict()
+            if self.rate_limit:
+                second = int(time.time())
+                window = self.window.setdefault(token(request), [second, 0])
+                if window[0] != second:
+                    window[:] = [second, 0]
+                window[1] += 1
+                remaining = max(0, self.rate_limit - window[1])
+                limit_headers = {
+                    "X-RateLimit-Limit": str(self.rate_limit),
+                    "X-RateLimit-Remaining": str(remaining),
+                    "X-RateLimit-Reset": str(second + 1),
+                }
+                if window[1] > self.rate_limit:
+                    self.throttled[path] += 1
+                    return JSONResponse(
+                        {"status": "error", "errors": [{"message": "Too many"}]},
+                        status_code=429,
+                        headers={**limit_headers, "Retry-After": "1"},
+                    )
+            delay = self.latency + random.uniform(0, self.jitter)
+            if delay:
+                await asyncio.sleep(delay)
+            if random.random() < self.error_rate:
+                self.errors[path] += 1
+                return JSONResponse(
+                    {"status": "error", "errors": [{"message": "Injected error"}]},
+                    status_code=500,
+                )
+            response = await call_next(request)
+            response.headers.update(limit_headers)
+            return response
+
+        @app.get("/market-quote/ltp")
+        def ltp(instrument_key: str) -> dict:
+            self.spot *= 1 + random.gauss(0, self.volatility)
+            keys = instrument_key.split(",")
+            return {
+                "status": "success",
+                "data": {key: self.quote(key, depth=False) for key in keys},
+            }
+
+        @app.get("/market-quote/quotes")
+        def quotes(instrument_key: str) -> dict:
+            keys = instrument_key.split(",")
+            return {
+                "status": "success",
+                "data": {key: self.quote(key, depth=True) for key in keys},
+            }
+
+        @app.post("/order/multi/place")
+        async def place(request: Request) -> dict:
+            book = self.orders.setdefault(token(request), dict())
+            placed = list()
+            for order in await request.json():
+                order_id = token_hex(8)
+                # Market orders fill at once, limit sells once the price is there
+                filled = order["transaction_type"] == "BUY" or not order["price"]
+                book[order_id] = {
+                    "order_id": order_id,
+                    "transaction_type": order["transaction_type"],
+                    "trading_symbol": order["instrument_token"].split("|")[-1],
+                    "instrument_token": order["instrument_token"],
+                    "price": order["price"],
+                    "status": "complete" if filled else "open",
+                    "status_message": None,
+                    "average_price": self.price(order["instrument_token"]),
+                }
+                placed.append(
+                    {"correlation_id": order["correlation_id"], "order_id": order_id}
+                )
+            return {"status": "success", "data": placed}
+
+        @app.put("/order/modify")
+        async def modify(request: Request):
+            body = await request.json()
+            order = self.orders.get(token(request), dict()).get(body["order_id"])
+            if order is None:
+                return JSONResponse(
+                    {"status": "error", "errors": [{"message": "Unknown order"}]},
+                    status_code=400,
+                )
+            if body["order_type"] == "MARKET":
+                order.update(price=0)
+            else:
+                order.update(price=body["price"])
+            self.fill(order)
+            return {"status": "success", "data": {"order_id": body["order_id"]}}
+
+        @app.get("/order/retrieve-all")
+        def retrieve_all(request: Request) -> dict:
+            orders: List[dict] = list(self.orders.get(token(request), dict()).values())
+            for order in orders:
+                self.fill(order)
+            return {"status": "success", "data": orders}
+
+        @app.get("/stats")
+        def stats() -> dict:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "throttled": self.throttled,
+            }
+
+        @app.post("/reset")
+        def reset() -> dict:
+            self.requests.clear()
+            self.errors.clear()
+            self.throttled.clear()
+            self.window.clear()
+            self.orders.clear()
+            return {"status": "success"}
+
+        return app
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--spot", type=float, default=23000.0)
+    parser.add_argument("--rate-limit", type=int, default=0)
+    arguments = parser.parse_args()
+    mock = MockUpstox(
+        arguments.latency,
+        arguments.jitter,
+        arguments.error_rate,
+        arguments.spot,
+        rate_limit=arguments.rate_limit,
+    )
+    uvicorn.run(
+        mock.app(), host=arguments.host, port=arguments.port, log_level="warning"
+    )
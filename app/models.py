@@ -1,13 +1,15 @@
 from datetime import datetime
 from secrets import token_hex
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
-from database import SQLModel, create_db_and_tables, get_session
-from enums import Status
-from httpx import get as get_request
-from httpx import post as post_request
+from broker import broker
+from config import NIFTY
+from database import SQLModel, create_db_and_tables, session_scope
+from enums import Priority, Status
+from instruments import instruments
 from pydantic import BaseModel
-from sqlalchemy.exc import NoResultFound
+from rules import LOT_SIZE
+from sqlalchemy import JSON, Column, DateTime, Index, text
 from sqlmodel import Field, select
 
 
@@ -40,19 +42,22 @@ class FetchedOrder(BaseModel):
     average_price: float
 
 
+class Quote(BaseModel):
+    last_price: float
+    depth: Dict[str, List[Dict[str, float]]]
+
+    @property
+    def bid(self) -> float:
+        return self.depth["buy"][0]["price"]
+
+    @property
+    def ask(self) -> float:
+        return self.depth["sell"][0]["price"]
+
+
 def get_symbol_token(instrument_key: str):
     """Return the TradingSymbol of the provided InstrumentKey"""
-    database = get_session()
-    try:
-        result = database.exec(
-            select(Instruments).where(Instruments.instrument_key == instrument_key)
-        ).one()
-    except NoResultFound:
-        raise Exception("The given instrument token is not in Instruments!")
-    else:
-        return result.trading_symbol
-    finally:
-        database.close()
+    return instruments.symbol(instrument_key)
 
 
 class Credentials(SQLModel, table=True):
@@ -72,42 +77,103 @@ class Clients(SQLModel, table=True):
     m_to_m: int
 
 
-class Strategies(SQLModel, table=True):
+class ClientStrategy(SQLModel, table=True):
+    """How a client trades one strategy, one row per client and strategy"""
+
     client_id: str = Field(foreign_key="credentials.client_id", primary_key=True)
-    iron_fly: int
+    strategy: str = Field(primary_key=True)
+    underlying: str = NIFTY
+    lots: int = 0
+    # A disabled strategy deploys nothing new but still manages its positions
+    enabled: bool = True
+    params: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON))
+
+
+class WorkerLease(SQLModel, table=True):
+    """A trading app worker, alive for as long as it renews its heartbeat"""
+
+    worker_id: str = Field(primary_key=True)
+    started_at: datetime = Field(sa_column=Column(DateTime(timezone=True)))
+    heartbeat: datetime = Field(sa_column=Column(DateTime(timezone=True)))
+    # The symbols the worker needs the LTPs of
+    symbols: List[str] = Field(default_factory=list, sa_column=Column(JSON))
+
+
+class SharedQuote(SQLModel, table=True):
+    """The last LTP of a symbol, fetched by the leading worker for all of them"""
+
+    symbol: str = Field(primary_key=True)
+    ltp: float
+    fetched_at: datetime = Field(sa_column=Column(DateTime(timezone=True)))
+
+
+class RiskSnapshot(SQLModel, table=True):
+    """The last risk report of a trading app worker, covering its clients"""
+
+    worker_id: str = Field(primary_key=True)
+    report: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON))
+    computed_at: datetime = Field(sa_column=Column(DateTime(timezone=True)))
+
+
+class LiveState(SQLModel, table=True):
+    """The positions and P&L of a client, as its trading app worker last saw them"""
+
+    client_id: str = Field(primary_key=True)
+    state: Dict[str, Any] = Field(default_factory=dict, sa_column=Column(JSON))
+    updated_at: datetime = Field(sa_column=Column(DateTime(timezone=True), index=True))
 
 
 class Instruments(SQLModel, table=True):
     trading_symbol: str = Field(primary_key=True)
-    instrument_key: str
+    instrument_key: str = Field(index=True)
 
 
 class IronFly(SQLModel, table=True):
+    __table_args__ = (
+        # Every job only looks at the rows that are still in play
+        Index(
+            "ix_ironfly_not_closed",
+            "client_id",
+            "strike",
+            postgresql_where=text("status <> 'CLOSED'"),
+        ),
+        Index(
+            "ix_ironfly_sell_ce_unfilled",
+            "sell_ce_status",
+            postgresql_where=text("sell_ce_status <> 'complete'"),
+        ),
+        Index(
+            "ix_ironfly_sell_pe_unfilled",
+            "sell_pe_status",
+            postgresql_where=text("sell_pe_status <> 'complete'"),
+        ),
+    )
+
     id: str = Field(default_factory=lambda: token_hex(3), primary_key=True)
     created_at: str = Field(default_factory=now)
     modified_at: str = Field(default_factory=now)
-    client_id: str = Field(foreign_key="credentials.client_id")
+    client_id: str = Field(foreign_key="credentials.client_id", index=True)
     week: Optional[str] = "N/A"
 
-    buy_ce_order_id: Optional[str]
+    buy_ce_order_id: Optional[str] = Field(default=None, index=True)
     buy_ce_symbol: Optional[str]
     buy_ce_price: Optional[float]
     buy_ce_status: Optional[str]
     buy_ce_message: Optional[str]
 
-    buy_pe_order_id: Optional[str]
+    buy_pe_order_id: Optional[str] = Field(default=None, index=True)
     buy_pe_symbol: Optional[str]
     buy_pe_price: Optional[float]
     buy_pe_status: Optional[str]
     buy_pe_message: Optional[str]
 
-    sell_ce_order_id: Optional[str]
+    sell_ce_order_id: Optional[str] = Field(default=None, index=True)
     sell_ce_symbol: Optional[str]
     sell_ce_price: Optional[float]
     sell_ce_status: Optional[str]
     sell_ce_message: Optional[str]
 
-    sell_pe_order_id: Optional[str]
+    sell_pe_order_id: Optional[str] = Field(default=None, index=True)
     sell_pe_symbol: Optional[str]
     sell_pe_price: Optional[float]
     sell_pe_status: Optional[str]
@@ -121,73 +187,87 @@ class IronFly(SQLModel, table=True):
     low_sl: Optional[float]
     adj_status: Optional[str]
     sl_status: Optional[str]
-    status: Optional[str]
+    status: Optional[str] = Field(default=None, index=True)
 
 
 class Client:
     last_op = dict()  # Denotes the last operation, required for closing orders
 
-    def __init__(self, client_id: str) -> None:
-        database = get_session()
+    def __init__(
+        self,
+        client_id: str,
+        access_token: str,
+        strategies: Optional[Dict[str, ClientStrategy]] = None,
+    ) -> None:
         self.client_id = client_id
-        self.access_token = database.get(Credentials, client_id).access_token
-        self.strategy = database.get(Strategies, client_id)
+        self.access_token = access_token
+        self.strategies = strategies or dict()
         Client.last_op[client_id] = dict()
 
+    def lots(self, strategy: str) -> int:
+        """Return the lots the client trades the strategy with, 0 if none"""
+        config = self.strategies.get(strategy)
+        return config.lots if config is not None else 0
+
+    def trades(self, strategy: str, underlying: str = NIFTY) -> bool:
+        """Return whether new positions of the strategy are deployed for it"""
+        config = self.strategies.get(strategy)
+        return (
+            config is not None
+            and config.enabled
+            and config.lots > 0
+            and config.underlying == underlying
+        )
+
     def fetch_orders(self) -> List[FetchedOrder]:
         try:
-            response = get_request(
-                url="https://api.upstox.com/v2/order/retrieve-all",
-                headers={
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {self.access_token}",
-                },
-            )
+            response = broker.get("/order/retrieve-all", self.access_token)
             return [FetchedOrder(**order) for order in response.json()["data"]]
         except Exception as e:
             print("Error while fetching client orders", str(e))
 
     def update_entry_price(self, tradingsymbol: str, price: float):
-        database = get_session()
-        row = database.exec(
-            select(IronFly).where(IronFly.client_id == self.client_id)
-        ).first()
-        column_name: str = next(
-            filter(
-                lambda column: getattr(row, column) == tradingsymbol,
-                (
-                    "buy_ce_symbol",
-                    "buy_pe_symbol",
-                    "sell_ce_symbol",
-                    "sell_pe_symbol",
-                ),
-            )
-        )
-        setattr(row, column_name.replace("_symbol", "_price"), price)
-        if (
-            row.sell_pe_status
-            == row.buy_ce_status
-            == row.buy_pe_status
-            == row.sell_ce_status
-            == Status.COMPLETE
-        ):
-            row.status = Status.COMPLETE
-            row.total = (
-                row.sell_ce_price
-                + row.sell_pe_price
-                - row.buy_ce_price
-                - row.buy_pe_price
+        with session_scope() as database:
+            row = database.exec(
+                select(IronFly).where(IronFly.client_id == self.client_id)
+            ).first()
+            column_name: str = next(
+                filter(
+                    lambda column: getattr(row, column) == tradingsymbol,
+                    (
+                        "buy_ce_symbol",
+                        "buy_pe_symbol",
+                        "sell_ce_symbol",
+                        "sell_pe_symbol",
+                    ),
+                )
             )
-            row.high_adj = row.total + 0.7 * row.total + row.strike
-            row.low_adj = row.total - 0.7 * row.total + row.strike
-            row.high_sl = 1.5 * row.sell_ce_price
-            row.low_sl = 1.5 * row.sell_pe_price
-        row.save()
-
-    def place_multiple_orders(self, *args: Order) -> List[Dict[str, str]]:
+            setattr(row, column_name.replace("_symbol", "_price"), price)
+            if (
+                row.sell_pe_status
+                == row.buy_ce_status
+                == row.buy_pe_status
+                == row.sell_ce_status
+                == Status.COMPLETE
+            ):
+                row.status = Status.COMPLETE
+                row.total = (
+                    row.sell_ce_price
+                    + row.sell_pe_price
+                    - row.buy_ce_price
+                    - row.buy_pe_price
+                )
+                row.high_adj = row.total + 0.7 * row.total + row.strike
+                row.low_adj = row.total - 0.7 * row.total + row.strike
+                row.high_sl = 1.5 * row.sell_ce_price
+                row.low_sl = 1.5 * row.sell_pe_price
+
+    def place_multiple_orders(
+        self, *args: Order, strategy: str, priority: Priority = Priority.ENTRY
+    ) -> List[Dict[str, str]]:
         data: List[Order] = list()
         for order in args:
-            order.quantity = self.strategy.iron_fly * 75
+            order.quantity = self.lots(strategy) * LOT_SIZE
             order.correlation_id = "_".join(
                 (
                     order.transaction_type,
@@ -196,14 +276,8 @@ class Client:
             ).lower()
             data.append(order.model_dump())
         try:
-            response = post_request(
-                url="https://api.upstox.com/v2/order/multi/place",
-                json=data,
-                headers={
-                    "Content-Type": "application/json",
-                    "Accept": "application/json",
-                    "Authorization": f"Bearer {self.access_token}",
-                },
+            response = broker.post(
+                "/order/multi/place", self.access_token, json=data, priority=priority
             )
 
             order_ids = response.json()["data"]
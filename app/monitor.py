@@ -0,0 +1,118 @@
+from collections import defaultdict
+from threading import Lock
+from time import perf_counter
+from typing import Callable, Dict, Set
+
+from bus import bus
+from config import NIFTY
+from database import session_scope
+from engine import engine
+from enums import Status
+from logger import logger as log
+from metrics import tick_to_order
+from models import IronFly, now
+from persistence import save_changes
+from shard import shards
+from sqlmodel import select
+
+# The columns a check may change
+CHECKED = ("sl_status", "adj_status", "status")
+
+
+class StopLossMonitor:
+    """Checks stoplosses and adjustments as soon as a relevant tick arrives.
+
+    The complete rows are kept in memory and indexed by the symbols of their
+    sold legs. A tick on one of those symbols only re-evaluates the rows that
+    hold it, while a NIFTY tick re-evaluates every row for the adjustment. The
+    ticks come from the market bus, which also keeps the latest LTPs.
+    """
+
+    def __init__(
+        self,
+        evaluate: Callable[[IronFly, Dict[str, float], float], None],
+        ltps: Dict[str, float],
+    ) -> None:
+        self._evaluate = evaluate
+        self.ltps = ltps
+        self._lock = Lock()
+        self._rows: Dict[str, IronFly] = dict()
+        self._row_locks: Dict[str, Lock] = dict()
+        self._rows_by_symbol: Dict[str, Set[str]] = dict()
+        self._pending: Set[str] = set()
+        # When the oldest tick a pending row has not been checked against arrived
+        self._ticked_at: Dict[str, float] = dict()
+
+    def refresh(self) -> Set[str]:
+        """Reload the complete rows and return the symbols they need"""
+        with session_scope() as database:
+            rows = database.exec(
+                select(IronFly)
+                .where(IronFly.status == Status.COMPLETE)
+                .where(shards.where(IronFly.client_id))
+            ).all()
+            database.expunge_all()
+        with self._lock:
+            # Rows that are already tracked keep their in-memory state
+            tracked = {row.id: self._rows.get(row.id, row) for row in rows}
+            rows_by_symbol = defaultdict(set)
+            for row in tracked.values():
+                rows_by_symbol[row.sell_ce_symbol].add(row.id)
+                rows_by_symbol[row.sell_pe_symbol].add(row.id)
+            self._row_locks = {
+                row_id: self._row_locks.get(row_id, Lock()) for row_id in tracked
+            }
+            self._rows, self._rows_by_symbol = tracked, dict(rows_by_symbol)
+        return {NIFTY, *rows_by_symbol} if rows_by_symbol else set()
+
+    def on_tick(self, symbol: str, ltp: float) -> None:
+        ticked_at = perf_counter()
+        with self._lock:
+            if symbol == NIFTY:
+                row_ids = set(self._rows)
+            else:
+                row_ids = self._rows_by_symbol.get(symbol, set())
+            # Rows that are already waiting to be checked will see this tick too
+            row_ids = row_ids - self._pending
+            self._pending |= row_ids
+            self._ticked_at.update(dict.fromkeys(row_ids, ticked_at))
+        for row_id in row_ids:
+            engine.spawn(self._check, row_id)
+
+    def _check(self, row_id: str) -> None:
+        with self._lock:
+            self._pending.discard(row_id)
+            ticked_at = self._ticked_at.pop(row_id, None)
+            row = self._rows.get(row_id)
+            row_lock = self._row_locks.get(row_id)
+        if row is None:
+            return
+        with row_lock:
+            if row.status != Status.COMPLETE:
+                return
+            ltps = dict(self.ltps)
+            if not {row.sell_ce_symbol, row.sell_pe_symbol, NIFTY} <= ltps.keys():
+                return
+            before = {name: getattr(row, name) for name in CHECKED}
+            self._evaluate(row, ltps, ltps[NIFTY])
+            changed = {
+                name: getattr(row, name)
+                for name in CHECKED
+                if getattr(row, name) != before[name]
+            }
+            if not changed:
+                return
+            # The row only changes once its exit orders have been placed
+            if ticked_at is not None:
+                tick_to_order.observe(perf_counter() - ticked_at)
+            row.modified_at = changed["modified_at"] = now()
+            with session_scope() as database:
+                saved = save_changes(database, IronFly, [(row.id, before, changed)])
+            if not saved:
+                # Checked by the poll in the meantime, it is loaded again
+                with self._lock:
+                    self._rows.pop(row_id, None)
+                log.warning("Row changed while checking", row=row.id)
+                return
+            log.info("Saved row after tick", row=row.id, sl_status=row.sl_status)
+            bus.publish_rows({row.client_id})
@@ -0,0 +1,198 @@
+"""Order updates of the iron fly legs, pushed by Upstox or polled.
+
+Upstox posts every change of an order to the postback URL of the app, which
+the API receives at `/postback`. Each event is matched to the row holding its
+order id through the per-leg order id indexes and applied to that leg in
+place. Downloading the order books of all the clients is only kept as a
+reconciliation every `ORDER_RECONCILE_INTERVAL` minutes, for events that
+never arrived.
+
+Every leg whose status changes is announced on the `orders` channel when its
+row is committed, which is how the postbacks received by the API reach the
+strategies running in the trading app.
+"""
+
+import json
+from typing import Dict, List, NamedTuple, Optional
+
+from database import Session, session_scope
+from enums import Status
+from logger import logger as log
+from metrics import order_events
+from models import FetchedOrder, IronFly
+from persistence import Changes
+from pydantic import BaseModel
+from rules import exit_levels
+from sqlalchemy import text
+from sqlmodel import col, or_, select
+
+LEGS = "buy_ce", "buy_pe", "sell_ce", "sell_pe"
+# Order statuses that never change again
+FINISHED = ("complete", "rejected", "cancelled")
+CHANNEL = "orders"
+
+
+class OrderUpdate(NamedTuple):
+    """A leg whose order changed status"""
+
+    row_id: str
+    client_id: str
+    leg: str
+    order_id: str
+    status: str
+
+    def payload(self) -> str:
+        return json.dumps(self._asdict())
+
+    @classmethod
+    def parse(cls, payload: str) -> "OrderUpdate":
+        return cls(**json.loads(payload))
+
+
+class OrderEvent(BaseModel):
+    """An order update posted by Upstox, the other fields are ignored"""
+
+    order_id: str
+    status: str
+    status_message: Optional[str] = None
+    average_price: float = 0.0
+    update_type: str = "order"
+
+
+def leg_of(row: IronFly, order_id: str) -> Optional[str]:
+    for leg in LEGS:
+        if getattr(row, f"{leg}_order_id") == order_id:
+            return leg
+    return None
+
+
+def notify(database: Session, update: OrderUpdate) -> None:
+    """Announce the update once the session commits"""
+    database.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": CHANNEL, "payload": update.payload()},
+    )
+
+
+def apply_order(row: IronFly, leg: str, order: FetchedOrder | OrderEvent) -> bool:
+    """Copy the state of an order to its leg and return False for a stale one"""
+    status = getattr(row, f"{leg}_status")
+    if status in FINISHED and order.status != status:
+        # Events may arrive out of order, a finished order stays finished
+        return False
+    if order.status == Status.COMPLETE:
+        setattr(row, f"{leg}_price", order.average_price)
+    if status != order.status:
+        setattr(row, f"{leg}_status", order.status)
+    if getattr(row, f"{leg}_message") != order.status_message:
+        setattr(row, f"{leg}_message", order.status_message)
+    return True
+
+
+def complete_row(row: IronFly) -> None:
+    """Mark the row complete and compute its levels once all its legs filled"""
+    if (
+        row.sell_pe_status
+        == row.buy_ce_status
+        == row.buy_pe_status
+        == row.sell_ce_status
+        == Status.COMPLETE
+    ):
+        log.debug("All orders are complete")
+        row.status = Status.COMPLETE
+        row.total, row.high_adj, row.low_adj, row.high_sl, row.low_sl = exit_levels(
+            row.strike,
+            row.sell_ce_price,
+            row.sell_pe_price,
+            row.buy_ce_price,
+            row.buy_pe_price,
+        )
+        log.info("Computed values are updated")
+
+
+def update_row(row: IronFly, orders: Dict[str, FetchedOrder]) -> List[OrderUpdate]:
+    """Copy the state of the row's orders from the client's order book.
+
+    Returns the legs whose status changed.
+    """
+    row_orders: List[FetchedOrder] = list()
+    for leg in LEGS:
+        order_id = getattr(row, f"{leg}_order_id")
+        if order_id not in orders:
+            log.warning(
+                "Order not found in order book",
+                row_id=row.id,
+                client=row.client_id,
+                leg=leg,
+                order_id=order_id,
+            )
+            continue
+        row_orders.append(orders[order_id])
+
+    log.info(
+        "Fetched row orders",
+        client=row.client_id,
+        order_ids=[order.order_id for order in row_orders],
+    )
+    updates: List[OrderUpdate] = list()
+    for order in row_orders:
+        log.info("Updating order", order_id=order.order_id, client=row.client_id)
+        leg = leg_of(row, order.order_id)
+        status = getattr(row, f"{leg}_status")
+        if apply_order(row, leg, order) and status != order.status:
+            updates.append(
+                OrderUpdate(row.id, row.client_id, leg, order.order_id, order.status)
+            )
+
+    log.info("Checking if all row orders are complete")
+    complete_row(row)
+    return updates
+
+
+def apply_event(event: OrderEvent) -> str:
+    """Apply a posted order update to the open row holding it"""
+    if event.update_type != "order":
+        result = "ignored"
+    else:
+        with session_scope() as database:
+            # Locked until the commit, so the reconciliation writing the row
+            # meanwhile finds it changed rather than overwriting the event
+            rows = Changes(
+                database,
+                select(IronFly)
+                .where(
+                    IronFly.status == Status.OPEN,
+                    or_(
+                        *(
+                            col(getattr(IronFly, f"{leg}_order_id")) == event.order_id
+                            for leg in LEGS
+                        )
+                    ),
+                )
+                .with_for_update(),
+            )
+            result = "unknown"
+            for row in rows:
+                leg = leg_of(row, event.order_id)
+                status = getattr(row, f"{leg}_status")
+                if apply_order(row, leg, event):
+                    complete_row(row)
+                    result = "applied"
+                    if status != event.status:
+                        notify(
+                            database,
+                            OrderUpdate(
+                                row.id, row.client_id, leg, event.order_id, event.status
+                            ),
+                        )
+                else:
+                    result = "stale"
+            rows.save(database)
+    order_events.labels(result).inc()
+    log.info(
+        "Received order update",
+        order_id=event.order_id,
+        status=event.status,
+        result=result,
+    )
+    return result
@@ -0,0 +1,152 @@
+from collections import defaultdict
+from typing import Any, Dict, Generic, List, Set, Tuple, Type, TypeVar
+
+from database import Session, SQLModel
+from models import now
+from sqlalchemy import cast, column, update, values
+from sqlmodel.sql.expression import SelectOfScalar
+
+Row = TypeVar("Row", bound=SQLModel)
+
+# Written with every change, but never compared
+TOUCHED = "modified_at"
+
+
+def _values(row: SQLModel) -> Dict[str, Any]:
+    # Some integer columns, like the ironfly totals, are assigned floats
+    return row.model_dump(warnings=False)
+
+
+def _differences(loaded: Dict[str, Any], current: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        name: value
+        for name, value in current.items()
+        if name != TOUCHED and loaded.get(name) != value
+    }
+
+
+def save_changes(
+    database: Session,
+    model: Type[Row],
+    changes: List[Tuple[Any, Dict[str, Any], Dict[str, Any]]],
+) -> Set[Any]:
+    """Write the changed columns of the rows that still hold the loaded values.
+
+    `changes` holds the primary key of every row, its values when the caller
+    loaded it and the columns the caller changed, with their new values. The
+    rows with the same changed columns are written by one UPDATE from a
+    VALUES list. A row whose changed columns were written by someone else in
+    the meantime does not match and is left as it is. Returns the keys of the
+    rows written.
+    """
+    table = model.__table__
+    (key,) = table.primary_key.columns
+    groups: Dict[Tuple[str, ...], list] = defaultdict(list)
+    for row_key, loaded, changed in changes:
+        groups[tuple(sorted(changed))].append((row_key, loaded, changed))
+    saved: Set[Any] = set()
+    for written, group in groups.items():
+        names = [name for name in written if name != TOUCHED]
+        data = values(
+            column("key", key.type),
+            *(column(f"old_{name}", table.c[name].type) for name in names),
+            *(column(f"new_{name}", table.c[name].type) for name in written),
+            name="changes",
+        ).data(
+            [
+                (
+                    row_key,
+                    *(loaded[name] for name in names),
+                    *(changed[name] for name in written),
+                )
+                for row_key, loaded, changed in group
+            ]
+        )
+        statement = (
+            update(table)
+            .where(key == data.c.key)
+            .where(
+                # A NULL in the VALUES list has no type of its own
+                *(
+                    table.c[name].is_not_distinct_from(
+                        cast(data.c[f"old_{name}"], table.c[name].type)
+                    )
+                    for name in names
+                )
+            )
+            .values(
+                {
+                    name: cast(data.c[f"new_{name}"], table.c[name].type)
+                    for name in written
+                }
+            )
+            .returning(key)
+        )
+        saved.update(database.execute(statement).scalars())
+    return saved
+
+
+class Changes(Generic[Row]):
+    """Rows loaded for a job, written back only where the job changed them.
+
+    The rows are detached from the session as soon as they are loaded so that
+    committing never flushes them one by one. `save` compares every row with
+    the copy taken at load time and sends the columns the job changed, and
+    only those, with `save_changes`. The connection is not held while the job
+    runs, so a postback or the stoploss monitor may write a row in between:
+    the job's change of such a row is not written and the row is kept in
+    `conflicts` instead, for the job to skip it or load it again. The rows
+    written are kept in `saved`.
+    """
+
+    def __init__(self, database: Session, statement: SelectOfScalar[Row]) -> None:
+        self.rows: List[Row] = database.exec(statement).all()
+        for row in self.rows:
+            database.expunge(row)
+        self._loaded = [_values(row) for row in self.rows]
+        self.saved: List[Row] = list()
+        self.conflicts: List[Row] = list()
+
+    def __bool__(self) -> bool:
+        return bool(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def changed(self) -> List[Tuple[Row, Dict[str, Any]]]:
+        """Return every row that differs from when it was loaded, with the columns"""
+        changed = list()
+        for row, loaded in zip(self.rows, self._loaded):
+            differences = _differences(loaded, _values(row))
+            if not differences:
+                continue
+            if TOUCHED in loaded:
+                differences[TOUCHED] = now()
+                setattr(row, TOUCHED, differences[TOUCHED])
+            changed.append((row, differences))
+        return changed
+
+    def save(self, database: Session) -> int:
+        """Write the changed rows back and return how many were written"""
+        changed = self.changed()
+        if not changed:
+            return 0
+        model: Type[Row] = type(self.rows[0])
+        (key,) = model.__table__.primary_key.columns
+        snapshots = {id(row): loaded for row, loaded in zip(self.rows, self._loaded)}
+        saved = save_changes(
+            database,
+            model,
+            [
+                (getattr(row, key.name), snapshots[id(row)], differences)
+                for row, differences in changed
+            ],
+        )
+        self.saved, self.conflicts = list(), list()
+        for row, _ in changed:
+            if getattr(row, key.name) in saved:
+                snapshots[id(row)].update(_values(row))
+                self.saved.append(row)
+            else:
+                self.conflicts.append(row)
+        return len(saved)
@@ -0,0 +1,165 @@
+"""Outbound scheduling of the Upstox calls made with every access token.
+
+Upstox limits the requests of every access token, separately for orders,
+market quotes and everything else. Each (token, endpoint class) pair gets a
+token bucket, and when a bucket runs dry its waiting calls are let through by
+lane: stoploss and adjustment exits first, then new entries, modifications
+and finally quote and order book polling. A burst of re-quotes can therefore
+never hold up an exit.
+
+The buckets adapt to what Upstox reports. A 429 or a `Retry-After` header
+pauses the bucket, and the `X-RateLimit-Remaining`/`X-RateLimit-Reset`
+headers lower the tokens left when Upstox has counted more calls than we did.
+"""
+
+import heapq
+from itertools import count
+from threading import Condition, Lock
+from time import monotonic, time
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from config import get_settings
+from enums import Priority
+from metrics import register_stats, upstox_queue_delay
+
+ORDER = "order"
+QUOTE = "quote"
+READ = "read"
+
+
+def seconds(value: Optional[str]) -> Optional[float]:
+    """Return the delay a `Retry-After` or reset header stands for"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    # Resets are sent either as a delay or as the epoch second of the reset
+    return max(0.0, number - time() if number > 1e9 else number)
+
+
+class PriorityBucket:
+    """Token bucket that hands its tokens to the most urgent waiting call"""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._paused_until = 0.0
+        self._waiting: List[Tuple[int, int]] = list()
+        self._order = count()
+        self._condition = Condition()
+
+    def _refill(self, current: float) -> None:
+        if current < self._paused_until:
+            self._updated = current
+            return
+        elapsed = current - max(self._updated, self._paused_until)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._updated = current
+
+    def acquire(self, priority: int) -> float:
+        """Block until the call may be sent and return how long it waited"""
+        started = monotonic()
+        with self._condition:
+            ticket = (priority, next(self._order))
+            heapq.heappush(self._waiting, ticket)
+            while True:
+                current = monotonic()
+                self._refill(current)
+                if self._waiting[0] != ticket:
+                    # Calls ahead of this one wake it up once they are through
+                    self._condition.wait()
+                elif current < self._paused_until:
+                    self._condition.wait(self._paused_until - current)
+                elif self._tokens < 1:
+                    self._condition.wait((1 - self._tokens) / self.rate)
+                else:
+                    self._tokens -= 1
+                    heapq.heappop(self._waiting)
+                    self._condition.notify_all()
+                    return monotonic() - started
+
+    def pause(self, delay: float) -> None:
+        """Send nothing for `delay` seconds, e.g. after Upstox answered a 429"""
+        with self._condition:
+            self._tokens = 0.0
+            self._paused_until = max(self._paused_until, monotonic() + delay)
+
+    def limit(self, remaining: int, reset: Optional[float]) -> None:
+        """Never assume more calls are left than Upstox says there are"""
+        with self._condition:
+            self._refill(monotonic())
+            self._tokens = min(self._tokens, float(remaining))
+        if remaining <= 0:
+            self.pause(reset if reset is not None else 1 / self.rate)
+
+    def waiting(self) -> int:
+        with self._condition:
+            return len(self._waiting)
+
+
+class RequestScheduler:
+    """One priority bucket per access token and endpoint class"""
+
+    def __init__(self, limits: Mapping[str, Tuple[float, int]]) -> None:
+        self.limits = dict(limits)
+        self._buckets: Dict[Tuple[str, str], PriorityBucket] = dict()
+        self._lock = Lock()
+        self._stats = {"delayed": 0, "delayed_seconds": 0.0, "throttled": 0}
+
+    def bucket(self, access_token: str, kind: str) -> PriorityBucket:
+        with self._lock:
+            bucket = self._buckets.get((access_token, kind))
+            if bucket is None:
+                bucket = self._buckets[(access_token, kind)] = PriorityBucket(
+                    *self.limits[kind]
+                )
+            return bucket
+
+    def acquire(self, access_token: str, kind: str, priority: Priority) -> float:
+        """Wait for the turn of a call and return how long it waited"""
+        waited = self.bucket(access_token, kind).acquire(priority)
+        upstox_queue_delay.labels(priority.name.lower()).observe(waited)
+        if waited > 0.001:
+            with self._lock:
+                self._stats["delayed"] += 1
+                self._stats["delayed_seconds"] += waited
+        return waited
+
+    def adapt(
+        self,
+        access_token: str,
+        kind: str,
+        status_code: int,
+        headers: Mapping[str, str],
+    ) -> None:
+        """Adjust the bucket of the call to the limits Upstox reported"""
+        bucket = self.bucket(access_token, kind)
+        retry_after = seconds(headers.get("Retry-After"))
+        if status_code == 429 or retry_after is not None:
+            if status_code == 429:
+                with self._lock:
+                    self._stats["throttled"] += 1
+            bucket.pause(retry_after if retry_after is not None else 1.0)
+        remaining = headers.get("X-RateLimit-Remaining")
+        if remaining is not None and remaining.isdigit():
+            bucket.limit(int(remaining), seconds(headers.get("X-RateLimit-Reset")))
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            buckets = list(self._buckets.values())
+            stats = {**self._stats, "buckets": len(buckets)}
+        stats["waiting"] = sum(bucket.waiting() for bucket in buckets)
+        return stats
+
+
+settings = get_settings()
+scheduler = RequestScheduler(
+    {
+        ORDER: (settings.order_rate_limit, settings.order_rate_burst),
+        QUOTE: (settings.quote_rate_limit, settings.quote_rate_burst),
+        READ: (settings.read_rate_limit, settings.read_rate_burst),
+    }
+)
+register_stats("request_scheduler", scheduler.stats)
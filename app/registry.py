@@ -0,0 +1,195 @@
+from collections import defaultdict
+from select import select as wait_readable
+from threading import Lock, Thread
+from time import sleep
+from typing import Callable, Dict, List, Optional
+
+from database import Session, engine, session_scope
+from logger import logger as log
+from models import Client, ClientStrategy, Credentials
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from sqlalchemy import text
+from sqlmodel import select
+
+CHANNEL = "credentials"
+ALL = "*"
+
+
+def notify(database: Session, client_id: str = ALL) -> None:
+    """Tell every registry to reload the given client once the session commits"""
+    database.execute(
+        text("SELECT pg_notify(:channel, :client_id)"),
+        {"channel": CHANNEL, "client_id": client_id},
+    )
+
+
+class ClientRegistry:
+    """In-process copy of the credentials and strategies of every client.
+
+    The registry is loaded on first use and then kept up to date through
+    Postgres notifications, so access tokens and strategies are looked up
+    without touching the database. Other modules can follow channels of their
+    own over the same listening connection with `listen`. Notifications sent
+    while the connection was down are lost, so every channel has a resync
+    that catches up on them once it is listening again.
+    """
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._clients: Dict[str, Client] = dict()
+        self._active: Dict[str, bool] = dict()
+        self._loaded = False
+        # Bumped with every change, for caches of what depends on the clients
+        self.version = 0
+        self._listener: Optional[Thread] = None
+        self._channels: Dict[str, Callable[[str], None]] = {CHANNEL: self._on_notify}
+        self._resyncs: Dict[str, Callable[[], None]] = {CHANNEL: self.load}
+
+    def load(self) -> None:
+        """Reload every client from the database"""
+        with session_scope() as database:
+            credentials = database.exec(select(Credentials)).all()
+            strategies = defaultdict(dict)
+            for config in database.exec(select(ClientStrategy)).all():
+                strategies[config.client_id][config.strategy] = config
+            database.expunge_all()
+        clients = {
+            row.client_id: Client(
+                row.client_id, row.access_token, strategies.get(row.client_id)
+            )
+            for row in credentials
+        }
+        active = {row.client_id: row.is_active == 1 for row in credentials}
+        with self._lock:
+            self._clients, self._active = clients, active
+            self._loaded = True
+            self.version += 1
+        log.info("Loaded clients", count=len(clients))
+
+    def refresh(self, client_id: str) -> None:
+        """Reload a single client from the database"""
+        with session_scope() as database:
+            credentials = database.get(Credentials, client_id)
+            strategies = {
+                config.strategy: config
+                for config in database.exec(
+                    select(ClientStrategy).where(ClientStrategy.client_id == client_id)
+                )
+            }
+            database.expunge_all()
+        with self._lock:
+            if credentials is None:
+                self._clients.pop(client_id, None)
+                self._active.pop(client_id, None)
+            else:
+                self._clients[client_id] = Client(
+                    client_id, credentials.access_token, strategies
+                )
+                self._active[client_id] = credentials.is_active == 1
+            self.version += 1
+        log.info("Refreshed client", client=client_id)
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.load()
+
+    def get(self, client_id: str) -> Client:
+        self._ensure_loaded()
+        try:
+            return self._clients[client_id]
+        except KeyError:
+            raise Exception("The client does not exist!")
+
+    def client_ids(self) -> List[str]:
+        self._ensure_loaded()
+        with self._lock:
+            return list(self._clients)
+
+    def access_token(self, client_id: str) -> str:
+        return self.get(client_id).access_token
+
+    def active(self) -> List[Client]:
+        """Return the clients that are currently logged in"""
+        self._ensure_loaded()
+        with self._lock:
+            return [
+                client
+                for client_id, client in self._clients.items()
+                if self._active.get(client_id)
+            ]
+
+    def trading(self, strategy: str, underlying: str) -> List[Client]:
+        """Return the logged in clients that deploy the strategy"""
+        return [
+            client for client in self.active() if client.trades(strategy, underlying)
+        ]
+
+    def listen(
+        self,
+        channel: str,
+        handler: Callable[[str], None],
+        resync: Optional[Callable[[], None]] = None,
+    ) -> None:
+        """Call the handler with the payload of every notification on the channel.
+
+        The resync is called whenever the channel is listened to again, as
+        notifications may have been missed in between. Only channels added
+        before `start` are listened to.
+        """
+        self._channels[channel] = handler
+        if resync is not None:
+            self._resyncs[channel] = resync
+
+    def _on_notify(self, payload: str) -> None:
+        if payload == ALL:
+            self.load()
+        else:
+            self.refresh(payload)
+
+    def _listen(self) -> None:
+        while True:
+            connection = None
+            try:
+                # The listening connection is taken out of the pool for good
+                pooled = engine.raw_connection()
+                connection = pooled.driver_connection
+                pooled.detach()
+                connection.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+                for channel in self._channels:
+                    connection.cursor().execute(f"LISTEN {channel}")
+                # Notifications may have been missed while disconnected
+                for channel, resync in list(self._resyncs.items()):
+                    self._call(channel, resync)
+                while True:
+                    if not wait_readable([connection], [], [], 60)[0]:
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notification = connection.notifies.pop(0)
+                        self._call(
+                            notification.channel,
+                            self._channels[notification.channel],
+                            notification.payload,
+                        )
+            except Exception:
+                log.exception("Client registry lost its listening connection")
+                if connection is not None:
+                    connection.close()
+                sleep(5)
+
+    @staticmethod
+    def _call(channel: str, handler: Callable, *args) -> None:
+        # A failing handler must not cost the others the listening connection
+        try:
+            handler(*args)
+        except Exception:
+            log.exception("Error while handling a notification", channel=channel)
+
+    def start(self) -> None:
+        """Start following the notifications in the background"""
+        if self._listener is None:
+            self._listener = Thread(target=self._listen, name="registry", daemon=True)
+            self._listener.start()
+
+
+clients = ClientRegistry()
@@ -0,0 +1,115 @@
+"""Replays Upstox order updates against the postback route of the API.
+
+    uv run app/replay_postbacks.py events.jsonl --speed 10
+    uv run app/replay_postbacks.py --fill --price 100
+
+With a file, every event in it (one JSON object per line, as Upstox posts
+them) is sent in order, keeping the gaps between their `order_timestamp`s
+divided by `--speed`. With `--fill`, a `complete` event is made up for every
+unfinished leg of the open rows in the configured database, filling them
+the way Upstox would.
+"""
+
+import json
+import sys
+from argparse import ArgumentParser
+from datetime import datetime
+from time import sleep
+from typing import Iterator, List, Optional
+
+import httpx
+
+
+def read_events(path: str) -> List[dict]:
+    with open(path) as events:
+        return [json.loads(line) for line in events if line.strip()]
+
+
+def fill_events(price: float) -> List[dict]:
+    """Return a complete event for every unfinished leg of the open rows"""
+    # Only this mode needs the database settings
+    from database import session_scope
+    from enums import Status
+    from models import IronFly
+    from orders import FINISHED, LEGS
+    from sqlmodel import select
+
+    timestamp = datetime.now().isoformat(sep=" ", timespec="seconds")
+    events = list()
+    with session_scope() as database:
+        rows = database.exec(select(IronFly).where(IronFly.status == Status.OPEN))
+        for row in rows:
+            for leg in LEGS:
+                order_id = getattr(row, f"{leg}_order_id")
+                if order_id is None or getattr(row, f"{leg}_status") in FINISHED:
+                    continue
+                events.append(
+                    {
+                        "update_type": "order",
+                        "user_id": row.client_id,
+                        "order_id": order_id,
+                        "trading_symbol": getattr(row, f"{leg}_symbol"),
+                        "transaction_type": leg.split("_")[0].upper(),
+                        "status": "complete",
+                        "status_message": None,
+                        "average_price": getattr(row, f"{leg}_price") or price,
+                        "order_timestamp": timestamp,
+                    }
+                )
+    return events
+
+
+def timestamp(event: dict) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(event["order_timestamp"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def paced(events: List[dict], speed: float) -> Iterator[dict]:
+    """Yield the events with the gaps they were posted with"""
+    previous = None
+    for event in events:
+        current = timestamp(event)
+        if speed and previous is not None and current is not None:
+            sleep(max(0.0, (current - previous).total_seconds() / speed))
+        previous = current or previous
+        yield event
+
+
+def replay(
+    client: httpx.Client, url: str, events: List[dict], secret: str, speed: float
+) -> int:
+    """Post the events in order and return how many were refused"""
+    params = {"secret": secret} if secret else None
+    failed = 0
+    for event in paced(events, speed):
+        response = client.post(url, json=event, params=params)
+        if response.is_error:
+            failed += 1
+            print(event["order_id"], response.status_code, response.text)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("events", nargs="?")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/postback")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--fill", action="store_true")
+    parser.add_argument("--price", type=float, default=100.0)
+    arguments = parser.parse_args()
+    if arguments.events is None and not arguments.fill:
+        parser.error("give a file of events or --fill")
+    events = (
+        fill_events(arguments.price)
+        if arguments.fill
+        else read_events(arguments.events)
+    )
+    with httpx.Client() as client:
+        failed = replay(
+            client, arguments.url, events, arguments.secret, arguments.speed
+        )
+    print(f"Replayed {len(events)} order updates, {failed} failed")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,480 @@
+"""Implied volatility and Black-Scholes greeks of every open iron fly leg.
+
+The positions are the filled, not exited legs of every row that is not
+closed, bought legs long and sold legs short, sized by the client's lots.
+Rows do not record their quantity, so the lots come from the client's
+current iron fly configuration. The trading app subscribes the engine to the
+market bus, which values the book once a minute with the LTPs it fetches for
+the strategies anyway. The positions are kept between snapshots and only
+loaded again after an order update or an exit, or once the clients or the
+worker's share of them changed.
+
+Most rows share the same few strikes, so the implied volatility and greeks
+are solved once per instrument, as NumPy arrays. The volatilities of the last
+snapshot are the first guess of the next one, so the solver usually converges
+in two or three iterations. The exposure of every client is then the product
+of its net holdings of each instrument, kept as a matrix since the positions
+were loaded, with the greeks of the instruments.
+
+Every worker stores its report in the `risksnapshot` table and announces it
+on the `risk` channel. The API keeps the reports of the live workers in
+memory, so `/risk` neither queries the database nor calls the broker.
+"""
+
+import json
+from datetime import datetime, time, timedelta, timezone
+from threading import Lock
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+from bus import Subscriber
+from config import IRON_FLY, NIFTY, get_settings
+from database import session_scope
+from enums import Status
+from expiry import expiries
+from logger import logger as log
+from metrics import register_stats
+from models import IronFly, RiskSnapshot
+from orders import LEGS, OrderUpdate
+from registry import clients
+from rules import LOT_SIZE
+from shard import shards
+from sqlalchemy import text
+from sqlmodel import col, select
+
+GREEKS = ("delta", "gamma", "vega", "theta")
+CHANNEL = "risk"
+# The bus values the book every minute, an older report is of a dead worker
+REPORT_MAX_AGE = timedelta(minutes=5)
+# Contracts stop trading at 15:30 on their expiry day
+EXPIRY_TIME = time(15, 30)
+YEAR_SECONDS = 365 * 24 * 60 * 60
+# Floor on the time to expiry, so an expiring leg still has finite greeks
+MIN_YEARS = 60 / YEAR_SECONDS
+MIN_VOL, MAX_VOL = 1e-4, 5.0
+IV_TOLERANCE = 1e-4
+IV_ITERATIONS = 50
+
+
+def norm_pdf(x: np.ndarray) -> np.ndarray:
+    return np.exp(-0.5 * x * x) / np.sqrt(2 * np.pi)
+
+
+def norm_cdf(x: np.ndarray) -> np.ndarray:
+    """Standard normal CDF, Abramowitz and Stegun 7.1.26 (error below 1e-7)"""
+    z = np.abs(x) / np.sqrt(2)
+    t = 1 / (1 + 0.3275911 * z)
+    poly = t * (
+        0.254829592
+        + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429)))
+    )
+    erf = 1 - poly * np.exp(-z * z)
+    return 0.5 * (1 + np.sign(x) * erf)
+
+
+def d1_d2(spot, strike, years, vol, rate) -> Tuple[np.ndarray, np.ndarray]:
+    deviation = vol * np.sqrt(years)
+    d1 = (np.log(spot / strike) + (rate + 0.5 * vol * vol) * years) / deviation
+    return d1, d1 - deviation
+
+
+def bs_price(spot, strike, years, vol, rate, call) -> np.ndarray:
+    """Black-Scholes price of European calls (call True) and puts"""
+    d1, d2 = d1_d2(spot, strike, years, vol, rate)
+    discounted = strike * np.exp(-rate * years)
+    calls = spot * norm_cdf(d1) - discounted * norm_cdf(d2)
+    puts = discounted * norm_cdf(-d2) - spot * norm_cdf(-d1)
+    return np.where(call, calls, puts)
+
+
+def implied_vol(
+    price, spot, strike, years, rate, call, guess: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """Solve the volatilities of the prices, Newton steps kept inside a bracket.
+
+    A step that leaves the bracket is replaced by bisection, and every
+    iteration only works on the options that have not converged yet. Prices
+    outside the no-arbitrage bounds end up at MIN_VOL or MAX_VOL, missing
+    (NaN) prices at NaN.
+    """
+    price, strike, years, call = np.broadcast_arrays(
+        np.asarray(price, dtype=float), strike, years, call
+    )
+    root = np.sqrt(years)
+    drift = np.log(spot / strike) + rate * years
+    discounted = strike * np.exp(-rate * years)
+    # Puts are priced from the calls through put-call parity
+    parity = np.where(call, 0.0, spot - discounted)
+    low = np.full(price.shape, MIN_VOL)
+    high = np.full(price.shape, MAX_VOL)
+    vol = np.clip(
+        guess if guess is not None else np.sqrt(2 * np.pi / years) * price / spot,
+        MIN_VOL,
+        MAX_VOL,
+    )
+    vol[~np.isfinite(price)] = np.nan
+    active = np.flatnonzero(np.isfinite(price))
+    for _ in range(IV_ITERATIONS):
+        if not active.size:
+            break
+        sigma, sqrt_t = vol[active], root[active]
+        deviation = sigma * sqrt_t
+        d1 = drift[active] / deviation + 0.5 * deviation
+        model = (
+            spot * norm_cdf(d1)
+            - discounted[active] * norm_cdf(d1 - deviation)
+            - parity[active]
+        )
+        error = model - price[active]
+        # The price rises with the volatility
+        above = error > 0
+        floor = np.where(above, low[active], sigma)
+        ceiling = np.where(above, sigma, high[active])
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            step = sigma - error / (spot * norm_pdf(d1) * sqrt_t)
+        inside = np.isfinite(step) & (step > floor) & (step < ceiling)
+        converged = np.abs(error) < IV_TOLERANCE
+        vol[active] = np.where(
+            converged, sigma, np.where(inside, step, 0.5 * (floor + ceiling))
+        )
+        low[active], high[active] = floor, ceiling
+        active = active[~(converged | (ceiling - floor < IV_TOLERANCE))]
+    return vol
+
+
+def greeks(spot, strike, years, vol, rate, call) -> Dict[str, np.ndarray]:
+    """Greeks of one option: vega per volatility point and theta per day"""
+    d1, d2 = d1_d2(spot, strike, years, vol, rate)
+    density = norm_pdf(d1)
+    root = np.sqrt(years)
+    discounted = strike * np.exp(-rate * years)
+    decay = -spot * density * vol / (2 * root)
+    return {
+        "delta": np.where(call, norm_cdf(d1), norm_cdf(d1) - 1),
+        "gamma": density / (spot * vol * root),
+        "vega": spot * density * root / 100,
+        "theta": np.where(
+            call,
+            decay - rate * discounted * norm_cdf(d2),
+            decay + rate * discounted * norm_cdf(-d2),
+        )
+        / 365,
+    }
+
+
+def live_legs(row: IronFly) -> List[str]:
+    """Return the legs of the row that are filled and not exited"""
+    exited = {
+        "CE_EXITED": ("buy_ce", "sell_ce"),
+        "PE_EXITED": ("buy_pe", "sell_pe"),
+        "ALL_EXITED": LEGS,
+    }.get(row.sl_status, ())
+    return [
+        leg
+        for leg in LEGS
+        if leg not in exited and getattr(row, f"{leg}_status") == Status.COMPLETE
+    ]
+
+
+class Positions:
+    """The open legs as arrays, indexed by instrument and by client"""
+
+    def __init__(self, legs: Iterable[Tuple[str, str, int]]) -> None:
+        symbols: Dict[str, int] = dict()
+        client_ids: Dict[str, int] = dict()
+        instrument, owner, quantity = list(), list(), list()
+        for client_id, symbol, signed_quantity in legs:
+            if expiries.contract(symbol) is None:
+                log.warning("Not an option symbol, leg left out", symbol=symbol)
+                continue
+            instrument.append(symbols.setdefault(symbol, len(symbols)))
+            owner.append(client_ids.setdefault(client_id, len(client_ids)))
+            quantity.append(signed_quantity)
+        self.symbols = list(symbols)
+        self.client_ids = list(client_ids)
+        self.instrument = np.array(instrument, dtype=np.intp)
+        self.client = np.array(owner, dtype=np.intp)
+        self.quantity = np.array(quantity, dtype=float)
+        contracts = [expiries.contract(symbol) for symbol in self.symbols]
+        self.expires_at = np.array(
+            [
+                datetime.combine(expiry, EXPIRY_TIME).timestamp()
+                for expiry, *_ in contracts
+            ]
+        )
+        self.strike = np.array([strike for _, strike, _ in contracts], dtype=float)
+        self.call = np.array([option == "CE" for *_, option in contracts], dtype=bool)
+        # Net quantity of every instrument held by every client
+        self.holdings = np.bincount(
+            self.client * len(self.symbols) + self.instrument,
+            weights=self.quantity,
+            minlength=len(self.client_ids) * len(self.symbols),
+        ).reshape(len(self.client_ids), len(self.symbols))
+
+    @classmethod
+    def load(cls) -> "Positions":
+        """Load the live legs of every row that is not closed"""
+        with session_scope() as database:
+            rows = database.exec(
+                select(IronFly)
+                .where(IronFly.status != Status.CLOSED)
+                .where(shards.where(IronFly.client_id))
+            ).all()
+            database.expunge_all()
+        legs = list()
+        for row in rows:
+            try:
+                lots = clients.get(row.client_id).lots(IRON_FLY)
+            except Exception:
+                lots = 0
+            # A row that is still open was deployed with at least one lot
+            quantity = max(lots, 1) * LOT_SIZE
+            for leg in live_legs(row):
+                side = 1 if leg.startswith("buy") else -1
+                legs.append(
+                    (row.client_id, getattr(row, f"{leg}_symbol"), side * quantity)
+                )
+        return cls(legs)
+
+
+def finite(value: float) -> Optional[float]:
+    # JSON has no NaN
+    return float(value) if np.isfinite(value) else None
+
+
+class RiskReport:
+    """Greeks of one quote snapshot, per instrument, client and book"""
+
+    def __init__(
+        self,
+        spot: float,
+        computed_at: datetime,
+        positions: Positions,
+        vol: np.ndarray,
+        instrument_greeks: Dict[str, np.ndarray],
+        client_greeks: Dict[str, np.ndarray],
+        missing: List[str],
+    ) -> None:
+        self.spot = spot
+        self.computed_at = computed_at
+        self.positions = positions
+        self.vol = vol
+        self.instrument_greeks = instrument_greeks
+        self.client_greeks = client_greeks
+        self.missing = missing
+
+    def client(self, client_id: str) -> Dict[str, float]:
+        """Return the exposures of a client, zero if it holds nothing"""
+        try:
+            index = self.positions.client_ids.index(client_id)
+        except ValueError:
+            return dict.fromkeys(GREEKS, 0.0)
+        return {name: float(self.client_greeks[name][index]) for name in GREEKS}
+
+    def clients(self) -> Dict[str, Dict[str, float]]:
+        return {
+            client_id: {name: float(self.client_greeks[name][index]) for name in GREEKS}
+            for index, client_id in enumerate(self.positions.client_ids)
+        }
+
+    def book(self) -> Dict[str, float]:
+        return {name: float(self.client_greeks[name].sum()) for name in GREEKS}
+
+    def instruments(self) -> Dict[str, Dict[str, Optional[float]]]:
+        """Return the volatility and greeks of every instrument, None if unpriced"""
+        return {
+            symbol: {
+                "iv": finite(self.vol[index]),
+                **{
+                    name: finite(self.instrument_greeks[name][index]) for name in GREEKS
+                },
+            }
+            for index, symbol in enumerate(self.positions.symbols)
+        }
+
+    def as_dict(self) -> dict:
+        return {
+            "spot": self.spot,
+            "computed_at": self.computed_at.isoformat(timespec="seconds"),
+            "book": self.book(),
+            "clients": self.clients(),
+            "instruments": self.instruments(),
+            "missing": self.missing,
+        }
+
+
+class RiskEngine(Subscriber):
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self._lock = Lock()
+        self.positions = Positions(())
+        # The positions only change with the rows, the clients or the shard
+        self._stale = True
+        self._loaded_for: Optional[Tuple[FrozenSet[str], int]] = None
+        self.report: Optional[RiskReport] = None
+        # Last solved volatility of every instrument, the next first guess
+        self._vols: Dict[str, float] = dict()
+
+    def load(self) -> Positions:
+        loaded_for = (shards.owned, clients.version)
+        # A change while loading is loaded again next time
+        self._stale = False
+        positions = Positions.load()
+        with self._lock:
+            self.positions, self._loaded_for = positions, loaded_for
+        return positions
+
+    def current(self) -> Positions:
+        """The loaded positions, loaded again only once something changed them"""
+        with self._lock:
+            positions, loaded_for = self.positions, self._loaded_for
+        if self._stale or loaded_for != (shards.owned, clients.version):
+            positions = self.load()
+        return positions
+
+    def update(
+        self, ltps: Dict[str, float], now: Optional[datetime] = None
+    ) -> Optional[RiskReport]:
+        """Recompute every greek from one snapshot of LTPs, NIFTY included"""
+        with self._lock:
+            positions = self.positions
+        spot = ltps.get(NIFTY)
+        if spot is None:
+            return None
+        now = now or datetime.now()
+        prices = np.array([ltps.get(symbol, np.nan) for symbol in positions.symbols])
+        priced = np.isfinite(prices)
+        missing = [
+            symbol for symbol, ok in zip(positions.symbols, priced.tolist()) if not ok
+        ]
+        guess = np.array(
+            [self._vols.get(symbol, np.nan) for symbol in positions.symbols]
+        )
+        years = np.maximum(
+            (positions.expires_at - now.timestamp()) / YEAR_SECONDS, MIN_YEARS
+        )
+        unsolved = np.isnan(guess)
+        guess[unsolved] = np.sqrt(2 * np.pi / years[unsolved]) * prices[unsolved] / spot
+        vol = implied_vol(
+            prices, spot, positions.strike, years, self.rate, positions.call, guess
+        )
+        unit = greeks(spot, positions.strike, years, vol, self.rate, positions.call)
+        # An instrument without a price adds nothing rather than NaN
+        table = np.nan_to_num(np.stack([unit[name] for name in GREEKS], axis=1))
+        exposure = positions.holdings @ table
+        by_client = {name: exposure[:, index] for index, name in enumerate(GREEKS)}
+        report = RiskReport(spot, now, positions, vol, unit, by_client, missing)
+        with self._lock:
+            self._vols.update(
+                (symbol, value)
+                for symbol, value, ok in zip(
+                    positions.symbols, vol.tolist(), priced.tolist()
+                )
+                if ok
+            )
+            self.report = report
+        return report
+
+    def instruments(self) -> Set[str]:
+        symbols = self.current().symbols
+        return {NIFTY, *symbols} if symbols else set()
+
+    def on_order(self, update: OrderUpdate) -> None:
+        self._stale = True
+
+    def on_rows(self, client_ids: Set[str]) -> None:
+        self._stale = True
+
+    def on_quotes(self, ltps: Dict[str, float]) -> None:
+        report = self.update(ltps)
+        if report is not None:
+            log.info(
+                "Updated book greeks", missing=len(report.missing), **report.book()
+            )
+            self.push(report)
+
+    def push(self, report: RiskReport) -> None:
+        """Store the report of this worker's clients for the API"""
+        with session_scope() as database:
+            database.execute(
+                text(
+                    "INSERT INTO risksnapshot (worker_id, report, computed_at) "
+                    "VALUES (:worker_id, CAST(:report AS JSON), now()) "
+                    "ON CONFLICT (worker_id) DO UPDATE "
+                    "SET report = excluded.report, computed_at = excluded.computed_at"
+                ),
+                {"worker_id": shards.worker_id, "report": json.dumps(report.as_dict())},
+            )
+            # Every restart is a new worker, the reports of the old ones go
+            database.execute(
+                text(
+                    "DELETE FROM risksnapshot "
+                    "WHERE computed_at < now() - make_interval(secs => :max_age)"
+                ),
+                {"max_age": 10 * REPORT_MAX_AGE.total_seconds()},
+            )
+            database.execute(
+                text("SELECT pg_notify(:channel, :worker_id)"),
+                {"channel": CHANNEL, "worker_id": shards.worker_id},
+            )
+
+    def book(self) -> Dict[str, float]:
+        report = self.report
+        return report.book() if report is not None else dict()
+
+    def clients(self) -> Dict[str, Dict[str, float]]:
+        report = self.report
+        return report.clients() if report is not None else dict()
+
+
+class RiskView:
+    """The API's copy of the reports the trading app workers push"""
+
+    def __init__(self) -> None:
+        self.report: Optional[dict] = None
+
+    def start(self) -> None:
+        """Load the reports and follow the pushes, before `clients.start`"""
+        clients.listen(CHANNEL, lambda _: self.reload(), self.reload)
+        self.reload()
+
+    def reload(self) -> None:
+        """Merge the reports of the live workers into one of the whole book"""
+        oldest = datetime.now(timezone.utc) - REPORT_MAX_AGE
+        with session_scope() as database:
+            rows = database.exec(
+                select(RiskSnapshot)
+                .where(col(RiskSnapshot.computed_at) > oldest)
+                .order_by(col(RiskSnapshot.computed_at))
+            ).all()
+            database.expunge_all()
+        if not rows:
+            self.report = None
+            return
+        by_client: Dict[str, Dict[str, float]] = dict()
+        by_instrument: Dict[str, Dict[str, Optional[float]]] = dict()
+        missing: Set[str] = set()
+        # A client that just moved is taken from the newer report
+        for row in rows:
+            by_client.update(row.report["clients"])
+            by_instrument.update(row.report["instruments"])
+            missing.update(row.report["missing"])
+        latest = rows[-1].report
+        self.report = {
+            "spot": latest["spot"],
+            "computed_at": latest["computed_at"],
+            "workers": len(rows),
+            "book": {
+                name: sum(greeks[name] for greeks in by_client.values())
+                for name in GREEKS
+            },
+            "clients": by_client,
+            "instruments": by_instrument,
+            "missing": sorted(missing),
+        }
+
+
+risk = RiskEngine(get_settings().risk_free_rate)
+register_stats("risk_book", risk.book)
+register_stats("risk_client", risk.clients, "client")
+risk_view = RiskView()
@@ -0,0 +1,80 @@
+"""Iron fly rules shared by the live jobs and the backtester.
+
+Every rule works on plain numbers as well as on NumPy arrays, so the
+backtester evaluates the exact code that trades.
+"""
+
+from typing import NamedTuple
+
+import numpy as np
+
+STRIKE_STEP = 50
+# NIFTY contracts per lot
+LOT_SIZE = 75
+# Smallest price change of NIFTY options
+TICK = 0.05
+SL_MULTIPLE = 1.5
+ADJUSTMENT_FACTOR = 0.7
+WING_FACTOR = 1.0
+# No new iron fly within this many points of one that is not closed yet
+REDEPLOY_GAP = 99
+
+
+class Levels(NamedTuple):
+    total: float
+    high_adj: float
+    low_adj: float
+    high_sl: float
+    low_sl: float
+
+
+def nearest_price(price, step: int = STRIKE_STEP):
+    """Return the nearest price to the given price with the given step"""
+    remainder = price % step
+    nearest = price - remainder + (remainder >= step // 2) * step
+    if isinstance(nearest, np.ndarray):
+        return nearest.astype(int)
+    return int(nearest)
+
+
+def wing_strikes(strike, premium, wing_factor=WING_FACTOR):
+    """Return the call and put strikes bought `premium` away from the strike"""
+    return (
+        nearest_price(strike + wing_factor * premium),
+        nearest_price(strike - wing_factor * premium),
+    )
+
+
+def exit_levels(
+    strike,
+    sell_ce_price,
+    sell_pe_price,
+    buy_ce_price,
+    buy_pe_price,
+    sl_multiple=SL_MULTIPLE,
+    adjustment_factor=ADJUSTMENT_FACTOR,
+) -> Levels:
+    """Return the credit, adjustment band and stoplosses of a filled iron fly"""
+    total = sell_ce_price + sell_pe_price - buy_ce_price - buy_pe_price
+    return Levels(
+        total=total,
+        high_adj=strike + adjustment_factor * total,
+        low_adj=strike - adjustment_factor * total,
+        high_sl=sl_multiple * sell_ce_price,
+        low_sl=sl_multiple * sell_pe_price,
+    )
+
+
+def stoploss_hit(ltp, stoploss):
+    return ltp > stoploss
+
+
+def adjustment_hit(nifty_price, high_adj, low_adj):
+    return (nifty_price > high_adj) | (nifty_price < low_adj)
+
+
+def blocks_redeploy(strike, open_strike):
+    """Whether an iron fly that is still open rules out deploying at `strike`"""
+    return (strike - REDEPLOY_GAP <= open_strike) & (
+        open_strike <= strike + REDEPLOY_GAP
+    )
@@ -0,0 +1,352 @@
+"""Partitioning of the clients across several trading app workers.
+
+With `SHARD_ENABLED` any number of trading apps run side by side, each one
+trading its share of the clients. Every worker keeps a lease in the
+`workerlease` table and renews it every `SHARD_HEARTBEAT_INTERVAL` seconds. A
+worker whose lease is older than `SHARD_LEASE_TIMEOUT` is dead. The clients
+are spread over the live workers on a consistent hash ring with
+`SHARD_VNODES` points per worker, so a worker joining or leaving only moves
+the clients next to it on the ring.
+
+The ring alone is not enough to trade a client. A worker also takes a
+session advisory lock on every client it is given, on a connection of its
+own, and gives the lock back when the ring moves the client elsewhere. While
+the workers disagree about the ring, each client is still traded by at most
+one of them. When a worker dies its locks go with its connection.
+
+One worker also holds the leader lock. Only the leader downloads the
+instrument master and fetches the LTPs every worker asked for, in one batch.
+It then shares the LTPs through the `sharedquote` table and tells the other
+workers over the `shard` channel.
+"""
+
+import json
+from bisect import bisect
+from collections import Counter
+from hashlib import blake2b
+from os import getpid
+from socket import gethostname
+from threading import Thread
+from time import sleep
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from config import get_settings
+from database import engine as database_engine
+from database import session_scope
+from logger import logger as log
+from metrics import register_stats
+from registry import clients
+from sqlalchemy import text, true
+from sqlmodel import col
+
+CHANNEL = "shard"
+# The leader lock, any other advisory lock key is a client
+LEADER_KEY = 0x6C656164
+
+
+def ring_hash(value: str, signed: bool = False) -> int:
+    digest = blake2b(value.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=signed)
+
+
+def lock_key(client_id: str) -> int:
+    return ring_hash(f"client:{client_id}", signed=True)
+
+
+class HashRing:
+    """Consistent hash ring of the live workers"""
+
+    def __init__(self, workers: Iterable[str], vnodes: int) -> None:
+        points = sorted(
+            (ring_hash(f"{worker}#{point}"), worker)
+            for worker in workers
+            for point in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._workers = [worker for _, worker in points]
+
+    def owner(self, client_id: str) -> Optional[str]:
+        if not self._workers:
+            return None
+        index = bisect(self._hashes, ring_hash(client_id)) % len(self._hashes)
+        return self._workers[index]
+
+
+class ShardCoordinator:
+    def __init__(
+        self,
+        enabled: bool,
+        heartbeat_interval: float,
+        lease_timeout: float,
+        vnodes: int,
+        quote_max_age: float,
+    ) -> None:
+        self.enabled = enabled
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_timeout = lease_timeout
+        self.vnodes = vnodes
+        self.quote_max_age = quote_max_age
+        self.worker_id = f"{gethostname()}-{getpid()}"
+        self.leader = False
+        # Only a started coordinator limits what this process trades
+        self.running = False
+        self._owned: FrozenSet[str] = frozenset()
+        self._workers: List[str] = list()
+        self._ring = HashRing((), vnodes)
+        self._connection = None
+        self._thread: Optional[Thread] = None
+        self._handlers: Dict[str, Callable[[dict], None]] = dict()
+        self._stats = Counter()
+
+    @property
+    def owned(self) -> FrozenSet[str]:
+        """The clients this worker trades, once started"""
+        return self._owned
+
+    def owns(self, client_id: str) -> bool:
+        """Return whether this worker trades the client"""
+        return not self.running or client_id in self._owned
+
+    def where(self, column):
+        """Return the condition that a client id column is one this worker trades"""
+        if not self.running:
+            return true()
+        return col(column).in_(sorted(self._owned))
+
+    def leads(self) -> bool:
+        """Return whether this worker does the work done once for all of them"""
+        return not self.running or self.leader
+
+    def on(self, event: str, handler: Callable[[dict], None]) -> None:
+        """Call the handler when another worker broadcasts the event.
+
+        The "rebalance" event is this worker gaining or losing clients. The
+        handlers run on the listening threads, so they hand any real work off.
+        """
+        self._handlers[event] = handler
+
+    def broadcast(self, event: str, **fields) -> None:
+        """Tell the other workers about the event"""
+        if not self.running:
+            return
+        payload = json.dumps({"event": event, "worker": self.worker_id, **fields})
+        with session_scope() as database:
+            database.execute(
+                text("SELECT pg_notify(:channel, :payload)"),
+                {"channel": CHANNEL, "payload": payload},
+            )
+
+    def _on_notify(self, payload: str) -> None:
+        try:
+            message = json.loads(payload)
+            handler = self._handlers.get(message["event"])
+            if handler is not None and message["worker"] != self.worker_id:
+                handler(message)
+        except Exception:
+            log.exception("Error while handling a shard message", payload=payload)
+
+    def _resync(self) -> None:
+        """Act on every event once, any of them may have been missed"""
+        for event, handler in list(self._handlers.items()):
+            if event == "rebalance":
+                # Not a notification, the beats raise it
+                continue
+            try:
+                handler({"event": event, "worker": None})
+            except Exception:
+                log.exception("Error while resyncing a shard event", event=event)
+
+    def _connect(self) -> None:
+        # The locks live as long as this connection, so it leaves the pool
+        pooled = database_engine.raw_connection()
+        connection = pooled.driver_connection
+        pooled.detach()
+        connection.autocommit = True
+        self._connection = connection
+
+    def _execute(self, query: str, *parameters) -> list:
+        with self._connection.cursor() as cursor:
+            cursor.execute(query, parameters)
+            return cursor.fetchall() if cursor.description else list()
+
+    def beat(self) -> None:
+        """Renew the lease and take or give back clients as the ring says"""
+        if self._connection is None:
+            self._connect()
+        self._execute(
+            "INSERT INTO workerlease (worker_id, started_at, heartbeat, symbols) "
+            "VALUES (%s, now(), now(), '[]') "
+            "ON CONFLICT (worker_id) DO UPDATE SET heartbeat = now()",
+            self.worker_id,
+        )
+        workers = [
+            worker
+            for worker, in self._execute(
+                "SELECT worker_id FROM workerlease "
+                "WHERE heartbeat > now() - make_interval(secs => %s) "
+                "ORDER BY worker_id",
+                self.lease_timeout,
+            )
+        ]
+        if workers != self._workers:
+            log.info("Shard workers changed", workers=workers)
+            self._workers, self._ring = workers, HashRing(workers, self.vnodes)
+        wanted = {
+            client_id
+            for client_id in clients.client_ids()
+            if self._ring.owner(client_id) == self.worker_id
+        }
+        before = self._owned
+        # Stop trading the clients that moved before anyone else can take them
+        self._owned = before & wanted
+        self._release(before - wanted)
+        # The previous owner may still hold some of them until its next beat
+        owned = self._owned | self._acquire(wanted - self._owned)
+        if not self.leader:
+            (self.leader,) = self._execute(
+                "SELECT pg_try_advisory_lock(%s)", LEADER_KEY
+            )[0]
+            if self.leader:
+                log.info("Leading the shard workers", worker=self.worker_id)
+                # Leases dead for long are of workers that will not come back
+                self._execute(
+                    "DELETE FROM workerlease "
+                    "WHERE heartbeat < now() - make_interval(secs => %s)",
+                    10 * self.lease_timeout,
+                )
+        self._owned = frozenset(owned)
+        if self._owned != before:
+            gained, lost = len(self._owned - before), len(before - self._owned)
+            self._stats["rebalances"] += 1
+            log.info("Rebalanced shard", clients=len(owned), gained=gained, lost=lost)
+            handler = self._handlers.get("rebalance")
+            if handler is not None:
+                handler({"gained": gained, "lost": lost})
+        self._stats["beats"] += 1
+
+    def _acquire(self, client_ids: Set[str]) -> Set[str]:
+        if not client_ids:
+            return set()
+        keys = {lock_key(client_id): client_id for client_id in client_ids}
+        taken = self._execute(
+            "SELECT key FROM unnest(%s::bigint[]) AS key "
+            "WHERE pg_try_advisory_lock(key)",
+            list(keys),
+        )
+        self._stats["lock_misses"] += len(keys) - len(taken)
+        return {keys[key] for key, in taken}
+
+    def _release(self, client_ids: Set[str]) -> None:
+        if client_ids:
+            self._execute(
+                "SELECT pg_advisory_unlock(key) FROM unnest(%s::bigint[]) AS key",
+                [lock_key(client_id) for client_id in client_ids],
+            )
+
+    def _reset(self) -> None:
+        """Stop trading anything, the locks are gone with the connection"""
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except Exception:
+                pass
+        self._connection = None
+        lost = len(self._owned)
+        self._owned, self.leader, self._workers = frozenset(), False, list()
+        self._ring = HashRing((), self.vnodes)
+        handler = self._handlers.get("rebalance")
+        if lost and handler is not None:
+            handler({"gained": 0, "lost": lost})
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.beat()
+            except Exception:
+                log.exception("Shard lost its lease connection, dropping its clients")
+                self._stats["failures"] += 1
+                self._reset()
+            sleep(self.heartbeat_interval)
+
+    def start(self) -> None:
+        """Join the workers, before `clients.start` so that broadcasts arrive"""
+        if not self.enabled or self._thread is not None:
+            return
+        self.running = True
+        clients.listen(CHANNEL, self._on_notify, self._resync)
+        self._thread = Thread(target=self._run, name="shard", daemon=True)
+        self._thread.start()
+
+    def demand(self, symbols: Iterable[str]) -> None:
+        """Publish the symbols this worker needs the LTPs of"""
+        with session_scope() as database:
+            database.execute(
+                text(
+                    "UPDATE workerlease SET symbols = CAST(:symbols AS JSON) "
+                    "WHERE worker_id = :worker_id"
+                ),
+                {"symbols": json.dumps(sorted(symbols)), "worker_id": self.worker_id},
+            )
+
+    def demanded(self) -> Set[str]:
+        """Return the symbols any live worker needs the LTPs of"""
+        with session_scope() as database:
+            rows = database.execute(
+                text(
+                    "SELECT symbols FROM workerlease "
+                    "WHERE heartbeat > now() - make_interval(secs => :timeout)"
+                ),
+                {"timeout": self.lease_timeout},
+            ).all()
+        return {symbol for symbols, in rows for symbol in symbols or ()}
+
+    def share(self, ltps: Dict[str, float]) -> None:
+        """Store the LTPs for the other workers and tell them they are there"""
+        if not ltps:
+            return
+        with session_scope() as database:
+            database.execute(
+                text(
+                    "INSERT INTO sharedquote (symbol, ltp, fetched_at) "
+                    "SELECT symbol, ltp, now() FROM unnest("
+                    "CAST(:symbols AS VARCHAR[]), CAST(:ltps AS FLOAT[])"
+                    ") AS quote (symbol, ltp) "
+                    "ON CONFLICT (symbol) DO UPDATE "
+                    "SET ltp = excluded.ltp, fetched_at = excluded.fetched_at"
+                ),
+                {"symbols": list(ltps), "ltps": list(ltps.values())},
+            )
+        self.broadcast("quotes", count=len(ltps))
+
+    def shared(self, symbols: Iterable[str]) -> Dict[str, Tuple[float, float]]:
+        """Return the LTP and its age in seconds of the recently shared symbols"""
+        with session_scope() as database:
+            rows = database.execute(
+                text(
+                    "SELECT symbol, ltp, "
+                    "extract(epoch FROM now() - fetched_at)::float FROM sharedquote "
+                    "WHERE symbol = ANY(CAST(:symbols AS VARCHAR[])) "
+                    "AND fetched_at > now() - make_interval(secs => :max_age)"
+                ),
+                {"symbols": list(symbols), "max_age": self.quote_max_age},
+            ).all()
+        return {symbol: (ltp, age) for symbol, ltp, age in rows}
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **self._stats,
+            "clients": len(self._owned),
+            "workers": len(self._workers),
+            "leader": int(self.leader),
+        }
+
+
+settings = get_settings()
+shards = ShardCoordinator(
+    settings.shard_enabled,
+    settings.shard_heartbeat_interval,
+    settings.shard_lease_timeout,
+    settings.shard_vnodes,
+    settings.shard_quote_max_age,
+)
+register_stats("shard", shards.stats)
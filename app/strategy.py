@@ -0,0 +1,55 @@
+"""Strategies the trading app runs as plugins of the market bus.
+
+A strategy is a bus subscriber with a name, the underlying it trades, the
+jobs it schedules and the background work it runs. A plugin is a module of
+the same name as its strategy that registers the class with `@plugin`; the
+app loads every module listed in `STRATEGIES` and runs one instance of each.
+
+Which clients deploy a strategy, with how many lots and which parameters,
+comes from their `ClientStrategy` rows.
+"""
+
+from importlib import import_module
+from typing import Dict, List, Type
+
+from bus import Subscriber
+from config import NIFTY
+from models import Client
+from registry import clients
+
+PLUGINS: Dict[str, Type["Strategy"]] = dict()
+
+
+def plugin(cls: Type["Strategy"]) -> Type["Strategy"]:
+    """Make the strategy class loadable by its name"""
+    PLUGINS[cls.name] = cls
+    return cls
+
+
+class Strategy(Subscriber):
+    name = ""
+    underlying = NIFTY
+
+    def clients(self) -> List[Client]:
+        """Return the logged in clients that deploy the strategy"""
+        return clients.trading(self.name, self.underlying)
+
+    def schedule(self) -> None:
+        """Schedule the jobs of the strategy on the engine"""
+
+    async def run(self) -> None:
+        """Work in the background for as long as the app trades"""
+
+
+def load_strategies(names: str) -> List[Strategy]:
+    """Import the plugins of the comma separated strategies and create them"""
+    strategies = list()
+    for name in (name.strip() for name in names.split(",")):
+        if not name:
+            continue
+        if name not in PLUGINS:
+            import_module(name)
+        if name not in PLUGINS:
+            raise Exception(f"The module {name} does not register a strategy!")
+        strategies.append(PLUGINS[name]())
+    return strategies
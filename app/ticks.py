@@ -0,0 +1,270 @@
+"""Append-only store of every LTP and quote the trading app receives.
+
+Each day gets a directory under `TICK_STORE_PATH`, and every worker one of
+its own in it, named after the worker, with one fixed-width file per column,
+memory mapped and filled row by row:
+
+    time.bin  int64    nanoseconds since the epoch when the tick arrived
+    key.bin   uint32   line of the instrument key in symbols.txt
+    ltp.bin   float64
+    bid.bin   float64  best bid, NaN for LTP only ticks
+    ask.bin   float64  best ask, NaN for LTP only ticks
+
+The columns are preallocated for `TICK_STORE_CAPACITY` rows and doubled when
+full. `rows.bin` holds the number of rows written and is only bumped after
+the rows themselves, so a reader never sees a half written tick. Writing a
+tick is a handful of stores into mapped memory under a lock.
+
+`read_ticks` maps the columns of a day read-only, so research and replay code
+gets NumPy arrays without parsing anything. The ticks of several workers are
+merged in the order they arrived, which copies them once.
+"""
+
+import atexit
+import fcntl
+from datetime import date
+from pathlib import Path
+from threading import Lock
+from time import time_ns
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from config import get_settings
+from logger import logger as log
+from metrics import register_stats
+
+COLUMNS = {
+    "time": np.int64,
+    "key": np.uint32,
+    "ltp": np.float64,
+    "bid": np.float64,
+    "ask": np.float64,
+}
+NAN = float("nan")
+
+Tick = Tuple[str, float, float, float]
+
+
+def quote_tick(quote: dict) -> Tick:
+    """Return the tick of an Upstox LTP or full market quote"""
+    depth = quote.get("depth")
+    if not depth:
+        return quote["instrument_token"], quote["last_price"], NAN, NAN
+    return (
+        quote["instrument_token"],
+        quote["last_price"],
+        depth["buy"][0]["price"],
+        depth["sell"][0]["price"],
+    )
+
+
+class Ticks(NamedTuple):
+    time: np.ndarray
+    key: np.ndarray
+    ltp: np.ndarray
+    bid: np.ndarray
+    ask: np.ndarray
+    symbols: List[str]
+
+    def of(self, instrument_key: str) -> np.ndarray:
+        """Return the mask of the ticks of one instrument"""
+        if instrument_key not in self.symbols:
+            return np.zeros(len(self.key), dtype=bool)
+        return self.key == self.symbols.index(instrument_key)
+
+
+def day_directory(day: date, path: Optional[str] = None) -> Path:
+    return Path(path or get_settings().tick_store_path, day.isoformat())
+
+
+def read_ticks(day: date, path: Optional[str] = None) -> Ticks:
+    """Map the ticks of a day read-only, including those still being written"""
+    directory = day_directory(day, path)
+    # Days recorded before every worker had a directory hold the files
+    # themselves
+    parts = [
+        read_directory(part)
+        for part in (directory, *sorted(directory.iterdir()))
+        if (part / "rows.bin").exists()
+    ]
+    if not parts:
+        raise FileNotFoundError(f"No ticks recorded in {directory}")
+    if len(parts) == 1:
+        return parts[0]
+    symbols = list(dict.fromkeys(symbol for part in parts for symbol in part.symbols))
+    ids = {symbol: id for id, symbol in enumerate(symbols)}
+    keys = [
+        np.array([ids[symbol] for symbol in part.symbols], dtype=np.uint32)[part.key]
+        for part in parts
+    ]
+    time = np.concatenate([part.time for part in parts])
+    order = np.argsort(time, kind="stable")
+    return Ticks(
+        time[order],
+        np.concatenate(keys)[order],
+        *(
+            np.concatenate([getattr(part, name) for part in parts])[order]
+            for name in ("ltp", "bid", "ask")
+        ),
+        symbols=symbols,
+    )
+
+
+def read_directory(directory: Path) -> Ticks:
+    """Map the ticks recorded by one worker"""
+    rows = int(np.fromfile(directory / "rows.bin", dtype=np.int64, count=1)[0])
+    columns = {
+        name: (
+            np.memmap(directory / f"{name}.bin", dtype, mode="r", shape=(rows,))
+            if rows
+            else np.empty(0, dtype)
+        )
+        for name, dtype in COLUMNS.items()
+    }
+    # Symbols are written before the ticks that use them
+    symbols = (directory / "symbols.txt").read_text().splitlines()
+    return Ticks(**columns, symbols=symbols)
+
+
+class TickRecorder:
+    """Appends ticks to the files of the current day"""
+
+    def __init__(self, path: str, capacity: int) -> None:
+        self.path = path
+        self.capacity = capacity
+        self.enabled = False
+        self.worker_id: Optional[str] = None
+        self._lock = Lock()
+        self._day: Optional[date] = None
+        # The day whose directory another process holds, retried the next day
+        self._refused: Optional[date] = None
+        self._directory: Optional[Path] = None
+        self._lock_file = None
+        self._symbols_file = None
+        self._ids: Dict[str, int] = dict()
+        self._columns: Dict[str, np.memmap] = dict()
+        self._rows: Optional[np.memmap] = None
+        self._row = 0
+        self._size = 0
+        self.ticks = 0
+
+    def start(self, worker_id: str) -> None:
+        """Record from now on, only the trading app does"""
+        self.worker_id = worker_id
+        self.enabled = True
+
+    def _map(self, size: int) -> None:
+        for name, dtype in COLUMNS.items():
+            file = self._directory / f"{name}.bin"
+            if (
+                not file.exists()
+                or file.stat().st_size < size * np.dtype(dtype).itemsize
+            ):
+                # Extending the file keeps it sparse until the rows are written
+                with file.open("ab") as handle:
+                    handle.truncate(size * np.dtype(dtype).itemsize)
+            self._columns[name] = np.memmap(file, dtype, mode="r+", shape=(size,))
+        self._size = size
+
+    def _open(self, day: date) -> bool:
+        self._close()
+        directory = day_directory(day, self.path) / self.worker_id
+        directory.mkdir(parents=True, exist_ok=True)
+        lock_file = (directory / "lock").open("w")
+        try:
+            # A second writer would overwrite the rows of the first one
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            log.warning(
+                "Ticks are recorded by another process",
+                directory=str(directory),
+            )
+            self._refused = day
+            return False
+        self._refused = None
+        self._day, self._directory, self._lock_file = day, directory, lock_file
+        rows = directory / "rows.bin"
+        if not rows.exists():
+            rows.write_bytes(bytes(8))
+        self._rows = np.memmap(rows, np.int64, mode="r+", shape=(1,))
+        self._row = int(self._rows[0])
+        self._symbols_file = (directory / "symbols.txt").open("a+")
+        self._symbols_file.seek(0)
+        symbols = self._symbols_file.read().splitlines()
+        self._ids = {symbol: id for id, symbol in enumerate(symbols)}
+        times = directory / "time.bin"
+        # Reopening the day keeps the columns at the size they had grown to
+        size = times.stat().st_size // 8 if times.exists() else 0
+        self._map(max(self.capacity, size))
+        log.info("Recording ticks", directory=str(directory), rows=self._row)
+        return True
+
+    def _symbol_id(self, instrument_key: str) -> int:
+        id = self._ids[instrument_key] = len(self._ids)
+        self._symbols_file.write(instrument_key + "\n")
+        self._symbols_file.flush()
+        return id
+
+    def record_many(self, ticks: Iterable[Tick]) -> None:
+        """Append ticks that arrived together, they share one timestamp"""
+        if not self.enabled:
+            return
+        arrived = time_ns()
+        today = date.today()
+        with self._lock:
+            if today != self._day and (today == self._refused or not self._open(today)):
+                return
+            columns, row = self._columns, self._row
+            time, key = columns["time"], columns["key"]
+            ltp, bid, ask = columns["ltp"], columns["bid"], columns["ask"]
+            for instrument_key, last_price, best_bid, best_ask in ticks:
+                if row == self._size:
+                    self._map(self._size * 2)
+                    columns = self._columns
+                    time, key = columns["time"], columns["key"]
+                    ltp, bid, ask = columns["ltp"], columns["bid"], columns["ask"]
+                id = self._ids.get(instrument_key)
+                time[row] = arrived
+                key[row] = id if id is not None else self._symbol_id(instrument_key)
+                ltp[row], bid[row], ask[row] = last_price, best_bid, best_ask
+                row += 1
+            self.ticks += row - self._row
+            self._row = self._rows[0] = row
+
+    def record(
+        self, instrument_key: str, ltp: float, bid: float = NAN, ask: float = NAN
+    ) -> None:
+        self.record_many(((instrument_key, ltp, bid, ask),))
+
+    def _close(self) -> None:
+        for column in self._columns.values():
+            column.flush()
+        if self._rows is not None:
+            self._rows.flush()
+        for file in (self._symbols_file, self._lock_file):
+            if file is not None:
+                file.close()
+        self._columns, self._rows = dict(), None
+        self._symbols_file = self._lock_file = None
+        self._day = None
+
+    def close(self) -> None:
+        """Flush the day to disk and let go of its files"""
+        with self._lock:
+            self._close()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "ticks": self.ticks,
+                "rows": self._row,
+                "capacity": self._size,
+                "symbols": len(self._ids),
+            }
+
+
+settings = get_settings()
+recorder = TickRecorder(settings.tick_store_path, settings.tick_store_capacity)
+atexit.register(recorder.close)
+register_stats("tick_store", recorder.stats)
@@ -1,191 +1,140 @@
-import calendar
-from datetime import date, timedelta
-from typing import List
+from typing import Dict, Iterable, List
 
-from config import NIFTY, today
-from database import get_session
+from broker import broker
+from cache import QuoteCache
+from config import NIFTY, get_settings
+from database import session_scope
 from enums import Options, OrderType, Product, Status, TransactionType, Validity
-from httpx import get as get_request
+from expiry import expiries
 from logger import logger as log
-from models import Client, Credentials, Instruments, IronFly, Order
+from instruments import instruments
+from metrics import register_stats
+from models import Client, IronFly, Order, Quote
+from registry import clients
 from sqlmodel import select
+from ticks import quote_tick, recorder
 
-def get_clients() -> list[Client]:
-    """Return a list of active clients"""
-    database = get_session()
-    active_clients: list[Client] = list()
-    for client in database.exec(select(Credentials).where(Credentials.is_active == 1)):
-        active_clients.append(Client(client.client_id))
-    return active_clients
+ltp_cache = QuoteCache(ttl=get_settings().quote_cache_ttl)
+quote_cache = QuoteCache(ttl=get_settings().quote_cache_ttl)
+register_stats(
+    "quote_cache",
+    lambda: {"ltp": ltp_cache.stats(), "quotes": quote_cache.stats()},
+    "cache",
+)
 
 
-def last_two_thursdays(year, month: date.day) -> tuple[date.day, date.day]:
-    """Return the last two Thursdays of the given month"""
-    if month < 0 or month > 12:
-        raise Exception("Invalid month!")
-    _, last_day = calendar.monthrange(year, month)
-    last_day_date = date(year, month, last_day)
-    days_back = (last_day_date.weekday() - 3) % 7
-    last_thursday = last_day_date - timedelta(days=days_back)
-    second_last_thursday = last_thursday - timedelta(days=7)
-    return last_thursday.day, second_last_thursday.day
+def get_clients() -> list[Client]:
+    """Return a list of active clients"""
+    return clients.active()
 
 
 def get_access_token(client) -> str:
     """Return the access token of the given client"""
-    database = get_session()
     if isinstance(client, Client):
-        return database.get(Credentials, client.client_id).access_token
-    return database.get(Credentials, client).access_token
+        return clients.access_token(client.client_id)
+    return clients.access_token(client)
 
 
 def get_symbol(strike: int, option: Options) -> str:
     """Return the symbol of the given strike and option"""
-    _, last_day = calendar.monthrange(today.year, today.month)
-    last_day_date = date(today.year, today.month, last_day)
-    days_back = (last_day_date.weekday() - 3) % 7
-    last_thursday = last_day_date - timedelta(days=days_back)
-    if today >= last_thursday:
-        new_date = date(year=today.year, month=today.month + 1, day=today.day)
-        return "NIFTY" + new_date.strftime("%y%b").upper() + str(strike) + option
-    return "NIFTY" + today.strftime("%y%b").upper() + str(strike) + option
+    return expiries.symbol(strike, option)
 
 def get_token(tradingsymbol: str) -> str:
     """Return the token of the given tradingsymbol"""
-    database = get_session()
-    result = database.get(Instruments, tradingsymbol)
-    if not result:
-        raise Exception("The tradingsymbol does not exist!")
-    database.close()
-    return result.instrument_key
+    return instruments.key(tradingsymbol)
+
+
+def fetch_quotes(path: str, tradingsymbols: List[str]) -> Dict[str, dict]:
+    """Return the quotes of the tradingsymbols in as few requests as possible"""
+    tokens = {get_token(symbol): symbol for symbol in tradingsymbols}
+    keys = list(tokens)
+    batch_size = get_settings().quote_batch_size
+    access_token = get_access_token(get_clients()[0])
+    quotes = dict()
+    for start in range(0, len(keys), batch_size):
+        response = broker.get(
+            path,
+            access_token,
+            params={"instrument_key": ",".join(keys[start : start + batch_size])},
+        )
+        batch = response.json()["data"].values()
+        for quote in batch:
+            quotes[tokens[quote["instrument_token"]]] = quote
+        recorder.record_many(map(quote_tick, batch))
+    return quotes
+
+
+def fetch_ltps(tradingsymbols: List[str]) -> Dict[str, float]:
+    quotes = fetch_quotes("/market-quote/ltp", tradingsymbols)
+    return {symbol: quote["last_price"] for symbol, quote in quotes.items()}
+
+
+def fetch_market_quotes(tradingsymbols: List[str]) -> Dict[str, Quote]:
+    quotes = fetch_quotes("/market-quote/quotes", tradingsymbols)
+    return {symbol: Quote(**quote) for symbol, quote in quotes.items()}
+
+
+def get_ltps(tradingsymbols: Iterable[str]) -> Dict[str, float]:
+    """Return the last traded prices of all the given tradingsymbols"""
+    return ltp_cache.get_many(tradingsymbols, fetch_ltps)
+
+
+def get_quotes(tradingsymbols: Iterable[str]) -> Dict[str, Quote]:
+    """Return the LTP and market depth of all the given tradingsymbols"""
+    return quote_cache.get_many(tradingsymbols, fetch_market_quotes)
 
 
 @log.catch(reraise=True)
 def get_ltp(tradingsymbol: str) -> float:
     """Return the last traded price of the given tradingsymbol"""
-    token = get_token(tradingsymbol)
-    instrument = token.split("|")[0] + f":{tradingsymbol}"
-    access_token = get_access_token(get_clients()[0])
     try:
-        response = get_request(
-            url="https://api.upstox.com/v2/market-quote/ltp",
-            headers={
-                "accept": "application/json",
-                "Authorization": f"Bearer {access_token}",
-            },
-            params={"symbol": token},
-        )
-        ltp = response.json()["data"][instrument]["last_price"]
-        return ltp
+        return get_ltps((tradingsymbol,))[tradingsymbol]
     except Exception as error:
         log.error("Error when fetching LTP:", error)
 
 
 def get_multiple_ltps(*args):
-    tokens = list()
-    instruments = list()
-    for tradingsymbol in args:
-        token = get_token(tradingsymbol)
-        tokens.append(token)
-        instruments.append(token.split("|")[0] + f":{tradingsymbol}")
-    access_token = get_access_token(get_clients()[0])
     try:
-        response = get_request(
-            url="https://api.upstox.com/v2/market-quote/ltp",
-            headers={
-                "accept": "application/json",
-                "Authorization": f"Bearer {access_token}",
-            },
-            params={"symbol": tokens},
-        )
-        return (
-            response.json()["data"][instrument]["last_price"]
-            for instrument in instruments
-        )
+        ltps = get_ltps(args)
+        return (ltps[tradingsymbol] for tradingsymbol in args)
     except Exception as error:
         log.error("Error when fetching LTP:", error)
 
 
 def get_bid(tradingsymbol: str) -> float:
     """Return the last traded price of the given tradingsymbol"""
-    token = get_token(tradingsymbol)
-    instrument = token.split("|")[0] + f":{tradingsymbol}"
-    access_token = get_access_token(get_clients()[0])
     try:
-        response = get_request(
-            url="https://api.upstox.com/v2/market-quote/quotes",
-            headers={
-                "accept": "application/json",
-                "Authorization": f"Bearer {access_token}",
-            },
-            params={"instrument_key": token},
-        )
-        bid = response.json()["data"][instrument]["depth"]["buy"][0]["price"]
-        return bid + 0.05
+        return get_quotes((tradingsymbol,))[tradingsymbol].bid + 0.05
     except Exception as error:
         print("Error when fetching ask:", error)
 
 
 def get_ask(tradingsymbol: str) -> float:
     """Return the last traded price of the given tradingsymbol"""
-    token = get_token(tradingsymbol)
-    instrument = token.split("|")[0] + f":{tradingsymbol}"
-    access_token = get_access_token(get_clients()[0])
     try:
-        response = get_request(
-            url="https://api.upstox.com/v2/market-quote/quotes",
-            headers={
-                "accept": "application/json",
-                "Authorization": f"Bearer {access_token}",
-            },
-            params={"instrument_key": token},
-        )
-        ask = response.json()["data"][instrument]["depth"]["sell"][0]["price"]
-        return ask - 0.05
+        return get_quotes((tradingsymbol,))[tradingsymbol].ask - 0.05
     except Exception as error:
         print("Error when fetching ask:", error)
 
 
 def get_nifty_price() -> float:
     """Return the last traded price of NIFTY"""
-    token = get_token(NIFTY)
-    access_token = get_access_token(get_clients()[0])
     try:
-        response = get_request(
-            url="https://api.upstox.com/v2/market-quote/ltp",
-            headers={
-                "accept": "application/json",
-                "Authorization": f"Bearer {access_token}",
-            },
-            params={"instrument_key": token},
-        )
-        ltp = response.json()["data"][token.replace("|", ":")]["last_price"]
-        return ltp
+        return get_ltps((NIFTY,))[NIFTY]
     except Exception as error:
         raise Exception("Error when fetching nifty price:", error)
 
-def nearest_price(price: float, step: int = 50) -> int:
-    """Return the nearest price to the given price with the given step"""
-    remainder = price % step
-    if remainder < step // 2:
-        return int(price - remainder)
-    else:
-        return int(price + (step - remainder))
-
-
 def complete_rows() -> List[IronFly]:
-    database = get_session()
-    return database.exec(
-        select(IronFly).where(IronFly.status == Status.COMPLETE)
-    )  # TODO: If it doesn't work, use .all() method
+    with session_scope() as database:
+        return database.exec(
+            select(IronFly).where(IronFly.status == Status.COMPLETE)
+        ).all()
     # return database.query(IronFly).filter_by(status=Status.COMPLETE).all()
 
 
 def open_rows() -> List[IronFly]:
-    database = get_session()
-    return database.exec(
-        select(IronFly).where(IronFly.status == Status.OPEN)
-    )  # TODO: If it doesn't work, use .all() method
+    with session_scope() as database:
+        return database.exec(select(IronFly).where(IronFly.status == Status.OPEN)).all()
 
 
 def buy(
@@ -0,0 +1,98 @@
+"""Fixtures shared by the tests.
+
+The tests import the modules of `app/` the way they import each other, with
+the settings of the environment or `.env`. They write to the configured
+database, so point the DATABASE_* settings at a scratch database, like for
+the benchmark.
+"""
+
+import os
+import sys
+from pathlib import Path
+from typing import Callable, Iterator
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+# Settings no test uses
+for name in ("LOGIN_URL", "REDIRECT_URI", "BETTERSTACK_SOURCE_TOKEN"):
+    os.environ.setdefault(name, "")
+os.environ.setdefault("METRICS_PORT", "0")
+
+from database import engine, session_scope  # noqa: E402
+from enums import Status  # noqa: E402
+from logger import pipeline  # noqa: E402
+from migrations import migrate  # noqa: E402
+from models import Credentials, IronFly  # noqa: E402
+from sqlmodel import col, delete  # noqa: E402
+
+PREFIX = "TEST"
+
+
+def pytest_unconfigure() -> None:
+    # While pytest still captures the output the logs are written to
+    pipeline.close()
+
+
+@pytest.fixture(scope="session", autouse=True)
+def schema() -> None:
+    try:
+        with engine.connect():
+            pass
+    except Exception as error:
+        pytest.exit(f"The tests need a scratch database: {error}", returncode=1)
+    migrate()
+
+
+@pytest.fixture
+def client_id() -> Iterator[str]:
+    """A client of the tests, removed with its rows afterwards"""
+
+    def cleanup() -> None:
+        with session_scope() as database:
+            for model in (IronFly, Credentials):
+                database.exec(
+                    delete(model).where(col(model.client_id).like(f"{PREFIX}%"))
+                )
+
+    cleanup()
+    with session_scope() as database:
+        database.add(
+            Credentials(
+                client_id=f"{PREFIX}0001",
+                is_active=1,
+                api_key="",
+                api_secret="",
+                access_token="token",
+            )
+        )
+    yield f"{PREFIX}0001"
+    cleanup()
+
+
+@pytest.fixture
+def add_row(client_id: str) -> Callable[..., IronFly]:
+    """Insert an iron fly of the test client around the given strike"""
+
+    def add(strike: int, status: str = Status.COMPLETE, **values) -> IronFly:
+        legs = {
+            "buy_ce": (strike + 500, "CE"),
+            "buy_pe": (strike - 500, "PE"),
+            "sell_ce": (strike, "CE"),
+            "sell_pe": (strike, "PE"),
+        }
+        row = IronFly(client_id=client_id, strike=strike, status=status)
+        for leg, (leg_strike, option) in legs.items():
+            setattr(row, f"{leg}_order_id", f"{row.id}-{leg}")
+            setattr(row, f"{leg}_symbol", f"NIFTY{leg_strike}{option}")
+            setattr(row, f"{leg}_price", 100.0)
+            setattr(row, f"{leg}_status", Status.COMPLETE)
+        for name, value in values.items():
+            setattr(row, name, value)
+        with session_scope() as database:
+            database.add(row)
+            database.flush()
+            database.expunge(row)
+        return row
+
+    return add
@@ -0,0 +1,78 @@
+import asyncio
+from threading import Lock
+from typing import Callable, List
+
+from config import NIFTY
+from feed import MarketFeed
+from mock_feed import MockFeed
+from monitor import StopLossMonitor
+from websockets.asyncio.server import serve
+
+
+async def wait_for(condition: Callable[[], bool], timeout: float = 10.0) -> None:
+    async def poll() -> None:
+        while not condition():
+            await asyncio.sleep(0.02)
+
+    await asyncio.wait_for(poll(), timeout)
+
+
+def test_feed_resubscribes_and_checks_only_the_ticked_rows(add_row) -> None:
+    ticked = add_row(24000)
+    untouched = add_row(25000)
+
+    checked: List[str] = list()
+    lock = Lock()
+
+    def evaluate(row, ltps, nifty) -> None:
+        with lock:
+            checked.append(row.id)
+
+    # Every LTP a check needs is known, so only the ticks decide what is checked
+    ltps = {NIFTY: 24000.0}
+    for row in (ticked, untouched):
+        ltps[row.sell_ce_symbol] = ltps[row.sell_pe_symbol] = 100.0
+    monitor = StopLossMonitor(evaluate, ltps)
+    assert {ticked.sell_ce_symbol, untouched.sell_ce_symbol} <= monitor.refresh()
+
+    ticks: List[str] = list()
+
+    def on_tick(key: str, ltp: float) -> None:
+        # The keys of the mock are the symbols themselves
+        ticks.append(key)
+        ltps[key] = ltp
+        monitor.on_tick(key, ltp)
+
+    async def run() -> None:
+        # Drops every connection after three ticks
+        mock = MockFeed(interval=0.02, volatility=0.01, start_price=100.0, drop_after=3)
+        async with serve(mock.handle, "127.0.0.1", 0) as server:
+            port = server.sockets[0].getsockname()[1]
+            feed = MarketFeed(lambda: "token", on_tick, f"ws://127.0.0.1:{port}")
+            await feed.subscribe([ticked.sell_ce_symbol])
+            task = asyncio.create_task(feed.run())
+            try:
+                await wait_for(lambda: feed.reconnects >= 1)
+                before = len(ticks)
+                await wait_for(lambda: len(ticks) > before)
+            finally:
+                task.cancel()
+        return mock, feed
+
+    mock, feed = asyncio.run(run())
+
+    # The keys subscribed before the drop are subscribed again on reconnecting
+    subscriptions = [
+        request["data"]["instrumentKeys"]
+        for request in mock.requests
+        if request["method"] == "sub"
+    ]
+    assert mock.connections >= 2
+    assert len(subscriptions) >= 2
+    assert all(keys == [ticked.sell_ce_symbol] for keys in subscriptions)
+    assert set(ticks) == {ticked.sell_ce_symbol}
+
+    # The checks run on the engine's workers
+    asyncio.run(wait_for(lambda: bool(checked)))
+    with lock:
+        assert set(checked) == {ticked.id}
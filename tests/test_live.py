@@ -0,0 +1,31 @@
+from database import session_scope
+from enums import Status
+from live import LivePublisher
+from models import IronFly
+from sqlmodel import update
+
+
+def test_quotes_mark_the_rows_in_memory(add_row, client_id, monkeypatch) -> None:
+    row = add_row(24000)
+    publisher = LivePublisher()
+    pushed = list()
+    monkeypatch.setattr(publisher, "_push", pushed.append)
+
+    publisher.publish()
+    assert "NIFTY24000CE" in publisher.instruments()
+    assert publisher.stats()["loads"] == 1
+
+    # A quote marks the rows read before, without reading them again
+    publisher.on_quotes({"NIFTY24000CE": 120.0})
+    assert publisher.stats()["loads"] == 1
+    assert len(pushed) == 2
+
+    # The rows of a client are read again once one of them changes
+    with session_scope() as database:
+        database.exec(
+            update(IronFly).where(IronFly.id == row.id).values(status=Status.CLOSED)
+        )
+    publisher.publish({client_id}, reload=True)
+    assert publisher.stats()["loads"] == 2
+    assert publisher.instruments() == set()
+    assert len(pushed) == 3
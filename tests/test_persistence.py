@@ -0,0 +1,65 @@
+from database import session_scope
+from enums import Status
+from models import IronFly
+from persistence import Changes
+from sqlmodel import select, update
+
+
+def load(row_id: str) -> IronFly:
+    with session_scope() as database:
+        row = database.get(IronFly, row_id)
+        database.expunge(row)
+    return row
+
+
+def test_save_writes_only_the_changed_columns(add_row) -> None:
+    row = add_row(24000, Status.OPEN, sell_ce_status=Status.OPEN, total=None)
+    with session_scope() as database:
+        rows = Changes(database, select(IronFly).where(IronFly.id == row.id))
+    # Written by a postback while the job has the row
+    with session_scope() as database:
+        database.exec(
+            update(IronFly)
+            .where(IronFly.id == row.id)
+            .values(buy_ce_message="filled elsewhere")
+        )
+    (job_row,) = rows
+    job_row.sell_ce_status = Status.COMPLETE
+    job_row.total = 120.0
+    with session_scope() as database:
+        assert rows.save(database) == 1
+    assert rows.conflicts == []
+
+    saved = load(row.id)
+    assert saved.sell_ce_status == Status.COMPLETE
+    assert saved.total == 120
+    assert saved.buy_ce_message == "filled elsewhere"
+    assert saved.modified_at == job_row.modified_at
+
+    # Saved rows are only written again once they change again
+    with session_scope() as database:
+        assert rows.save(database) == 0
+
+
+def test_save_skips_rows_changed_since_they_were_loaded(add_row) -> None:
+    row = add_row(24000, Status.OPEN, sell_ce_status=Status.OPEN)
+    other = add_row(24500, Status.OPEN, sell_ce_status=Status.OPEN)
+    with session_scope() as database:
+        rows = Changes(
+            database,
+            select(IronFly).where(IronFly.id.in_([row.id, other.id])),
+        )
+    with session_scope() as database:
+        database.exec(
+            update(IronFly)
+            .where(IronFly.id == row.id)
+            .values(sell_ce_status=Status.REJECTED)
+        )
+    for job_row in rows:
+        job_row.sell_ce_status = Status.COMPLETE
+    with session_scope() as database:
+        assert rows.save(database) == 1
+    assert [conflict.id for conflict in rows.conflicts] == [row.id]
+
+    assert load(row.id).sell_ce_status == Status.REJECTED
+    assert load(other.id).sell_ce_status == Status.COMPLETE
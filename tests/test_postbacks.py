@@ -0,0 +1,48 @@
+import iron_fly
+from api import app
+from config import get_settings
+from database import session_scope
+from enums import Status
+from fastapi.testclient import TestClient
+from models import FetchedOrder, IronFly
+from orders import LEGS
+from replay_postbacks import fill_events, replay
+
+
+def test_postback_during_reconciliation_is_kept(add_row, monkeypatch) -> None:
+    # The sell CE leg of a new row, whose status the reconciliation fills in
+    row = add_row(24000, Status.OPEN, sell_ce_status=None, sell_ce_price=None)
+    monkeypatch.setattr(get_settings(), "postback_secret", "secret")
+    published = list()
+    monkeypatch.setattr(iron_fly.bus, "publish_order", published.append)
+
+    class Client:
+        def fetch_orders(self):
+            # Upstox posts the fill while the order book, from before it, downloads
+            events = fill_events(120.0)
+            assert [event["order_id"] for event in events] == [row.sell_ce_order_id]
+            assert replay(TestClient(app), "/postback", events, "secret", 0) == 0
+            return [
+                FetchedOrder(
+                    order_id=getattr(row, f"{leg}_order_id"),
+                    transaction_type=leg.split("_")[0].upper(),
+                    trading_symbol=getattr(row, f"{leg}_symbol"),
+                    status="open" if leg == "sell_ce" else Status.COMPLETE,
+                    status_message=None,
+                    average_price=getattr(row, f"{leg}_price") or 0.0,
+                )
+                for leg in LEGS
+            ]
+
+    monkeypatch.setattr(iron_fly.clients, "get", lambda client_id: Client())
+    iron_fly.update_order_status()
+
+    with session_scope() as database:
+        saved = database.get(IronFly, row.id)
+    assert saved.sell_ce_status == Status.COMPLETE
+    assert saved.sell_ce_price == 120.0
+    # The postback filled the last leg, the row is traded from now on
+    assert saved.status == Status.COMPLETE
+    assert saved.total is not None
+    # Nor is the order book's stale status announced
+    assert published == []
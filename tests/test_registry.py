@@ -0,0 +1,62 @@
+from threading import Event
+from time import monotonic, sleep
+from typing import Callable, List
+
+from database import session_scope
+from registry import ClientRegistry
+from sqlalchemy import text
+
+CHANNEL = "test_registry"
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 15.0) -> None:
+    deadline = monotonic() + timeout
+    while not condition():
+        assert monotonic() < deadline, "timed out"
+        sleep(0.02)
+
+
+def send(payload: str) -> None:
+    with session_scope() as database:
+        database.execute(
+            text("SELECT pg_notify(:channel, :payload)"),
+            {"channel": CHANNEL, "payload": payload},
+        )
+
+
+def test_listener_survives_handlers_and_resyncs_on_reconnect(client_id) -> None:
+    handled: List[str] = list()
+    resyncs: List[float] = list()
+    delivered = Event()
+
+    def handle(payload: str) -> None:
+        if payload == "fail":
+            raise ValueError(payload)
+        handled.append(payload)
+        delivered.set()
+
+    registry = ClientRegistry()
+    registry.listen(CHANNEL, handle, lambda: resyncs.append(monotonic()))
+    registry.start()
+    wait_for(lambda: len(resyncs) == 1)
+    # The registry's own channel catches up too
+    assert client_id in registry.client_ids()
+
+    # A failing handler leaves the connection to the next notification
+    send("fail")
+    send("ok")
+    assert delivered.wait(5)
+    assert handled == ["ok"]
+
+    # Whatever was sent while the connection was down is caught up on
+    with session_scope() as database:
+        database.execute(
+            text(
+                "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                "WHERE query = :query"
+            ),
+            {"query": f"LISTEN {CHANNEL}"},
+        )
+    wait_for(lambda: len(resyncs) == 2)
+    send("again")
+    wait_for(lambda: handled == ["ok", "again"])